@@ -20,4 +20,5 @@ def validate_base(input_seq):
 class SeqForm(forms.Form):
     input_seq = forms.CharField(label='',  validators=[validate_base], 
         widget=forms.Textarea(attrs={'cols': 50, 'placeholder': 'Your sequence...'}),
-        error_messages={'required': 'Error: Nothing was inputted'})
\ No newline at end of file
+        error_messages={'required': 'Error: Nothing was inputted'})
+    uncertainty = forms.BooleanField(label='Estimate uncertainty (Monte-Carlo dropout)', required=False)
\ No newline at end of file
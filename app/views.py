@@ -1,9 +1,22 @@
 from django.shortcuts import render
 from .forms import SeqForm
 
+import os
 import numpy as np
 import tensorflow as tf
+from tensorflow.keras import backend as K
 from tensorflow.keras.models import load_model
+from model_creation.model_search.autotune import apply_profile
+from model_creation.model_evaluation.uncertainty import mc_dropout_model, predict_mc
+
+apply_profile('inference') # tuned CPU threads, if a thread profile was saved
+MODEL_PATH = os.environ.get('CROTON_MODEL', 'models/CROTON.h5') # e.g. a distilled student model
+MC_SAMPLES = 50 # dropout passes for the uncertainty estimate
+MODEL = load_model(MODEL_PATH) # load multitask model once, not per request
+MC_MODEL = mc_dropout_model(MODEL) # copy with dropout on at prediction time, built once as well
+GRAPH = tf.compat.v1.get_default_graph() # TF1 keeps the graph and session per thread, so requests served
+SESS = K.get_session()                   # on other runserver threads must re-enter the ones the models were built in
+STATS = ['delfreq', 'prob_1bpins', 'prob_1bpdel', 'onemod3_freq', 'twomod3_freq', 'frameshift_freq']
 
 def one_hot_encode(seq, base_map):
     seq = seq.upper()
@@ -21,8 +34,13 @@ def get_input_view(request):
             input_seq = form['input_seq'].value()
             input_seq = one_hot_encode(input_seq, 'ACGT')
             input_seq = np.reshape(input_seq, (1, 60, 4))
-            model = load_model('models/CROTON.h5') #load multitask model
-            pred = model.predict(input_seq)
+            with GRAPH.as_default():
+                K.set_session(SESS)
+                if form.cleaned_data['uncertainty']: # mean and std over dropout passes, run as one batch
+                    mc = predict_mc(MC_MODEL, input_seq, n_samples=MC_SAMPLES)
+                    pred = mc['mean']
+                else:
+                    pred = MODEL.predict(input_seq)
             
             delfreq = pred[:,0].flatten().tolist()[0] * 100
             prob_1bpins = pred[:,1].flatten().tolist()[0] * 100
@@ -48,6 +66,9 @@ def get_input_view(request):
                 'twomod3_freq': twomod3_freq, 
                 'frameshift_freq': frameshift_freq,
             }
+            if form.cleaned_data['uncertainty']:
+                for i, stat in enumerate(STATS):
+                    context[stat + '_std'] = ' \u00b1 ' + str(round(mc['std'][0, i] * 100, 2)) + ' %'
 
     else: # if GET (or any other method), create a blank form
         context = {'form': SeqForm()}
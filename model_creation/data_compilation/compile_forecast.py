@@ -1,10 +1,12 @@
 """Convert cigar string to distribution
 """
 
-from model_creation.data_compilation.read_forecast_data import main as read_data_main
+from model_creation.data_compilation.read_forecast_data import main as read_data_main, grna_fp, outcomes_dir
+from model_creation.data_compilation.encode import seqs_to_codes
+from model_creation.data_compilation.shards import write_shards
+import os
 import numpy as np
 import re
-from amber.utils.data_parser import seq_to_matrix
 import pickle
 
 def token_to_full_indel(indel):
@@ -92,21 +94,31 @@ def dump_pickle(seqs, labels, idx, fp=None):
     return x, y
 
 
-def main():
-    oligo_dict, label_dict = read_data_main()
+train_fp = "./data/01_train_data/forecast.train.pkl"
+val_fp = "./data/01_train_data/forecast.val.pkl"
+test_fp = "./data/01_train_data/forecast.test.pkl"
+
+def main(grna_fp=grna_fp, par_dir=outcomes_dir, train_fp=train_fp, val_fp=val_fp, test_fp=test_fp, shard_dir=None):
+    oligo_dict, label_dict = read_data_main(token=True, grna_fp=grna_fp, par_dir=par_dir)
     label_oligos = [k for k in label_dict if k in oligo_dict]
 
     # compile many summary stats as labels
     indel_freq = get_indel_freq(label_dict, label_oligos)
     prob_ins1bp = get_1bp_insertion(label_dict, label_oligos)
 
-    # compile the raw sequence one-hot encoded
-    seqs = np.asarray([seq_to_matrix(oligo_dict[oligo]) for oligo in label_oligos])
+    # compile the raw sequence as uint8 base codes; one-hot expansion happens at batch time,
+    # see model_creation.data_compilation.encode
+    seqs = seqs_to_codes([oligo_dict[oligo] for oligo in label_oligos])
 
     # split into test, val, train, and save pikle
     test_idx, val_idx, train_idx = split_train_val_test(label_oligos, seed=777)
 
     # dump to disk
-    _ = dump_pickle(seqs, [indel_freq, prob_ins1bp], train_idx, fp="./data/01_train_data/forecast.train.pkl")
-    _ = dump_pickle(seqs, [indel_freq, prob_ins1bp], val_idx, fp="./data/01_train_data/forecast.val.pkl")
-    _ = dump_pickle(seqs, [indel_freq, prob_ins1bp], test_idx, fp="./data/01_train_data/forecast.test.pkl")
+    _ = dump_pickle(seqs, [indel_freq, prob_ins1bp], train_idx, fp=train_fp)
+    _ = dump_pickle(seqs, [indel_freq, prob_ins1bp], val_idx, fp=val_fp)
+    _ = dump_pickle(seqs, [indel_freq, prob_ins1bp], test_idx, fp=test_fp)
+
+    # optionally also as memory-mapped shards, for streaming (amber_cnn_sumstats.py --data-dir)
+    if shard_dir:
+        for split, idx in (('train', train_idx), ('val', val_idx), ('test', test_idx)):
+            write_shards(os.path.join(shard_dir, split), seqs[idx], [indel_freq[idx], prob_ins1bp[idx]])
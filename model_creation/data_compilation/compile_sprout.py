@@ -2,10 +2,13 @@
 Generate labels from Leenay data (del_freq, 1bp_ins_proba etc.)'''
 
 import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 from scipy.stats import entropy
-from model_creation.data_compilation.read_sprout_data import final_df
+from model_creation.data_compilation.read_sprout_data import classify_cigars
+from model_creation.data_compilation.sprout_store import (counts_store_path, insertions_store_path, master_store_path,
+    choose_source, open_store, write_store)
 
 
 key_df_path = 'key_df.csv'
@@ -19,161 +22,142 @@ master_dir = 'data/Sprout/master'
 ## Create master_dfs ##
 #######################
 
-def get_master_df(cts_path, ins_path, maxlen=80): # maxlen = 80 [do not consider insertions > 20 bp]
+def merge_insertion_samples(ins, maxlen=80):
+    # sum counts of the same insertion allele over all samples in one groupby
+    ins_df = ins.groupby(['Allele', 'insseq', 'seqlen'], as_index=False)['Count'].sum()
+    ins_df = ins_df[['Allele', 'Count', 'insseq', 'seqlen']]
+    ins_df = ins_df[ins_df['seqlen'] <= maxlen]
+    return ins_df.rename(columns={'Allele': 'cigar', 'Count':'total', 'insseq':'seq'})
+
+def read_counts(cts_path):
     counts = pd.read_csv(cts_path)
-    counts = counts.rename(columns={ counts.columns[0]: 'cigar' })
+    return counts.rename(columns={ counts.columns[0]: 'cigar' })
+
+def read_insertions(ins_path):
+    if not os.path.exists(ins_path): return None
+    return pd.read_csv(ins_path)
 
+def master_from_frames(counts, ins, maxlen=80):
     counts = counts.dropna()
-    no_variant_inds = []
-    for ind in range(len(counts)):
-        if (counts.cigar.iloc[ind].count('SNV') == 1): no_variant_inds.append(ind)
-        elif (counts.cigar.iloc[ind] == 'no variant'): no_variant_inds.append(ind)
-    master_df = counts[~counts.index.isin(no_variant_inds)] # only deletions
-
-    no_include_inds = []
-    for ind in range(len(counts)):
-        if (counts.cigar.iloc[ind].count('SNV') == 1): no_include_inds.append(ind)
-        elif (counts.cigar.iloc[ind] == 'no variant'): no_include_inds.append(ind)
-        
-        if (counts.cigar.iloc[ind].count('I') > 0) and (counts.cigar.iloc[ind].count('D') > 0): no_include_inds.append(ind)
-        elif (counts.cigar.iloc[ind].count('I') > 1) or (counts.cigar.iloc[ind].count('D') > 1): no_include_inds.append(ind)
-        elif(counts.cigar.iloc[ind] == 'Other'): no_include_inds.append(ind)
-    
-    master_df = counts[~counts.index.isin(no_include_inds)] # only deletions
-    master_df = master_df[['cigar', 'total', 'seq', 'seqlen']]
-
-    if os.path.exists(ins_path):
-        ins = pd.read_csv(ins_path)
+    outcome = classify_cigars(counts['cigar'])
+    # drop SNVs, no variant, Other and complex outcomes, only simple indels
+    master_df = counts.loc[outcome['indel'], ['cigar', 'total', 'seq', 'seqlen']]
+
+    if ins is not None:
         ins = ins.dropna()
         if len(ins) != 0:
-            grouped = ins.groupby(ins.Sample)
-            groups = list(set(ins.Sample.tolist()))
-            ins_df = grouped.get_group(groups[0])
-            ins_df = ins_df[['Allele', 'Count', 'insseq', 'seqlen']]
-            for i in range(len(groups) - 1):
-                sample = grouped.get_group(groups[i+1])
-                sample = sample[['Allele', 'Count', 'insseq', 'seqlen']]
-                ins_df = pd.merge(ins_df, sample, on=['Allele', 'insseq', 'seqlen'], how='outer').fillna(0)
-                ins_df['Count'] = ins_df['Count_x'] + ins_df['Count_y']
-                ins_df = ins_df[['Allele', 'Count', 'insseq', 'seqlen']]
-            ins_df = ins_df[ins_df['seqlen'] <= maxlen]
-            ins_df = ins_df.rename(columns={'Allele': 'cigar', 'Count':'total', 'insseq':'seq'})
-            master_df = master_df.append(ins_df)
+            master_df = pd.concat([master_df, merge_insertion_samples(ins, maxlen)])
     master_df['seq'] = master_df['seq'].str.upper()
-    
+
     return master_df
 
-def create_master_files():
-    df = pd.read_csv(key_df_path) #get key df with no replicates
-    for i in range(len(df)):
-        genename = df['genename'][i]
-        id_ending_lst = df['id_ending'][i]
-        id_ending_lst = id_ending_lst.strip('][').split(', ')
-        id_ending_lst = [end.replace("'", '') for end in id_ending_lst]
-        gene_paths = [genename + end + '.txt' for end in id_ending_lst]
-        
-        for j in range(len(id_ending_lst)):
-            cts_path = os.path.join(counts_dir, 'counts-' + gene_paths[j])
-            ins_path = os.path.join(insertions_dir, 'insertions-' + gene_paths[j])
-            master_df_ = get_master_df(cts_path, ins_path)
-            if j == 0: master_df = master_df_ # first dataframe
-            else:
-                master_df = master_df.merge(master_df_, on=['cigar', 'seq', 'seqlen'], how='outer')
-                master_df['total_x'] = master_df['total_x'].fillna(0.)
-                master_df['total_y'] = master_df['total_y'].fillna(0.)
-                master_df['total'] = master_df['total_x'] + master_df['total_y']
-                master_df = master_df.drop(columns=['total_x', 'total_y'])
-        master_df = master_df.rename(columns={'total': 'count'})
-        master_df['seq'] = master_df['seq'].str.upper()
-        master_name = 'master-' + genename + '.txt'
-        master_df.to_csv(os.path.join(master_dir, master_name), index=False)
-
-################################
-## Add statcols to key_df.csv ##
-################################
-
-def add_proba_1bp_insertion():
-    df = pd.read_csv(key_df_path)
-    df['prob_1bpins']: df[col] = np.nan
-    for i in range(len(df)):
-        genename = df['genename'][i]
-        total_indels = df['insertions'][i] + df['deletions'][i]
-
-        master_name = 'master-' + genename + '.txt'
-        master_df = pd.read_csv(os.path.join(master_dir, master_name))
-        master_df = master_df[master_df['seqlen'] == 61] #master only has 1 bp insertions now
-        total_1bpins = master_df['count'].to_numpy().sum()
-
-        df.loc[i, 'prob_1bpins'] = total_1bpins / total_indels
-
-    df.to_csv(key_df_path, index=False)
-#proba_1bp_insertion()
-
-def add_proba_1bp_deletion():
-    df = pd.read_csv(key_df_path)
-    df['prob_1bpdel'] = np.nan
-    for i in range(len(df)):
-        genename = df['genename'][i]
-        total_indels = df['insertions'][i] + df['deletions'][i]
-
-        master_name = 'master-' + genename + '.txt'
-        master_df = pd.read_csv(os.path.join(master_dir, master_name))
-        master_df = master_df[master_df['seqlen'] == 59] #master only has 1 bp insertions now
-        total_1bpdel = master_df['count'].to_numpy().sum()
-
-        df.loc[i, 'prob_1bpdel'] = total_1bpdel / total_indels
-
-    df.to_csv(key_df_path, index=False)
-#proba_1bp_deletion()
-
-def add_frameshift_freq():
-    df = pd.read_csv(key_df_path)
-    onemod3_freq, twomod3_freq = [], []
-    for col in ['onemod3_freq', 'twomod3_freq', 'frameshift_freq']: df[col] = np.nan
-    for i in range(len(df)):
-        genename = df['genename'][i]
-        id_ending_lst = df['id_ending'][i]
-        id_ending_lst = id_ending_lst.strip('][').split(', ')
-        id_ending_lst = [end.replace("'", '') for end in id_ending_lst]
-        gene_paths = [genename + end + '.txt' for end in id_ending_lst]
-        total, total_onemod3, total_twomod3 = 0, 0, 0
-        for j in range(len(id_ending_lst)):
-            cts_path = os.path.join(counts_dir, 'counts-' + gene_paths[j])
-            counts = pd.read_csv(cts_path)
-            counts = counts.rename(columns={ counts.columns[0]: 'cigar' })
-            exclude_inds = []
-            for ind in range(len(counts)):
-                if (counts.cigar.iloc[ind].count('SNV') == 1): exclude_inds.append(ind)
-                elif (counts.cigar.iloc[ind] == 'no variant'): exclude_inds.append(ind)
-                elif(counts.cigar.iloc[ind] == 'Other'): exclude_inds.append(ind)
-                elif (counts.cigar.iloc[ind].count('I') > 0) and (counts.cigar.iloc[ind].count('D') > 0): exclude_inds.append(ind)
-                elif (counts.cigar.iloc[ind].count('I') > 1) or (counts.cigar.iloc[ind].count('D') > 1): exclude_inds.append(ind)
-            counts = counts[~counts.index.isin(exclude_inds)] #get rid of complex variants and no variants, only indels including those outside of 60bp range 
-            
-            seqlens = []
-            for cigar in counts.cigar:
-                if 'D' in cigar:
-                    cigar_ = cigar.split(':')
-                    dellen = cigar_[1].replace('D', '')
-                    seqlens.append(60-int(dellen))
-                if 'I' in cigar:
-                    cigar_ = cigar.split(':')
-                    inslen = cigar_[1].replace('I', '')
-                    seqlens.append(60+int(inslen))
-            counts['seqlen'] = seqlens
-            counts['mod3'] = (counts['seqlen'] - 60) % 3
-            counts_onemod3 = counts[counts['mod3'] == 1]
-            counts_twomod3 = counts[counts['mod3'] == 2]
-
-            total += counts['total'].to_numpy().sum()
-            total_onemod3 += counts_onemod3['total'].to_numpy().sum()
-            total_twomod3 += counts_twomod3['total'].to_numpy().sum()
-        
-        onemod3_freq.append(total_onemod3 / total) #computing total over all counts dfs for gene
-        twomod3_freq.append(total_twomod3 / total)
-    
-    df['onemod3_freq'] = onemod3_freq
-    df['twomod3_freq'] = twomod3_freq
+def get_master_df(cts_path, ins_path, maxlen=80): # maxlen = 80 [do not consider insertions > 20 bp]
+    return master_from_frames(read_counts(cts_path), read_insertions(ins_path), maxlen)
+
+def frameshift_totals(counts):
+    # only simple indels, including those outside of 60bp range; returns total, 1 mod 3 and 2 mod 3 counts
+    counts = counts[counts['cigar'].notna()]
+    outcome = classify_cigars(counts['cigar'])
+    keep = outcome['indel'] & (outcome['ins'] | outcome['del'])
+    counts, is_ins = counts[keep], outcome.loc[keep, 'ins'].to_numpy()
+    indel_len = counts['cigar'].str.split(':').str[1].str.replace('[ID]', '', regex=True).astype(int).to_numpy()
+    mod3 = np.where(is_ins, indel_len, -indel_len) % 3 # seqlen - 60
+    total = counts['total'].to_numpy()
+    return total.sum(), total[mod3 == 1].sum(), total[mod3 == 2].sum()
+
+def load_gene_frames(gene_key, counts_store_fp=counts_store_path, insertions_store_fp=insertions_store_path):
+    # counts and insertions of one counts file (key = genename + id_ending), from the columnar
+    # stores if they have been ingested since the csv directories last changed, else from the csv files
+    counts_store, ins_store = open_store(counts_store_fp, counts_dir), open_store(insertions_store_fp, insertions_dir)
+    if counts_store is not None: counts = counts_store.read(gene_key)
+    else: counts = read_counts(os.path.join(counts_dir, 'counts-' + gene_key + '.txt'))
+    if ins_store is not None: ins = ins_store.read(gene_key) if gene_key in ins_store else None
+    else: ins = read_insertions(os.path.join(insertions_dir, 'insertions-' + gene_key + '.txt'))
+    return counts, ins
+
+def parse_id_endings(id_ending):
+    # id_ending is stored as the string of a python list, e.g. "['-1', 'r-01-2']"
+    id_ending_lst = id_ending.strip('][').split(', ')
+    return [end.replace("'", '') for end in id_ending_lst]
+
+##########################################
+## Master files + statcols, in one pass ##
+##########################################
+
+def gene_stats(genename, id_ending, total_indels, maxlen=80, master_dir=master_dir,
+        counts_store_fp=counts_store_path, insertions_store_fp=insertions_store_path):
+    '''Read every counts/insertions file of a gene once, and return its prob_1bpins, prob_1bpdel,
+    onemod3_freq and twomod3_freq with its master table; the master table is written to master_dir
+    (and not returned) unless master_dir is None'''
+    masters = []
+    total, total_onemod3, total_twomod3 = 0, 0, 0
+    for end in parse_id_endings(id_ending):
+        counts, ins = load_gene_frames(genename + end, counts_store_fp, insertions_store_fp)
+        masters.append(master_from_frames(counts, ins, maxlen))
+        totals = frameshift_totals(counts)
+        total, total_onemod3, total_twomod3 = total + totals[0], total_onemod3 + totals[1], total_twomod3 + totals[2]
+
+    # sum counts of the same outcome over all counts dfs of the gene
+    master_df = pd.concat(masters).groupby(['cigar', 'seq', 'seqlen'], as_index=False, sort=False)['total'].sum()
+    master_df = master_df.rename(columns={'total': 'count'})[['cigar', 'count', 'seq', 'seqlen']]
+    stats = {
+        'prob_1bpins': master_df.loc[master_df['seqlen'] == 61, 'count'].sum() / total_indels,
+        'prob_1bpdel': master_df.loc[master_df['seqlen'] == 59, 'count'].sum() / total_indels,
+        'onemod3_freq': total_onemod3 / total, #computing total over all counts dfs for gene
+        'twomod3_freq': total_twomod3 / total,
+    }
+    if master_dir is None: return stats, master_df
+    master_df.to_csv(os.path.join(master_dir, 'master-' + genename + '.txt'), index=False)
+    return stats, None
+
+def _gene_stats_star(args):
+    return gene_stats(*args)
+
+def compile_sprout_stats(key_fp=key_df_path, out_fp=key_df_path, master_dir=master_dir, master_store_fp=None,
+        counts_store_fp=counts_store_path, insertions_store_fp=insertions_store_path, maxlen=80, n_jobs=None):
+    '''Create master files and add prob_1bpins, prob_1bpdel, onemod3_freq, twomod3_freq and
+    frameshift_freq to key_df, with genes spread over n_jobs processes (all cores if None).
+    If master_store_fp is given, master tables go to one columnar store instead of master_dir;
+    read them back with read_master or iter_master_tables either way'''
+    df = pd.read_csv(key_fp)
+    if master_store_fp is not None: master_dir = None
+    else: os.makedirs(master_dir, exist_ok=True)
+    total_indels = (df['insertions'] + df['deletions']).tolist()
+    counts_store_fp = choose_source(counts_store_fp, counts_dir, 'counts')
+    insertions_store_fp = choose_source(insertions_store_fp, insertions_dir, 'insertions')
+    tasks = [(df['genename'][i], df['id_ending'][i], total_indels[i], maxlen, master_dir, counts_store_fp, insertions_store_fp)
+            for i in range(len(df))]
+    if n_jobs == 1:
+        stats = [gene_stats(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            stats = list(executor.map(_gene_stats_star, tasks, chunksize=8))
+    if master_store_fp is not None:
+        write_store(master_store_fp, {task[0]: master_df for task, (_, master_df) in zip(tasks, stats)}, 'master')
+
+    stats = pd.DataFrame([stat for stat, _ in stats], index=df.index)
+    for col in stats.columns: df[col] = stats[col]
     df['frameshift_freq'] = df['onemod3_freq'] + df['twomod3_freq']
-    df.to_csv(key_df_path, index=False)
-#frameshift_freq()
+    df.to_csv(out_fp, index=False)
+    return df
+
+def read_master(genename, master_store_fp=master_store_path, master_dir=master_dir):
+    '''Master table of one gene, from the master store if it has been written since master_dir last
+    changed, else from master_dir'''
+    store = open_store(master_store_fp, master_dir)
+    if store is not None: return store.read(genename)
+    return pd.read_csv(os.path.join(master_dir, 'master-' + genename + '.txt'))
+
+def iter_master_tables(master_store_fp=master_store_path, master_dir=master_dir):
+    '''Yield (genename, master table) for every gene written by compile_sprout_stats, from the master
+    store if it has been written since master_dir last changed, else from master_dir'''
+    store = open_store(choose_source(master_store_fp, master_dir, 'master'), master_dir)
+    if store is not None:
+        for genename in store.keys(): yield genename, store.read(genename)
+    else:
+        for filename in sorted(os.listdir(master_dir)):
+            if not (filename.startswith('master-') and filename.endswith('.txt')): continue
+            yield filename[len('master-'):-len('.txt')], pd.read_csv(os.path.join(master_dir, filename))
+
+# Run (after read_sprout_data.get_indels_and_totalout):
+# compile_sprout_stats()
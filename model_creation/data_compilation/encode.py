@@ -0,0 +1,110 @@
+"""Compact uint8 encoding of nucleotide sequences, expanded to one-hot only when a batch is needed
+
+Sequences are stored as one uint8 code per base (A=0, C=1, G=2, T/U=3, N=4, anything else=5).
+`codes_to_onehot` reproduces `amber.utils.data_parser.seq_to_matrix` exactly: N becomes 0.25 in
+every channel and unrecognized letters become all-zero rows.
+"""
+
+import numpy as np
+
+BASE_CODES = 'ACGTN'
+N_CODE = 4
+UNKNOWN_CODE = 5
+
+# byte -> code lookup; everything not listed maps to the all-zero row, as in seq_to_matrix
+_CODE_TABLE = np.full(256, UNKNOWN_CODE, dtype=np.uint8)
+for _code, _letter in enumerate(BASE_CODES):
+    _CODE_TABLE[ord(_letter)] = _code
+_CODE_TABLE[ord('U')] = 3
+
+# code -> one-hot row
+ONE_HOT_TABLE = np.array([
+    [1, 0, 0, 0],
+    [0, 1, 0, 0],
+    [0, 0, 1, 0],
+    [0, 0, 0, 1],
+    [0.25, 0.25, 0.25, 0.25],
+    [0, 0, 0, 0]
+], dtype=np.float32)
+
+
+def seq_to_codes(seq):
+    """Encode one sequence as a 1D uint8 code array
+    """
+    return _CODE_TABLE[np.frombuffer(seq.encode('ascii'), dtype=np.uint8)]
+
+
+def seqs_to_codes(seqs):
+    """Encode a list of equal-length sequences as a (n_seqs, seq_len) uint8 code matrix in one pass
+
+    Parameters
+    ----------
+    seqs : list of str
+        sequences of identical length
+
+    Returns
+    -------
+    codes : np.array
+        uint8 matrix of base codes
+    """
+    seqs = list(seqs)
+    if len(seqs) == 0:
+        return np.zeros((0, 0), dtype=np.uint8)
+    seq_len = len(seqs[0])
+    buf = ''.join(seqs).encode('ascii')
+    if len(buf) != seq_len * len(seqs):
+        raise ValueError("seqs_to_codes only works with sequences of the same length")
+    return _CODE_TABLE[np.frombuffer(buf, dtype=np.uint8)].reshape(len(seqs), seq_len)
+
+
+def codes_to_onehot(codes, dtype=np.float32):
+    """Expand uint8 base codes of any shape to one-hot, adding a trailing axis of 4
+    """
+    onehot = ONE_HOT_TABLE[codes]
+    if onehot.dtype != dtype:
+        onehot = onehot.astype(dtype)
+    return onehot
+
+
+def is_codes(x):
+    """True if `x` holds base codes (uint8, no one-hot axis) rather than one-hot matrices
+    """
+    return isinstance(x, np.ndarray) and x.dtype == np.uint8 and x.ndim == 2
+
+
+class OneHotCodes:
+    """Read-only, array-like one-hot view over a uint8 code matrix
+
+    Indexing (integers, slices or index arrays) along the first axis returns float32 one-hot
+    batches, so this can be handed to code that only ever slices batches out of `x`, e.g. the AMBER
+    manager, without expanding the whole dataset in memory.
+
+    Parameters
+    ----------
+    codes : np.array
+        uint8 matrix of shape (n_seqs, seq_len)
+    """
+
+    def __init__(self, codes):
+        self.codes = codes
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, idx):
+        return codes_to_onehot(self.codes[idx])
+
+    def __array__(self, dtype=None, copy=None):
+        return codes_to_onehot(self.codes, dtype=np.float32 if dtype is None else dtype)
+
+    @property
+    def shape(self):
+        return self.codes.shape + (4,)
+
+    @property
+    def ndim(self):
+        return self.codes.ndim + 1
+
+    @property
+    def dtype(self):
+        return ONE_HOT_TABLE.dtype
@@ -0,0 +1,265 @@
+'''
+Declarative runner for the data compilation steps
+
+Each Stage names the files/directories it reads (inputs) and writes (outputs), keyed by the keyword
+arguments of its function. The runner
+    - orders stages by matching inputs to the outputs of other stages,
+    - skips a stage if all of its outputs exist and are newer than all of its inputs,
+    - runs stages whose dependencies are done in parallel, each in its own process,
+    - has stages write to temporary paths that are moved into place only on success,
+    - logs wall time and peak memory (max RSS of the stage process and its children) per stage.
+
+Example:
+    python -m model_creation.data_compilation.pipeline sprout --jobs 3
+'''
+import os
+import sys
+import time
+import shutil
+import argparse
+import resource
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+
+
+class Stage:
+    '''One step of a pipeline
+
+    Parameters
+    ----------
+    name : str
+        unique stage name
+    func : callable
+        called as func(**inputs, **outputs, **params), with the output paths replaced by temporary paths
+    inputs : dict
+        keyword -> path (file or directory) read by func
+    outputs : dict
+        keyword -> path (file or directory) written by func
+    params : dict
+        other keyword arguments for func
+    '''
+    def __init__(self, name, func, inputs=None, outputs=None, params=None):
+        self.name = name
+        self.func = func
+        self.inputs = inputs or {}
+        self.outputs = outputs or {}
+        self.params = params or {}
+
+
+def _mtime(path, newest=True):
+    # newest (or oldest) modification time of a file, or of any file under a directory
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    times = [os.path.getmtime(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files]
+    times.append(os.path.getmtime(path))
+    return max(times) if newest else min(times)
+
+
+def is_up_to_date(stage):
+    if not stage.outputs or not all(os.path.exists(p) for p in stage.outputs.values()):
+        return False
+    missing = [p for p in stage.inputs.values() if not os.path.exists(p)]
+    if missing:
+        return False
+    oldest_output = min(_mtime(p, newest=False) for p in stage.outputs.values())
+    newest_input = max([_mtime(p) for p in stage.inputs.values()] or [0])
+    return oldest_output >= newest_input
+
+
+def _tmp_path(path):
+    # keep the extension, some writers depend on it
+    head, tail = os.path.split(path)
+    stem, ext = os.path.splitext(tail)
+    return os.path.join(head, '.%s.tmp%i%s' % (stem, os.getpid(), ext))
+
+
+def _commit(tmp, path):
+    if os.path.isdir(tmp) and os.path.isdir(path):
+        # directories cannot be replaced atomically when the target exists; swap then clean up
+        old = _tmp_path(path) + '.old'
+        os.rename(path, old)
+        os.rename(tmp, path)
+        shutil.rmtree(old)
+    else:
+        os.replace(tmp, path)
+
+
+def _peak_rss_mb():
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak / (1024. ** 2 if sys.platform == 'darwin' else 1024.) # bytes on macOS, KB on Linux
+
+
+def _run_stage(stage, conn):
+    start = time.time()
+    tmp_outputs = {k: _tmp_path(p) for k, p in stage.outputs.items()}
+    try:
+        for p in stage.outputs.values():
+            if os.path.dirname(p): os.makedirs(os.path.dirname(p), exist_ok=True)
+        stage.func(**stage.inputs, **tmp_outputs, **stage.params)
+        for k, p in stage.outputs.items():
+            if not os.path.exists(tmp_outputs[k]):
+                raise FileNotFoundError("stage '%s' did not write its output %s" % (stage.name, p))
+            _commit(tmp_outputs[k], p)
+        conn.send((None, time.time() - start, _peak_rss_mb()))
+    except BaseException:
+        for tmp in tmp_outputs.values():
+            if os.path.isdir(tmp): shutil.rmtree(tmp, ignore_errors=True)
+            elif os.path.exists(tmp): os.remove(tmp)
+        conn.send((traceback.format_exc(), time.time() - start, _peak_rss_mb()))
+    finally:
+        conn.close()
+
+
+def get_dependencies(stages):
+    '''stage name -> names of the stages producing its inputs; raises ValueError on cycles or
+    outputs written by more than one stage'''
+    producer = {}
+    for stage in stages:
+        for p in stage.outputs.values():
+            p = os.path.normpath(p)
+            if p in producer:
+                raise ValueError("%s is written by both '%s' and '%s'" % (p, producer[p], stage.name))
+            producer[p] = stage.name
+    deps = {stage.name: {producer[os.path.normpath(p)] for p in stage.inputs.values()
+                         if os.path.normpath(p) in producer} for stage in stages}
+    # check for cycles
+    done, pending = set(), dict(deps)
+    while pending:
+        ready = [name for name, d in pending.items() if d <= done]
+        if not ready:
+            raise ValueError("dependency cycle among stages: %s" % sorted(pending))
+        for name in ready:
+            done.add(name)
+            del pending[name]
+    return deps
+
+
+def run_pipeline(stages, n_jobs=1, force=False):
+    '''Run stages in dependency order, up to n_jobs at a time
+
+    Parameters
+    ----------
+    stages : list of Stage
+    n_jobs : int
+        maximum number of stages running concurrently
+    force : bool
+        run every stage, even if its outputs are up to date
+
+    Returns
+    -------
+    log : list of dict
+        per-stage name, status ('ran', 'skipped' or 'failed'), wall time (s) and peak RSS (MB)
+    '''
+    deps = get_dependencies(stages)
+    by_name = {stage.name: stage for stage in stages}
+    done, failed, log, running = set(), [], [], {}
+    waiting = [stage.name for stage in stages]
+
+    def record(name, status, wall=0., peak_rss=0.):
+        log.append({'stage': name, 'status': status, 'wall_time': wall, 'peak_rss_mb': peak_rss})
+        print("[pipeline] %-24s %-8s %8.1fs %9.1f MB" % (name, status, wall, peak_rss), flush=True)
+
+    while waiting or running:
+        skipped = True
+        while skipped and not failed: # skipping a stage can make its dependents ready
+            skipped = False
+            for name in [n for n in waiting if deps[n] <= done]:
+                stage = by_name[name]
+                if not force and is_up_to_date(stage):
+                    waiting.remove(name)
+                    done.add(name)
+                    skipped = True
+                    record(name, 'skipped')
+                elif len(running) < n_jobs:
+                    waiting.remove(name)
+                    recv, send = multiprocessing.Pipe(duplex=False)
+                    proc = multiprocessing.Process(target=_run_stage, args=(stage, send), name=name)
+                    proc.start()
+                    send.close()
+                    running[proc.sentinel] = (name, proc, recv)
+        if waiting and not running and not failed:
+            raise RuntimeError("stages can never run: %s" % waiting)
+        if not running:
+            break
+        for sentinel in wait(list(running)):
+            name, proc, recv = running.pop(sentinel)
+            try:
+                error, wall, peak_rss = recv.recv()
+            except EOFError:
+                error, wall, peak_rss = "process exited with code %s" % proc.exitcode, 0., 0.
+            proc.join()
+            if error is None:
+                done.add(name)
+                record(name, 'ran', wall, peak_rss)
+            else:
+                failed.append(name)
+                record(name, 'failed', wall, peak_rss)
+                print(error, file=sys.stderr, flush=True)
+
+    if failed:
+        raise RuntimeError("pipeline failed at stage(s): %s" % ', '.join(failed))
+    return log
+
+
+def sprout_stages(n_jobs=None):
+    '''SPROUT (Leenay et al.) labels: run load_sprout.R first for summary_df.txt, Leenay_bam_df.csv
+    and the counts/30insertions directories'''
+    from model_creation.data_compilation import read_sprout_data as rsd
+    from model_creation.data_compilation import compile_sprout as cs
+    from model_creation.data_compilation import sprout_store as ss
+    return [
+        Stage('ingest_counts', ss.ingest_sprout_dir,
+              inputs={'src_dir': cs.counts_dir}, outputs={'store_fp': ss.counts_store_path},
+              params={'kind': 'counts'}),
+        Stage('ingest_insertions', ss.ingest_sprout_dir,
+              inputs={'src_dir': cs.insertions_dir}, outputs={'store_fp': ss.insertions_store_path},
+              params={'kind': 'insertions'}),
+        Stage('clean_bam_df', rsd.write_clean_csv,
+              inputs={'bam_fp': rsd.Leenay_bam_df_path}, outputs={'out_fp': rsd.clean_bam_df_path}),
+        Stage('create_final_df', rsd.create_final_df,
+              inputs={'summary_fp': rsd.summary_df_path, 'clean_bam_fp': rsd.clean_bam_df_path},
+              outputs={'out_fp': 'final_df.raw.csv'}),
+        Stage('add_num_indels', rsd.add_num_indels,
+              inputs={'in_fp': 'final_df.raw.csv', 'counts_store_fp': ss.counts_store_path},
+              outputs={'out_fp': rsd.final_df_path}),
+        Stage('create_key_df', rsd.create_key_df,
+              inputs={'final_fp': rsd.final_df_path}, outputs={'out_fp': 'key_df.raw.csv'}),
+        Stage('get_indels_and_totalout', rsd.get_indels_and_totalout,
+              inputs={'key_fp': 'key_df.raw.csv', 'final_fp': rsd.final_df_path},
+              outputs={'out_fp': 'key_df.indels.csv'}),
+        Stage('compile_sprout_stats', cs.compile_sprout_stats,
+              inputs={'key_fp': 'key_df.indels.csv', 'counts_store_fp': ss.counts_store_path,
+                      'insertions_store_fp': ss.insertions_store_path},
+              outputs={'out_fp': cs.key_df_path, 'master_store_fp': ss.master_store_path},
+              params={'n_jobs': n_jobs}),
+    ]
+
+
+def forecast_stages(grna_fp=None, par_dir=None):
+    '''FORECasT (Allen et al.) train/val/test pickles'''
+    from model_creation.data_compilation import compile_forecast as cf
+    return [
+        Stage('compile_forecast', cf.main,
+              inputs={'grna_fp': grna_fp or cf.grna_fp, 'par_dir': par_dir or cf.outcomes_dir},
+              outputs={'train_fp': cf.train_fp, 'val_fp': cf.val_fp, 'test_fp': cf.test_fp}),
+    ]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile CROTON training data')
+    parser.add_argument("target", choices=['sprout', 'forecast', 'all'], help="which dataset(s) to compile")
+    parser.add_argument("--workdir", type=str, default='.', help="directory the relative data paths are resolved in")
+    parser.add_argument("--jobs", type=int, default=1, help="number of stages to run concurrently")
+    parser.add_argument("--gene-jobs", type=int, default=None, help="processes for per-gene SPROUT statistics")
+    parser.add_argument("--grna-fp", type=str, default=None, help="FORECasT gRNA target table")
+    parser.add_argument("--forecast-dir", type=str, default=None, help="FORECasT processed indels directory")
+    parser.add_argument("--force", action='store_true', help="rerun stages even if up to date")
+    args = parser.parse_args()
+
+    stages = []
+    if args.target in ('sprout', 'all'): stages += sprout_stages(n_jobs=args.gene_jobs)
+    if args.target in ('forecast', 'all'): stages += forecast_stages(args.grna_fp, args.forecast_dir)
+    os.chdir(args.workdir)
+    run_pipeline(stages, n_jobs=args.jobs, force=args.force)
@@ -66,25 +66,72 @@ def read_oligo_seq(grna_fp):
     When considering cut and PAM sites, upstream 3nt needs to consider the strandness
     """
     oligo_df = pd.read_csv(grna_fp, sep="\t")
-    n_rev = 0
-    oligo_df['TargetSequence_forward_centered'] = ''
-    for i in range(oligo_df.shape[0]):
-        seq = get_recenter_pam(oligo_df['TargetSequence'][i],
-                pam_index=oligo_df['PAM Index'][i],
-                strand=oligo_df['Strand'][i],
-                out_len=60)
-        if oligo_df['Strand'][i] == 'REVERSE':
-            seq = reverse_complement(seq)
-            n_rev += 1
-        oligo_df.at[i, 'TargetSequence_forward_centered'] = seq
-
-    # print("total rev=%i"%n_rev)
-    oligo_df.index = oligo_df.ID
-    oligo_dict = oligo_df['TargetSequence_forward_centered'].to_dict()
-    # print(oligo_dict)
+    strand = oligo_df['Strand'].to_numpy()
+    pam_index = oligo_df['PAM Index'].to_numpy()
+    cut_index = np.where(strand == 'FORWARD', pam_index - 3, pam_index + 3)
+    seqs = extract_windows(oligo_df['TargetSequence'].tolist(), cut_index,
+            reverse=(strand == 'REVERSE'), out_len=60)
+    oligo_dict = dict(zip(oligo_df['ID'], seqs))
     return oligo_dict
 
 
+# byte -> complementary byte; anything else is left as-is
+_COMPLEMENT = np.arange(256, dtype=np.uint8)
+for _b, _c in zip(b'ACGTNacgtn', b'TGCANtgcan'):
+    _COMPLEMENT[_b] = _c
+
+
+def extract_windows(seqs, cut_indices, reverse=None, out_len=60):
+    """Bulk version of `get_recenter_pam` + `reverse_complement`: cut a window of out_len//2 bases on
+    each side of every cut index, pad Ns past the sequence ends, and reverse complement the windows
+    flagged in `reverse`
+
+    Parameters
+    ----------
+    seqs : list of str, or str
+        either one sequence per cut index (e.g. gRNA target sequences), or a single sequence that
+        all cut indices refer to (e.g. a chromosome, for genome-wide window extraction)
+    cut_indices : array-like of int
+        0-based cut positions; positions outside of [0, len(seq)] are clipped to the sequence ends
+    reverse : array-like of bool, or None
+        windows to reverse complement
+    out_len : int
+        window length
+
+    Returns
+    -------
+    list of str
+        one window per cut index
+    """
+    flanking_len = out_len // 2
+    cut_indices = np.asarray(cut_indices, dtype=np.int64)
+    n = len(cut_indices)
+    N = ord('N')
+    if isinstance(seqs, str):
+        buf = np.frombuffer(seqs.encode('ascii'), dtype=np.uint8)
+        padded = np.full(len(buf) + 2 * flanking_len, N, dtype=np.uint8)
+        padded[flanking_len:flanking_len + len(buf)] = buf
+        cut_indices = np.clip(cut_indices, 0, len(buf))
+        windows = padded[cut_indices[:, None] + np.arange(2 * flanking_len)]
+    else:
+        if len(seqs) != n:
+            raise ValueError("got %i sequences for %i cut indices" % (len(seqs), n))
+        lens = np.fromiter((len(x) for x in seqs), dtype=np.int64, count=n)
+        buf = np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8)
+        # scatter all sequences into one N-filled matrix, offset by the left flank
+        padded = np.full((n, (lens.max() if n else 0) + 2 * flanking_len), N, dtype=np.uint8)
+        rows = np.repeat(np.arange(n), lens)
+        starts = np.cumsum(lens) - lens
+        padded[rows, np.arange(len(buf)) - np.repeat(starts, lens) + flanking_len] = buf
+        cut_indices = np.clip(cut_indices, 0, lens)
+        windows = padded[np.arange(n)[:, None], cut_indices[:, None] + np.arange(2 * flanking_len)]
+    if reverse is not None:
+        reverse = np.asarray(reverse, dtype=bool)
+        windows[reverse] = _COMPLEMENT[windows[reverse][:, ::-1]]
+    windows = np.ascontiguousarray(windows)
+    return windows.view('S%i' % windows.shape[1]).ravel().astype(str).tolist() if n else []
+
+
 def get_recenter_pam(seq, pam_index, strand, out_len=60):
     flanking_len = out_len // 2
     cut_index = pam_index - 3 if strand=='FORWARD' else pam_index + 3
@@ -102,8 +149,11 @@ def reverse_complement(seq):
     reverse_complement = "".join(letter_match[b] for b in reversed(seq))
     return reverse_complement
 
-def main(token):
-    oligo_dict = read_oligo_seq(grna_fp="/mnt/home/zzhang/workspace/src/cripsr-repair/resources/grna-target_list-pub.txt")
-    label_dict = read_outcomes(par_dir="/mnt/home/zzhang/workspace/src/cripsr-repair/data/fa_2018_nbt", cell_line="K562", replicate=None,
+grna_fp = "/mnt/home/zzhang/workspace/src/cripsr-repair/resources/grna-target_list-pub.txt"
+outcomes_dir = "/mnt/home/zzhang/workspace/src/cripsr-repair/data/fa_2018_nbt"
+
+def main(token, grna_fp=grna_fp, par_dir=outcomes_dir):
+    oligo_dict = read_oligo_seq(grna_fp=grna_fp)
+    label_dict = read_outcomes(par_dir=par_dir, cell_line="K562", replicate=None,
             dpi="DPI7", coverage="800x", token=token)
     return oligo_dict, label_dict
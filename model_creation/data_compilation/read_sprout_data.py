@@ -3,11 +3,37 @@ Reading and cleaning the Leenay et. al. bam_df
 '''
 import os
 import statistics 
+from collections import defaultdict
 import numpy as np
 import pandas as pd
+from model_creation.data_compilation.sprout_store import counts_store_path, choose_source, open_store
 
 # Run load_sprout.R first to get 'summary_df.tsv' and 'Leenay_bam_df.csv'
 
+def classify_cigars(cigars):
+    '''Classify SPROUT outcome strings (e.g. '-3:2D', '1:1I', 'SNV:...', 'no variant', 'Other')
+    with the I/D/SNV string counts computed once over the whole column
+
+    Returns a DataFrame of boolean masks, aligned with `cigars`:
+        snv, no_variant, other : the outcome types excluded from indel statistics
+        complex : more than one indel, or an insertion and a deletion together
+        ins, del : exactly one insertion / exactly one deletion and nothing else
+        indel : simple indels, i.e. none of snv, no_variant, other, complex
+    '''
+    cigars = pd.Series(cigars)
+    n_ins = cigars.str.count('I')
+    n_del = cigars.str.count('D')
+    masks = pd.DataFrame({
+        'snv': cigars.str.count('SNV') == 1,
+        'no_variant': cigars == 'no variant',
+        'other': cigars == 'Other',
+        'complex': ((n_ins > 0) & (n_del > 0)) | (n_ins > 1) | (n_del > 1),
+        'ins': (n_ins == 1) & (n_del == 0),
+        'del': (n_del == 1) & (n_ins == 0),
+    }, index=cigars.index)
+    masks['indel'] = ~(masks['snv'] | masks['no_variant'] | masks['other'] | masks['complex'])
+    return masks
+
 ######################################################
 ## Create final_df.csv, add cols with num of indels ##
 ######################################################
@@ -16,79 +42,108 @@ summary_df_path = 'summary_df.txt'
 Leenay_bam_df_path = 'Leenay_bam_df.csv'
 final_df_path = 'final_df.csv'
 
-def create_clean_csv(): # clean up Leenay_bam_df.csv
-    bam_df = pd.read_csv(Leenay_bam_df_path, low_memory=False)
-    bam_df_ = bam_df[bam_df['reference'].notna()] #Get rid of rows where reference is NA
-    bam_df_ = bam_df_.rename(columns={'Unnamed: 0': 'Number'})
-    bam_df_reduce = bam_df_.drop(columns=['Number', 'guide', 'gdlrow', 'reference', 'genename']) 
-    bam_files = []
-    for i in range(len(bam_df_reduce)):
-        row_bam_lst = []
-        for j in range(len(bam_df_reduce.iloc[i].dropna())):
-            row_bam_lst.append(bam_df_reduce.iloc[i].dropna()[j])
-        row_bam_file = ','.join(row_bam_lst)
-        bam_files.append(row_bam_file)
-    bam_df_['BAM file'] = bam_files # col with name of cols without NaN
-    bam_df_ = bam_df_[['Number', 'guide', 'gdlrow', 'reference', 'genename', 'BAM file']]
-    return bam_df
-
-def create_final_df():
-    summary_df = pd.read_csv(summary_df_path, sep="\t")
+def join_nonnull_columns(df, sep=','):
+    # join the non-null values of each row left to right, looping over columns instead of rows
+    joined = pd.Series('', index=df.index, dtype=object)
+    for col in df.columns:
+        values = df[col]
+        prefix = joined.where(joined == '', joined + sep)
+        joined = joined.where(values.isna(), prefix + values.astype(str))
+    return joined
+
+clean_bam_df_path = 'Leenay_bam_df.clean.csv'
+id_cols = ['Number', 'guide', 'gdlrow', 'reference', 'genename']
+
+def read_bam_df_chunks(bam_fp=Leenay_bam_df_path, chunksize=500):
+    # Leenay_bam_df.csv is wide (one column per BAM file) and mostly empty: read it in chunks with
+    # the id columns as strings (kept verbatim) and the BAM columns as categoricals instead of
+    # letting read_csv infer dtypes over the whole file
+    columns = pd.read_csv(bam_fp, nrows=0).columns
+    dtype = {col: str if i == 0 or col in id_cols else 'category' for i, col in enumerate(columns)}
+    return pd.read_csv(bam_fp, dtype=dtype, chunksize=chunksize)
+
+def clean_bam_chunk(chunk):
+    chunk = chunk.rename(columns={chunk.columns[0]: 'Number'})
+    chunk = chunk[chunk['reference'].notna()] #Get rid of rows where reference is NA
+    bam_df_ = chunk[id_cols].copy()
+    bam_df_['BAM file'] = join_nonnull_columns(chunk.drop(columns=id_cols)) # col with name of cols without NaN
+    return bam_df_
+
+def create_clean_csv(bam_fp=Leenay_bam_df_path, chunksize=500): # clean up Leenay_bam_df.csv
+    return pd.concat([clean_bam_chunk(chunk) for chunk in read_bam_df_chunks(bam_fp, chunksize)])
+
+def write_clean_csv(bam_fp=Leenay_bam_df_path, out_fp=clean_bam_df_path, chunksize=500):
+    # stream the cleaned table to disk, so only one chunk of the wide table is in memory at a time
+    header = True
+    for chunk in read_bam_df_chunks(bam_fp, chunksize):
+        clean_bam_chunk(chunk).to_csv(out_fp, mode='w' if header else 'a', header=header, index=False)
+        header = False
+
+def create_final_df(summary_fp=summary_df_path, clean_bam_fp=clean_bam_df_path, out_fp=final_df_path):
+    summary_df = pd.read_csv(summary_fp, sep="\t")
     summary_df = summary_df[['genename', 'refseq', 'chrom', 'ranges', 'strand']]
-    bam_df = create_clean_csv()
+    bam_df = pd.read_csv(clean_bam_fp) # written by write_clean_csv
     bam_df = bam_df[['Number', 'genename', 'guide', 'BAM file']]
     final_df = summary_df.merge(bam_df, on='genename', how='inner')
     final_df = final_df.drop_duplicates()
     final_df = final_df.reset_index(drop=True)
     final_df = final_df[['Number', 'genename', 'refseq', 'chrom', 'ranges', 'strand', 'guide', 'BAM file']]
     final_df.rename(columns = {'BAM file':'bams'}, inplace = True)
-    final_df.to_csv(final_df_path, index=False) #1987 rows, 8 cols
+    final_df.to_csv(out_fp, index=False) #1987 rows, 8 cols
 
 counts_dir = 'data/Sprout/counts'
 
-def add_num_indels():
-    df = pd.read_csv(final_df_path)
+def iter_counts_files(counts_dir=counts_dir, counts_store_fp=counts_store_path):
+    '''Yield (BAM sample names, cigars, per-cigar read counts) for every counts file, from the
+    columnar store if it has been ingested since counts_dir last changed (see sprout_store.py),
+    else from counts_dir'''
+    store = open_store(choose_source(counts_store_fp, counts_dir, 'counts'), counts_dir)
+    if store is not None:
+        for key in store.keys():
+            counts = store.read(key)
+            yield store.samples(key), counts['cigar'], counts['count'].to_numpy(dtype=float)
+    else:
+        for filename in os.listdir(counts_dir):
+            counts = pd.read_csv(os.path.join(counts_dir, filename), index_col=0) #make counts df
+            counts = counts.drop(columns=['seq', 'seqlen', 'proba', 'total'], errors='ignore')
+            yield list(counts.columns), counts.index, counts.sum(axis=1, skipna=False).to_numpy(dtype=float)
+
+def add_num_indels(in_fp=final_df_path, out_fp=final_df_path, counts_dir=counts_dir, counts_store_fp=counts_store_path):
+    '''Add the insertions, deletions and total_out of every counts file to the rows of final_df whose
+    bams list its first BAM file. BAM files are matched exactly against the comma-separated bams of
+    each row (not as substrings, which also matched e.g. 'D1_X-1.bam' in 'XD1_X-1.bam'); counts
+    files whose BAM file is not listed in any row are reported and left out'''
+    df = pd.read_csv(in_fp)
     for col in ['insertions', 'deletions', 'total_out']: df[col] = np.nan
-    bam_lst = df['bams'].tolist()
+    bam_rows = defaultdict(list) # bam file -> rows of df listing it
+    for i, bams in enumerate(df['bams'].tolist()):
+        for bam in bams.split(','): bam_rows[bam].append(i)
+    unmatched = []
     
-    files = os.listdir(counts_dir)
-    for file_num in [x for x in range(len(files)) if x != 822]: # files[822] is counts-YWHAG-01-1699.txt which only has NaNs
-        filename = files[file_num]
-        counts = pd.read_csv(os.path.join(counts_dir, filename), index_col=0) #make counts df
-        counts = counts.drop(columns=['seq', 'seqlen', 'proba', 'total'], errors='ignore')
-
-        complex_indices = []
-        ins_indices = [] #list outcomes with 1 insertion, no deletions
-        del_indices = [] #list outcomes with 1 deletion, no insertions
-        for ind in range(len(counts.index)):
-            if (counts.index[ind].count('I') == 1) and (counts.index[ind].count('D') == 0): ins_indices.append(ind)
-            elif (counts.index[ind].count('D') == 1) and (counts.index[ind].count('I') == 0): del_indices.append(ind)
-
-            if (counts.index[ind].count('I') > 0) and (counts.index[ind].count('D') > 0): complex_indices.append(ind)
-            elif (counts.index[ind].count('I') > 1) or (counts.index[ind].count('D') > 1): complex_indices.append(ind)
-            elif(counts.index[ind] == 'Other'): complex_indices.append(ind)
-
-        complex_rows = counts.iloc[complex_indices].index
-        sim_counts = counts[~counts.index.isin(complex_rows)]
-        total_out = sim_counts.to_numpy().sum() # sum all values in sim_counts = simple outs [include SNVs, no variant, Other]
-
-        ins_counts = counts.iloc[ins_indices]
-        ins = ins_counts.to_numpy().sum() # sum all values in insertions df = # insertions
-        
-        del_counts = counts.iloc[del_indices]
-        dels = del_counts.to_numpy().sum() # sum all values in deletions df = # deletions
-
-        bam = list(counts.columns)[0] # get first bam file/col name 
-        df_index = [i for i, s in enumerate(bam_lst) if bam in s]
-            # find row of df with bams that contains first column name (bam file) from counts df 
+    for bams, cigars, counts in iter_counts_files(counts_dir, counts_store_fp):
+        if np.isnan(counts).all(): continue # e.g. counts-YWHAG-01-1699.txt which only has NaNs
+        outcome = classify_cigars(cigars)
+        complex_rows = (outcome['complex'] | outcome['other']).to_numpy()
+        total_out = counts[~complex_rows].sum() # sum all simple outs [include SNVs, no variant]
+        ins = counts[outcome['ins'].to_numpy()].sum() # outcomes with 1 insertion, no deletions = # insertions
+        dels = counts[outcome['del'].to_numpy()].sum() # outcomes with 1 deletion, no insertions = # deletions
+
+        bam = bams[0] # get first bam file/col name 
+        df_index = bam_rows.get(bam) # rows of df whose bams list the first column name (bam file) from counts df
+        if not df_index:
+            unmatched.append(bam)
+            continue
         
         df.loc[df_index, 'total_out'] = total_out
         df.loc[df_index, 'insertions'] = ins
         df.loc[df_index, 'deletions'] = dels
 
-    df.to_csv(final_df_path, index=False)
+    if unmatched:
+        print("%i counts files have a first BAM file not listed in %s, e.g. %s" % (len(unmatched), in_fp, unmatched[0]))
+    df.to_csv(out_fp, index=False)
 
 # Run:
+# write_clean_csv()
 # create_final_df()
 # add_num_indels()
 
@@ -98,69 +153,56 @@ def add_num_indels():
 
 key_df_path = 'key_df.csv'
 
-def get_refseq_dups(): # different genename, same refseq
-    df = pd.read_csv(final_df_path)
-    refseq_lst = df['refseq'].tolist()
-    refseq_dups_lst = []
-    for i in range(len(df)):
-        refseq = refseq_lst[i]
-        temp_df = df[df['refseq'] == refseq]
-        genename_lst = temp_df['genename'].tolist()
-        if len(list(set(genename_lst))) != 1: refseq_dups_lst.append(list(set(genename_lst)))
-    norepeat_dup_lsts = []
-    for elem in refseq_dups_lst:
-        if elem not in norepeat_dup_lsts:
-            norepeat_dup_lsts.append(elem)
+def get_refseq_dups(final_fp=final_df_path): # different genename, same refseq
+    df = pd.read_csv(final_fp)
+    refseq_genenames = df.groupby('refseq', sort=False)['genename'].unique() # refseq -> genenames
+    norepeat_dup_lsts, seen = [], set()
+    for genename_lst in refseq_genenames:
+        if len(genename_lst) == 1 or frozenset(genename_lst) in seen: continue
+        seen.add(frozenset(genename_lst))
+        norepeat_dup_lsts.append(list(genename_lst))
     # ['CXCR4', 'CXCR4r-01', 'CXCR4r80-01', 'CXCR4r-02', 'CXCR4r80-02'] 5
     # ['LEDGF', 'LEDGFr-01', 'LEDGFr80-01', 'LEDGFr-02', 'LEDGFr80-02'] 5
     # ['CDK9',  'CDK9r-01',  'CDK9r80-01',  'CDK9r-02',  'CDK9r80-02'] 5
     return norepeat_dup_lsts
 
-def create_key_df():
-    df = pd.read_csv(final_df_path)
-    key_df = df[['genename', 'refseq']]
+def create_key_df(final_fp=final_df_path, out_fp=key_df_path):
+    df = pd.read_csv(final_fp)
+    key_df = df[['genename', 'refseq']].copy()
     key_df['refseq'] = key_df['refseq'].str.upper()
     key_df = key_df.drop_duplicates().reset_index(drop=True)
-    key_df['id_ending'] = np.nan
-    norepeat_dup_lsts = get_refseq_dups()
-
-    for i in range(len(key_df)):
-        genename = key_df['genename'][i]
-        temp_df = df[df['genename'] == genename]
-        Numbers_lst = temp_df['Number']
-        Numbers_lst = ['-' + str(x) for x in Numbers_lst]
-        key_df['id_ending'][i] = Numbers_lst
+    norepeat_dup_lsts = get_refseq_dups(final_fp)
+
+    # genename -> ['-' + Number, ...]
+    id_ending = {genename: ['-' + str(x) for x in numbers] for genename, numbers in df.groupby('genename', sort=False)['Number']}
     
+    dropped = set()
     for dup_lst in norepeat_dup_lsts:
         genename = min(dup_lst, key=len) 
-        extra_str_lst = [s.replace(genename, '') for s in dup_lst]
         id_ending_ = []
-        for dup_num in range(len(dup_lst)):
-            dup_name = dup_lst[dup_num]
-            extra_str = extra_str_lst[dup_num]
-            id_end = key_df.loc[key_df['genename'] == dup_name, 'id_ending'].tolist()[0]
-            id_end = [extra_str + end for end in id_end]
-            id_ending_ += id_end
-            if extra_str != '': key_df = key_df[key_df['genename'] != dup_name]
-        
-        key_df.loc[key_df['genename'] == genename, 'id_ending'] = str(id_ending_)
-
-    key_df.to_csv(key_df_path, index=False)
-
-def get_indels_and_totalout(): #based on final_df numbers
-    df = pd.read_csv(key_df_path)
-    final_df = pd.read_csv(final_df_path)
-    final_df = final_df[['genename', 'insertions', 'deletions', 'total_out']]
-
-    for i in range(len(df)):
-        genename = df['genename'][i]
-        final_df_ = final_df[final_df['genename'] == genename]
-        insertions = final_df_['insertions'].to_numpy().sum()
-        deletions = final_df_['deletions'].to_numpy().sum()
-        total_out = final_df_['total_out'].to_numpy().sum()
-        df.loc[i, 'insertions'] = insertions
-        df.loc[i, 'deletions'] = deletions
-        df.loc[i, 'total_out'] = total_out
+        for dup_name in dup_lst:
+            extra_str = dup_name.replace(genename, '')
+            id_ending_ += [extra_str + end for end in id_ending[dup_name]]
+            if extra_str != '': dropped.add(dup_name)
+        id_ending[genename] = str(id_ending_)
+
+    key_df = key_df[~key_df['genename'].isin(dropped)].copy()
+    key_df['id_ending'] = key_df['genename'].map(id_ending)
+    key_df.to_csv(out_fp, index=False)
+
+def get_indels_and_totalout(key_fp=key_df_path, final_fp=final_df_path, out_fp=key_df_path): #based on final_df numbers
+    df = pd.read_csv(key_fp)
+    final_df = pd.read_csv(final_fp)
+    cols = ['insertions', 'deletions', 'total_out']
+    grouped = final_df.groupby('genename')[cols]
+    sums = grouped.sum()
+    sums = sums.mask(grouped.count().lt(grouped.size(), axis=0)) # NaN if any row of the gene is NaN
+    sums = sums.reindex(df['genename'], fill_value=0.)
+    for col in cols: df[col] = sums[col].to_numpy(dtype=float)
    
     df['delfreq'] = df['deletions'] / (df['deletions'] + df['insertions'])
-    df.to_csv(key_df_path, index=False)
+    df.to_csv(out_fp, index=False)
+
+# Run (or see pipeline.py to run the whole chain with dependency tracking):
+# create_key_df()
+# get_indels_and_totalout()
@@ -0,0 +1,132 @@
+"""Row shards of training data on disk, read back as memory-mapped, array-like views
+
+A shard directory holds `x.<i>.npy` (uint8 base codes, or one-hot matrices) and `y.<i>.npy` (one
+column per label, in the order they were compiled) for i = 0, 1, ..., so a dataset never has to fit
+in memory: rows are only read from disk when a batch is gathered.
+"""
+
+import os
+import re
+import pickle
+import numpy as np
+from model_creation.data_compilation.encode import OneHotCodes, codes_to_onehot, is_codes
+
+
+def write_shards(shard_dir, x, y, shard_size=100000):
+    """Write x and labels y in row shards of `shard_size` samples
+
+    Parameters
+    ----------
+    shard_dir : str
+        output directory
+    x : np.array
+        sequences, as uint8 codes or one-hot
+    y : list of np.array, or np.array
+        labels; a list of per-task arrays (as in the compiled pickles) is stacked column-wise
+    shard_size : int
+        number of samples per shard
+    """
+    y = np.column_stack(y) if isinstance(y, list) else np.asarray(y).reshape(len(x), -1)
+    os.makedirs(shard_dir, exist_ok=True)
+    for i, start in enumerate(range(0, len(x), shard_size)):
+        np.save(os.path.join(shard_dir, 'x.%i.npy' % i), np.asarray(x[start:start + shard_size]))
+        np.save(os.path.join(shard_dir, 'y.%i.npy' % i), y[start:start + shard_size])
+
+
+def pickle_to_shards(pickle_fp, shard_dir, shard_size=100000):
+    """Convert a (x, y) pickle written by compile_forecast.dump_pickle to a shard directory"""
+    x, y = pickle.load(open(pickle_fp, "rb"))
+    write_shards(shard_dir, x, y, shard_size=shard_size)
+
+
+class ShardedArray:
+    """Read-only array-like over row shards, concatenated along the first axis
+
+    Supports `len`, `shape` and indexing of the first axis by integers, slices and index arrays, which
+    is all the batch loaders and the AMBER manager need. Base codes are expanded to one-hot per read.
+
+    Parameters
+    ----------
+    shards : list of np.array
+        row shards, typically memory-mapped with `np.load(..., mmap_mode='r')`
+    cols : list of int, or None
+        columns to select from every row read, e.g. the label columns of the tasks being trained
+    """
+
+    def __init__(self, shards, cols=None):
+        if not shards:
+            raise ValueError("no shards given")
+        self.shards = shards
+        self.cols = None if cols is None else np.asarray(cols)
+        self.offsets = np.concatenate([[0], np.cumsum([len(s) for s in shards])])
+        self.onehot = is_codes(shards[0])
+        row_shape = shards[0].shape[1:]
+        if self.cols is not None:
+            row_shape = (len(self.cols),) + row_shape[1:]
+        self.row_shape = row_shape
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def _read(self, idx):
+        out = np.empty((len(idx),) + self.row_shape, dtype=self.shards[0].dtype)
+        shard = np.searchsorted(self.offsets, idx, side='right') - 1
+        for s in np.unique(shard):
+            mask = shard == s
+            rows = self.shards[s][idx[mask] - self.offsets[s]]
+            out[mask] = rows if self.cols is None else rows[:, self.cols]
+        return codes_to_onehot(out) if self.onehot else out
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self._read(np.array([idx % len(self)]))[0]
+        if isinstance(idx, slice):
+            idx = np.arange(*idx.indices(len(self)))
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        return self._read(idx % len(self) if len(idx) else idx.astype(np.int64))
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype)
+
+    @property
+    def shape(self):
+        return (len(self),) + self.row_shape + ((4,) if self.onehot else ())
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32) if self.onehot else self.shards[0].dtype
+
+
+def concat_sequences(x, codes):
+    """Append base-coded sequences to the sequences `x` (`OneHotCodes`, `ShardedArray` or one-hot array) as one
+    ShardedArray, without copying `x`
+    """
+    if isinstance(x, ShardedArray):
+        shards = list(x.shards)
+    elif isinstance(x, OneHotCodes):
+        shards = [x.codes]
+    else:
+        shards = [np.asarray(x)]
+    if not is_codes(shards[0]):
+        codes = codes_to_onehot(codes)
+    return ShardedArray(shards + [codes])
+
+
+def _shard_files(shard_dir, name):
+    pattern = re.compile(r'^%s\.(\d+)\.npy$' % name)
+    files = [(int(m.group(1)), f) for f in os.listdir(shard_dir) for m in [pattern.match(f)] if m]
+    return [os.path.join(shard_dir, f) for _, f in sorted(files)]
+
+
+def open_shards(shard_dir, cols=None, mmap_mode='r'):
+    """Open a shard directory as (x, y) ShardedArrays, with y restricted to the label columns `cols`"""
+    x = ShardedArray([np.load(fp, mmap_mode=mmap_mode) for fp in _shard_files(shard_dir, 'x')])
+    y = ShardedArray([np.load(fp, mmap_mode=mmap_mode) for fp in _shard_files(shard_dir, 'y')], cols=cols)
+    return x, y
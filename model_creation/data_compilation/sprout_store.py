@@ -0,0 +1,196 @@
+'''
+Columnar, gene-indexed store for the SPROUT counts/insertions/master files
+
+Each directory of small CSVs (e.g. data/Sprout/counts/counts-<gene><id_ending>.txt) is ingested once
+into a single HDF5 file with one dataset per column, rows of the same file stored contiguously, and a
+key -> row range index, so any file's records are read back with one slice per column.
+'''
+import os
+import numpy as np
+import pandas as pd
+import h5py
+
+# file name prefix, and the columns kept for each kind of file (None = string column)
+KINDS = {
+    'counts': ('counts-', {'cigar': None, 'count': 'f8', 'total': 'f8', 'seq': None, 'seqlen': 'f8'}),
+    'insertions': ('insertions-', {'Sample': None, 'Allele': None, 'Count': 'f8', 'insseq': None, 'seqlen': 'f8'}),
+    'master': ('master-', {'cigar': None, 'count': 'f8', 'seq': None, 'seqlen': 'f8'}),
+}
+
+counts_store_path = 'data/Sprout/counts.h5'
+insertions_store_path = 'data/Sprout/30insertions.h5'
+master_store_path = 'data/Sprout/master.h5'
+
+
+def read_sprout_file(fp, kind):
+    '''Read one SPROUT csv into the columns kept by the store, plus the names of its BAM
+    sample columns (counts files only, whose 'count' is the read count summed over the BAM columns)'''
+    df = pd.read_csv(fp)
+    samples = []
+    if kind == 'counts':
+        df = df.rename(columns={df.columns[0]: 'cigar'})
+        samples = [c for c in df.columns[1:] if c not in ('seq', 'seqlen', 'proba', 'total')]
+        df['count'] = df[samples].sum(axis=1, skipna=False)
+        if 'total' not in df.columns: df['total'] = df['count']
+    columns = KINDS[kind][1]
+    for col in columns:
+        if col not in df.columns: df[col] = np.nan
+    return df[list(columns)], samples
+
+
+def write_store(store_fp, frames, kind, samples=None):
+    '''Write {key: DataFrame} to one HDF5 file, one dataset per column, with a key -> row range index
+
+    Parameters
+    ----------
+    store_fp : str
+        output HDF5 path; written to a temporary file and moved into place when complete
+    frames : dict
+        key (e.g. 'CXCR4r-01-12' or a genename) -> DataFrame with the columns of KINDS[kind]
+    kind : str
+        one of 'counts', 'insertions', 'master'
+    samples : dict, or None
+        key -> list of BAM sample column names
+    '''
+    columns = KINDS[kind][1]
+    keys = list(frames)
+    lens = np.array([len(frames[k]) for k in keys], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lens)])
+    data = pd.concat([frames[k] for k in keys], ignore_index=True) if keys else pd.DataFrame(columns=list(columns))
+    str_dtype = h5py.string_dtype()
+    tmp_fp = store_fp + '.tmp'
+    with h5py.File(tmp_fp, 'w') as f:
+        f.attrs['kind'] = kind
+        f.create_dataset('keys', data=np.array(keys, dtype=object), dtype=str_dtype)
+        f.create_dataset('offsets', data=offsets)
+        sample_strs = [','.join(samples.get(k, [])) if samples else '' for k in keys]
+        f.create_dataset('samples', data=np.array(sample_strs, dtype=object), dtype=str_dtype)
+        grp = f.create_group('columns')
+        for col, dtype in columns.items():
+            if dtype is None:
+                values = data[col].fillna('').astype(str).to_numpy(dtype=object)
+                grp.create_dataset(col, data=values, dtype=str_dtype, compression='gzip', chunks=True)
+            else:
+                values = pd.to_numeric(data[col], errors='coerce').to_numpy(dtype=dtype)
+                grp.create_dataset(col, data=values, compression='gzip', chunks=True)
+    os.replace(tmp_fp, store_fp)
+
+
+def ingest_sprout_dir(src_dir, store_fp, kind):
+    '''Consolidate every '<prefix><key>.txt' file of src_dir into one store; the key is the file name
+    without prefix and extension, i.e. genename + id_ending for counts/insertions, genename for master'''
+    prefix = KINDS[kind][0]
+    frames, samples = {}, {}
+    for filename in sorted(os.listdir(src_dir)):
+        if not (filename.startswith(prefix) and filename.endswith('.txt')): continue
+        key = filename[len(prefix):-len('.txt')]
+        frames[key], samples[key] = read_sprout_file(os.path.join(src_dir, filename), kind)
+    write_store(store_fp, frames, kind, samples)
+    return len(frames)
+
+
+def _read_str(dset, sel=slice(None)):
+    if hasattr(dset, 'asstr'): # h5py >= 3 returns bytes otherwise
+        return dset.asstr()[sel]
+    return dset[sel]
+
+
+class SproutStore:
+    '''Read-only access to a store written by `write_store`
+
+    Parameters
+    ----------
+    store_fp : str
+        HDF5 path
+    '''
+    def __init__(self, store_fp):
+        self.store_fp = store_fp
+        self.f = h5py.File(store_fp, 'r')
+        self.kind = self.f.attrs['kind']
+        if isinstance(self.kind, bytes): self.kind = self.kind.decode()
+        self.columns = KINDS[self.kind][1]
+        self.offsets = self.f['offsets'][:]
+        self.index = {k: i for i, k in enumerate(_read_str(self.f['keys']))}
+        self._samples = None
+
+    def keys(self):
+        return list(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def samples(self, key):
+        if self._samples is None: self._samples = _read_str(self.f['samples'])
+        samples = self._samples[self.index[key]]
+        return samples.split(',') if samples else []
+
+    def read(self, key):
+        '''Records of one file as a DataFrame with the file's own column names; empty strings and
+        numeric columns are restored to NaN / integers as in the csv'''
+        i = self.index[key]
+        sel = slice(self.offsets[i], self.offsets[i + 1])
+        grp = self.f['columns']
+        df = {}
+        for col, dtype in self.columns.items():
+            if dtype is None:
+                values = pd.Series(_read_str(grp[col], sel), dtype=object)
+                df[col] = values.where(values != '', np.nan)
+            else:
+                values = grp[col][sel]
+                if not np.isnan(values).any() and np.array_equal(values, np.round(values)):
+                    values = values.astype(np.int64)
+                df[col] = values
+        return pd.DataFrame(df, columns=list(self.columns))
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def store_is_stale(store_fp, src_dir):
+    '''True if src_dir, or any file in it, was modified after store_fp was written, i.e. the store
+    no longer matches the csv files and has to be re-ingested'''
+    if src_dir is None or not os.path.isdir(src_dir): return False # the store is the only source
+    store_mtime = os.path.getmtime(store_fp)
+    if os.path.getmtime(src_dir) > store_mtime: return True # files added or removed
+    return any(entry.stat().st_mtime > store_mtime for entry in os.scandir(src_dir))
+
+
+def choose_source(store_fp, src_dir, kind):
+    '''store_fp if it exists and is up to date with src_dir, else None to read the csv files of
+    src_dir; prints which source is read'''
+    if store_fp is None or not os.path.exists(store_fp):
+        print("reading %s from %s" % (kind, src_dir))
+        return None
+    if store_is_stale(store_fp, src_dir):
+        print("reading %s from %s: %s is older, re-run ingest_sprout_dir to update it" % (kind, src_dir, store_fp))
+        return None
+    print("reading %s from %s" % (kind, store_fp))
+    return store_fp
+
+
+_open_stores = {}
+
+def open_store(store_fp, src_dir=None):
+    '''Open a store once per process (h5py handles must not be shared across forked workers);
+    returns None if store_fp does not exist, or is older than src_dir (see store_is_stale), so
+    callers fall back to the csv directories'''
+    if store_fp is None or not os.path.exists(store_fp): return None
+    key = (os.getpid(), os.path.abspath(store_fp))
+    if key not in _open_stores:
+        _open_stores[key] = None if store_is_stale(store_fp, src_dir) else SproutStore(store_fp)
+    return _open_stores[key]
+
+
+# Run (once, after the counts and 30insertions directories are populated, and again whenever they
+# are regenerated; stores older than their directory are ignored):
+# ingest_sprout_dir('data/Sprout/counts', counts_store_path, 'counts')
+# ingest_sprout_dir('data/Sprout/30insertions', insertions_store_path, 'insertions')
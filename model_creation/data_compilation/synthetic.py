@@ -0,0 +1,272 @@
+'''
+Synthetic FORECasT and SPROUT inputs, for exercising and benchmarking the compile scripts without the
+real datasets
+
+Files are written in the layouts the readers expect:
+    FORECasT: a gRNA target table (ID, TargetSequence, PAM Index, Strand) and
+        <par_dir>/<ST_June_2017_K562_800x_<replicate>_DPI7>/<batch>/*_processedindels.txt files with
+        '@@@<oligo id>' headers followed by 'token<TAB>count<TAB>sequence' outcome rows
+    SPROUT: summary_df.txt, the wide Leenay_bam_df.csv (one column per BAM slot, mostly empty), and
+        data/Sprout/counts/counts-<genename>-<Number>.txt and data/Sprout/30insertions/insertions-*.txt
+
+`scale` multiplies the number of oligos / guides relative to the real datasets, `depth` the number of
+reads per oligo / BAM file (deeper sequencing also surfaces more distinct, rarer outcomes).
+
+Example:
+    python -m model_creation.data_compilation.synthetic all --out /tmp/synth --scale 10
+    python -m model_creation.data_compilation.pipeline all --workdir /tmp/synth \\
+        --grna-fp /tmp/synth/grna-target_list.txt --forecast-dir /tmp/synth/fa_2018_nbt
+'''
+import os
+import argparse
+import numpy as np
+
+# approximate size of the real datasets at scale=1
+FORECAST_N_OLIGOS = 41630 # gRNA-target pairs of Allen et al.
+FORECAST_READS_PER_OLIGO = 800 # 800x coverage, per replicate
+SPROUT_N_GUIDES = 1987 # rows of final_df.csv
+SPROUT_READS_PER_BAM = 10000
+MEAN_OUTCOMES = 40 # distinct outcomes per oligo / BAM before the count filters
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def random_seqs(rng, n, length):
+    '''n random ACGT sequences of the given length'''
+    buf = BASES[rng.integers(0, 4, size=(n, length))]
+    return buf.view('S%i' % length).ravel().astype(str).tolist() if n else []
+
+
+def sample_indels(rng, n_reads, depth=1.):
+    '''Sample the distinct indel outcomes of one target and their read counts
+
+    Returns
+    -------
+    is_ins : np.array of bool
+    size : np.array of int
+        inserted / deleted length
+    left : np.array of int
+        deleted bases left of the cut site (0 for insertions)
+    counts : np.array of int
+        read count per outcome, all > 0
+    '''
+    n = 1 + rng.poisson(MEAN_OUTCOMES * np.sqrt(depth))
+    is_ins = rng.random(n) < rng.beta(2, 5)
+    size = np.where(is_ins, np.minimum(rng.geometric(0.7, n), 20), np.minimum(rng.geometric(0.25, n), 30))
+    left = np.where(is_ins, 0, rng.integers(0, size + 1))
+    # merge identical outcomes, then spread the reads with a skewed (few dominant outcomes) profile
+    _, first = np.unique(is_ins * 10000 + size * 100 + left, return_index=True)
+    is_ins, size, left = is_ins[first], size[first], left[first]
+    counts = rng.multinomial(n_reads, rng.dirichlet(np.full(len(first), 0.3)))
+    keep = counts > 0
+    return is_ins[keep], size[keep], left[keep], counts[keep]
+
+
+def apply_indel(seq, cut, is_ins, size, left, ins_seq=''):
+    if is_ins: return seq[:cut] + ins_seq[:size] + seq[cut:]
+    return seq[:cut - left] + seq[cut - left + size:]
+
+
+############
+# FORECasT #
+############
+
+def write_forecast(out_dir, scale=1., depth=1., seed=0, replicates=('LV7A', 'LV7B'), oligos_per_file=1000):
+    '''Write a synthetic FORECasT gRNA table and processedindels tree under out_dir
+
+    Parameters
+    ----------
+    out_dir : str
+        output directory
+    scale : float
+        number of oligos, as a multiple of FORECAST_N_OLIGOS
+    depth : float
+        reads per oligo and replicate, as a multiple of FORECAST_READS_PER_OLIGO
+    seed : int
+        seed for the random generator
+    replicates : tuple of str
+        one '<...>_K562_800x_<replicate>_DPI7' directory is written per replicate
+    oligos_per_file : int
+        oligos per processedindels file
+
+    Returns
+    -------
+    dict
+        grna_fp and par_dir to pass to compile_forecast.main, and the number of oligos and outcome rows
+    '''
+    rng = np.random.default_rng(seed)
+    n_oligos = max(1, int(round(FORECAST_N_OLIGOS * scale)))
+    n_reads = max(1, int(round(FORECAST_READS_PER_OLIGO * depth)))
+    os.makedirs(out_dir, exist_ok=True)
+
+    # gRNA targets: 79bp with an NGG (forward) or CCN (reverse) PAM around the middle
+    ids = ['Oligo_%i' % i for i in range(n_oligos)]
+    targets = random_seqs(rng, n_oligos, 79)
+    forward = rng.random(n_oligos) < 0.5
+    pam_index = np.where(forward, rng.integers(40, 47, n_oligos), rng.integers(33, 40, n_oligos))
+    cut_index = np.where(forward, pam_index - 3, pam_index + 3)
+    for i in range(n_oligos):
+        p, t = pam_index[i], targets[i]
+        targets[i] = t[:p + 1] + 'GG' + t[p + 3:] if forward[i] else t[:p - 3] + 'CC' + t[p - 1:]
+    grna_fp = os.path.join(out_dir, 'grna-target_list.txt')
+    with open(grna_fp, 'w') as f:
+        f.write('ID\tTargetSequence\tPAM Index\tStrand\n')
+        for i in range(n_oligos):
+            f.write('%s\t%s\t%i\t%s\n' % (ids[i], targets[i], pam_index[i], 'FORWARD' if forward[i] else 'REVERSE'))
+
+    par_dir = os.path.join(out_dir, 'fa_2018_nbt')
+    n_rows = 0
+    for replicate in replicates:
+        for start in range(0, n_oligos, oligos_per_file):
+            batch_dir = os.path.join(par_dir, 'ST_June_2017_K562_800x_%s_DPI7' % replicate, 'batch_%i' % (start // oligos_per_file))
+            os.makedirs(batch_dir, exist_ok=True)
+            lines = []
+            for i in range(start, min(start + oligos_per_file, n_oligos)):
+                lines.append('@@@' + ids[i])
+                is_ins, size, left, counts = sample_indels(rng, n_reads, depth)
+                ins_seqs = random_seqs(rng, len(counts), 20)
+                for j in range(len(counts)):
+                    if is_ins[j]: token = 'I%i_L-1C0R0' % size[j]
+                    else: token = 'D%i_L%iC0R%i' % (size[j], -left[j] - 1, size[j] - left[j])
+                    seq = apply_indel(targets[i], cut_index[i], is_ins[j], size[j], left[j], ins_seqs[j])
+                    lines.append('%s\t%i\t%s' % (token, counts[j], seq))
+                n_rows += len(counts)
+            with open(os.path.join(batch_dir, 'Oligos_%i_processedindels.txt' % start), 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+    return {'grna_fp': grna_fp, 'par_dir': par_dir, 'n_oligos': n_oligos, 'n_rows': n_rows}
+
+
+##########
+# SPROUT #
+##########
+
+def sprout_outcomes(rng, window, n_reads, depth=1.):
+    '''cigar, 60bp-window sequence and read count of every outcome of one BAM file, including the
+    non-indel outcomes (no variant, SNVs, Other, complex) the compile scripts filter out'''
+    is_ins, size, left, counts = sample_indels(rng, n_reads, depth)
+    ins_seqs = random_seqs(rng, len(counts), 20)
+    cigars, seqs = [], []
+    for j in range(len(counts)):
+        if is_ins[j]: cigars.append('1:%iI' % size[j])
+        else: cigars.append('%i:%iD' % (-left[j], size[j]))
+        seqs.append(apply_indel(window, 30, is_ins[j], size[j], left[j], ins_seqs[j]))
+    snv_pos = int(rng.integers(0, 60))
+    snv = window[:snv_pos] + 'ACGT'[(('ACGT'.index(window[snv_pos]) + 1) % 4)] + window[snv_pos + 1:]
+    cigars += ['no variant', 'SNV:%i%s' % (snv_pos - 30, snv[snv_pos]), 'Other', '-2:1D,3:1I']
+    seqs += [window, snv, window, apply_indel(apply_indel(window, 33, True, 1, 0, 'A'), 30, False, 1, 2)]
+    other = rng.multinomial(n_reads // 2, [0.8, 0.1, 0.05, 0.05])
+    return cigars, seqs, np.concatenate([counts, other])
+
+
+def write_sprout(out_dir, scale=1., depth=1., seed=0, bams_per_guide=(2, 4), n_bam_columns=None,
+        dup_frac=0.01, na_reference_frac=0.05):
+    '''Write synthetic SPROUT inputs under out_dir: summary_df.txt, Leenay_bam_df.csv and the
+    data/Sprout/counts and data/Sprout/30insertions directories
+
+    Parameters
+    ----------
+    out_dir : str
+        output directory, i.e. the workdir of the SPROUT pipeline
+    scale : float
+        number of guides, as a multiple of SPROUT_N_GUIDES
+    depth : float
+        reads per BAM file, as a multiple of SPROUT_READS_PER_BAM
+    seed : int
+        seed for the random generator
+    bams_per_guide : tuple of int
+        inclusive range of the number of BAM files (donors/replicates) per guide
+    n_bam_columns : int, or None
+        width of Leenay_bam_df.csv; one column per BAM file if None
+    dup_frac : float
+        fraction of genes with 'r-01' / 'r80-01' variants sharing their refseq (as CXCR4, LEDGF, CDK9)
+    na_reference_frac : float
+        fraction of Leenay_bam_df rows without a reference, which create_clean_csv drops
+
+    Returns
+    -------
+    dict
+        number of guides, BAM files and counts rows
+    '''
+    rng = np.random.default_rng(seed)
+    n_guides = max(1, int(round(SPROUT_N_GUIDES * scale)))
+    n_reads = max(1, int(round(SPROUT_READS_PER_BAM * depth)))
+    counts_dir = os.path.join(out_dir, 'data', 'Sprout', 'counts')
+    insertions_dir = os.path.join(out_dir, 'data', 'Sprout', '30insertions')
+    os.makedirs(counts_dir, exist_ok=True)
+    os.makedirs(insertions_dir, exist_ok=True)
+
+    # genes, some with refseq duplicates under variant names, and guides (rows of Leenay_bam_df)
+    genenames, refseqs = [], []
+    for i, refseq in enumerate(random_seqs(rng, n_guides, 60)):
+        genename = 'SYN%05i' % i
+        genenames.append(genename)
+        refseqs.append(refseq)
+        if rng.random() < dup_frac:
+            genenames += [genename + 'r-01', genename + 'r80-01']
+            refseqs += [refseq, refseq]
+    n_rows = len(genenames)
+    n_bams = rng.integers(bams_per_guide[0], bams_per_guide[1] + 1, n_rows)
+    bams = [['D%i_%s-%i.bam' % (k, genenames[i], i + 1) for k in range(n_bams[i])] for i in range(n_rows)]
+    has_reference = rng.random(n_rows) >= na_reference_frac
+    n_columns = n_bam_columns or int(n_bams.sum())
+
+    with open(os.path.join(out_dir, 'Leenay_bam_df.csv'), 'w') as f:
+        f.write(',guide,gdlrow,reference,genename,' + ','.join('bam_%i' % c for c in range(n_columns)) + '\n')
+        for i in range(n_rows):
+            cells = [''] * n_columns
+            for c, bam in zip(np.sort(rng.choice(n_columns, n_bams[i], replace=False)), bams[i]):
+                cells[c] = bam
+            f.write('%i,g%i,%i,%s,%s,%s\n' % (i + 1, i + 1, rng.integers(1, 100),
+                refseqs[i] if has_reference[i] else 'NA', genenames[i], ','.join(cells)))
+
+    chroms = rng.integers(1, 23, n_rows)
+    starts = rng.integers(1000000, 100000000, n_rows)
+    n_counts_rows = 0
+    with open(os.path.join(out_dir, 'summary_df.txt'), 'w') as summary:
+        summary.write('index\tgenename\trefseq\tchrom\tranges\tstrand\tbams\n')
+        for i in np.flatnonzero(has_reference):
+            key = '%s-%i' % (genenames[i], i + 1)
+            summary.write('%i\t%s\t%s\tchr%i\t%i-%i\t%s\t%s\n' % (i + 1, genenames[i], refseqs[i], chroms[i],
+                starts[i], starts[i] + 22, '+-'[rng.integers(0, 2)], ','.join(bams[i])))
+
+            # counts: one column of reads per BAM file; outcomes averaging <= 20 reads are dropped,
+            # as in load_sprout.R
+            cigars, seqs, counts = sprout_outcomes(rng, refseqs[i], n_reads * n_bams[i], depth)
+            per_bam = np.stack([rng.binomial(counts, p) for p in rng.dirichlet(np.full(n_bams[i], 5.))], axis=1)
+            keep = per_bam.mean(axis=1) > 20
+            total = per_bam[keep].sum(axis=1)
+            lines = [',' + ','.join(bams[i]) + ',seq,seqlen,proba,total']
+            for j, row in zip(np.flatnonzero(keep), range(len(total))):
+                cigar = '"%s"' % cigars[j] if ',' in cigars[j] else cigars[j] # complex outcomes, e.g. -2:1D,3:1I
+                lines.append('%s,%s,%s,%i,%.6g,%i' % (cigar, ','.join(map(str, per_bam[j])), seqs[j],
+                    len(seqs[j]), total[row] / max(total.sum(), 1), total[row]))
+            with open(os.path.join(counts_dir, 'counts-%s.txt' % key), 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            n_counts_rows += len(total)
+
+            # 30insertions: longer insertions (up to 30bp) per BAM file, for some of the guides
+            if rng.random() < 0.5: continue
+            lines = ['Sample,Allele,Count,insseq,seqlen']
+            for bam in bams[i]:
+                for size in np.unique(np.minimum(rng.geometric(0.3, 1 + rng.poisson(3)), 30)):
+                    insseq = random_seqs(rng, 1, int(size))[0]
+                    lines.append('%s,1:%iI,%i,%s,%i' % (bam, size, rng.integers(1, 50), insseq, 60 + size))
+            with open(os.path.join(insertions_dir, 'insertions-%s.txt' % key), 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+    return {'n_guides': n_rows, 'n_bams': int(n_bams.sum()), 'n_counts_rows': n_counts_rows}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic FORECasT/SPROUT inputs for scale testing')
+    parser.add_argument("target", choices=['sprout', 'forecast', 'all'], help="which dataset(s) to generate")
+    parser.add_argument("--out", type=str, required=True, help="output directory")
+    parser.add_argument("--scale", type=float, default=1., help="number of oligos/guides, relative to the real data")
+    parser.add_argument("--depth", type=float, default=None, help="reads per oligo/BAM file, relative to the real data; defaults to --scale")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    depth = args.scale if args.depth is None else args.depth
+    if args.target in ('forecast', 'all'):
+        print(write_forecast(args.out, scale=args.scale, depth=depth, seed=args.seed))
+    if args.target in ('sprout', 'all'):
+        print(write_sprout(args.out, scale=args.scale, depth=depth, seed=args.seed))
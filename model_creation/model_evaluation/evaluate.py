@@ -1,11 +1,18 @@
 
 import os
+import glob
 import pickle
+import argparse
 import numpy as np
 import pandas as pd
+from tensorflow.python.keras import backend as K
 from tensorflow.python.keras.models import load_model
-from sklearn.metrics import roc_auc_score
 import scipy.stats as ss
+from model_creation.data_compilation.encode import OneHotCodes, is_codes
+from model_creation.model_search.data_loader import predict_onehot
+from model_creation.model_evaluation.metrics import auc, pearson
+from model_creation.model_evaluation.bootstrap import confidence_intervals
+from model_creation.model_search.autotune import apply_profile
 
 TASK_IDENTIFIER = {'delfreq':0, 'prob_1bpins': 1, 'prob_1bpdel': 2, 'onemod3_freq': 3, 'twomod3_freq': 4, 'frameshift_freq': 5}
 statlst = ['delfreq','prob_1bpins','prob_1bpdel','onemod3_freq','twomod3_freq','frameshift_freq']
@@ -24,14 +31,16 @@ def one_hot_encode(seq, base_map): #takes upper case seq
     return final_seq
 
 #Function only works with sequences of the same length
+#Encodes all sequences in one table lookup; N -> [0.25, 0.25, 0.25, 0.25] as in one_hot_encode
 def one_hot_encode_lst(seq_col, len_, base_map, save):
-    number = 1
-    stack = one_hot_encode(seq_col[0], base_map)
-    for i in range(1, len(seq_col)):
-        seq = one_hot_encode(seq_col[i], base_map)
-        stack = np.concatenate([stack, seq])
-        number += 1
-    stack = np.reshape(stack, (number, len_, 4))
+    lookup = np.full(256, 5, dtype=np.uint8)
+    lookup[np.frombuffer(base_map.encode(), dtype=np.uint8)] = np.arange(4)
+    lookup[ord('N')] = 4
+    idx = lookup[np.frombuffer(''.join(seq_col).encode(), dtype=np.uint8)]
+    if (idx == 5).any():
+        raise KeyError("sequences contain characters other than %s and N" % base_map)
+    table = np.vstack([np.eye(4), np.full(4, 0.25)])
+    stack = table[idx].reshape((len(seq_col), len_, 4))
     if save:
         output_path = "data/npy/encoded_%ibp_%s" % (len_, base_map)
         np.save(output_path, stack, allow_pickle=True)
@@ -50,22 +59,42 @@ def get_binary_cols(df, statlst=statlst):
 def get_croton_obs(dataset):
     if dataset == 'forecast':
         x_test, y_test = pickle.load(open('./data/data/Forecast/test_.pkl', 'rb'))
+        if is_codes(x_test): x_test = OneHotCodes(x_test) # expanded batch by batch when predicting
         obs_df = pd.DataFrame({'delfreq':y_test[0], 'prob_1bpins':y_test[1], 'prob_1bpdel':y_test[2],
             'onemod3_freq':y_test[6], 'twomod3_freq':y_test[7], 'frameshift_freq':y_test[8]})
     
     if dataset == 'sprout':
         obs_df = pd.read_csv('key_df.csv')
         obs_df['refseq'] = obs_df['refseq'].str.upper()
-        x_test = one_hot_encode_lst(obs_df['refseq'], 60, 'ACGT', False)
+        # reuse the encoded sequences saved by a previous run, unless key_df.csv changed since
+        encoded_fp = "data/npy/encoded_60bp_ACGT.npy"
+        if os.path.isfile(encoded_fp) and os.path.getmtime(encoded_fp) >= os.path.getmtime('key_df.csv'):
+            x_test = np.load(encoded_fp)
+        else:
+            os.makedirs(os.path.dirname(encoded_fp), exist_ok=True)
+            x_test = one_hot_encode_lst(obs_df['refseq'], 60, 'ACGT', True)
 
     obs_df = get_binary_cols(obs_df)
     
     return x_test, obs_df
 
+_models = {}
+
+def get_model(croton_path):
+    # loaded once per process, for the per-stat get_croton_pred calls
+    if croton_path not in _models:
+        _models[croton_path] = load_model(croton_path)
+    return _models[croton_path]
+
+def predict_all(model, x_test, batch_size=None):
+    # all tasks in one pass, columns in statlst order
+    pred = predict_onehot(model, x_test, batch_size=batch_size or 4096)
+    return pred[:, [TASK_IDENTIFIER[stat] for stat in statlst]]
+
 def get_croton_pred(stat, x_test, croton_path='CROTON.h5'):
     pred_inx = TASK_IDENTIFIER[stat] 
-    model = load_model(croton_path)
-    pred = model.predict(x_test)
+    model = get_model(croton_path)
+    pred = predict_onehot(model, x_test)
     pred = pred[:,pred_inx]
     pred_median = np.median(pred)
     pred_binary = np.where(pred>=pred_median, 1.0, pred)
@@ -73,28 +102,56 @@ def get_croton_pred(stat, x_test, croton_path='CROTON.h5'):
 
     return pred, pred_binary
 
-def get_aucroc_stats(dataset): # *****ONLY CROTON SUPPORTS dataset = 'forecast'*****
+def get_model_stats(obs_df, pred, label, n_boot=1000, processes=1):
+    # aucroc/pearson/kendall statistics of all stats from one prediction matrix, with 95% bootstrap CIs of the
+    # aucroc and pearson (none if n_boot is 0)
+    obs = obs_df[statlst].values
+    obs_binary = obs_df[[stat+'_binary' for stat in statlst]].values
+    stats_df = pd.DataFrame({'df_label': [label] * len(statlst), 'stat': list(statlst),
+                             'auc': list(auc(obs_binary, pred)), 'pearson': list(np.round(pearson(obs, pred), 6)),
+                             'kendall': [round(ss.kendalltau(obs[:, i], pred[:, i])[0], 6)
+                                         for i in range(len(statlst))]})
+    if n_boot:
+        cis = confidence_intervals(obs, pred, metrics=('auc', 'pearson'), y_binary=obs_binary, n_boot=n_boot,
+                                   processes=processes)
+        for metric, (lower, upper) in cis.items():
+            stats_df[metric + '_ci_low'] = np.round(lower, 6)
+            stats_df[metric + '_ci_high'] = np.round(upper, 6)
+    return stats_df
+
+def get_label(croton_path, dataset):
+    # 'croton_<dataset>' for CROTON.h5, '<run dir>_<dataset>' for a run's bestmodel.h5
+    name = os.path.splitext(os.path.basename(croton_path))[0]
+    if name == 'bestmodel':
+        name = os.path.basename(os.path.dirname(os.path.abspath(croton_path)))
+    return '%s_%s' % ('croton' if name == 'CROTON' else name, dataset)
+
+def evaluate_models(dataset, model_paths, labels=None, n_boot=1000, processes=1):
+    """Statistics of every model in `model_paths` on the same test data, which is loaded and encoded once; each
+    model is loaded once and predicts all stats in one pass
+    """
     x_test, obs_df = get_croton_obs(dataset)
-    
-    modelpred_stats = {'df_label':[], 'stat':[], 'auc':[], 'pearson':[], 'kendall':[]}
-    for i in range(len(statlst)):
-        modelpred_stats['df_label'].append('croton_' + dataset)
-        stat = statlst[i]
-        obs, obs_binary = obs_df[stat], obs_df[stat+'_binary']
-        
-        # Get pred
-        pred, pred_binary = get_croton_pred(stat, x_test)
-
-        # Get aucroc statistics
-        auc = roc_auc_score(obs_binary, pred)
-        modelpred_stats['auc'].append(auc)
-
-        # Get corr statistics
-        modelpred_stats['pearson'].append(round(ss.pearsonr(obs, pred)[0], 6))
-        modelpred_stats['kendall'].append(round(ss.kendalltau(obs, pred)[0], 6))
+    # with the tuned threads/batch size, if any
+    config = apply_profile('inference')
+    batch_size = config['batch_size'] if config is not None else None
+    labels = labels or [get_label(fp, dataset) for fp in model_paths]
+    dfs = []
+    for fp, label in zip(model_paths, labels):
+        pred = predict_all(load_model(fp), x_test, batch_size=batch_size)
+        dfs.append(get_model_stats(obs_df, pred, label, n_boot=n_boot, processes=processes))
+        K.clear_session() # drop the model's graph before loading the next one
+        apply_profile('inference') # the TF 1.x thread limits live in the session just cleared
+    return pd.concat(dfs, ignore_index=True)
+
+def random_collection_models(target_dir):
+    # best models of the random architectures in <target_dir>/random_collections.denseResConn/
+    return sorted(glob.glob(os.path.join(target_dir, 'random_collections.denseResConn', '*', 'bestmodel.h5')))
+
+# *****ONLY CROTON SUPPORTS dataset = 'forecast'*****
+def get_aucroc_stats(dataset, model_paths=('CROTON.h5',), labels=None, n_boot=1000, processes=1):
+    modelpred_stats_df = evaluate_models(dataset, model_paths, labels=labels, n_boot=n_boot, processes=processes)
     
     # Put model prediction statistics into a dataframe
-    modelpred_stats_df = pd.DataFrame.from_dict(modelpred_stats)
     try: 
         stats_df = pd.read_csv('modelpred_stats.csv') 
         modelpred_stats_df = pd.concat([stats_df, modelpred_stats_df], ignore_index=True) 
@@ -102,3 +159,17 @@ def get_aucroc_stats(dataset): # *****ONLY CROTON SUPPORTS dataset = 'forecast'*
         pass
     modelpred_stats_df.to_csv('modelpred_stats.csv', index=False)
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Evaluate CROTON and other models on a test set')
+    parser.add_argument("--dataset", type=str, choices=['forecast', 'sprout'], default='forecast', help="test set")
+    parser.add_argument("--models", type=str, nargs='+', default=None, help="models to evaluate; default CROTON.h5")
+    parser.add_argument("--random-dir", type=str, default=None,
+                        help="also evaluate the random architectures collected in this search dir")
+    parser.add_argument("--n-boot", type=int, default=1000, help="bootstrap resamples for 95%% CIs; 0 for none")
+    parser.add_argument("--processes", type=int, default=1, help="processes for the bootstrap")
+    args = parser.parse_args()
+
+    model_paths = args.models or ['CROTON.h5']
+    if args.random_dir is not None:
+        model_paths += random_collection_models(args.random_dir)
+    get_aucroc_stats(args.dataset, model_paths=model_paths, n_boot=args.n_boot, processes=args.processes)
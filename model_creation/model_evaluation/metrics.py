@@ -0,0 +1,164 @@
+"""Vectorized per-task metrics for multi-task predictions
+
+All functions take (n_samples, n_tasks) arrays of observations and predictions (1-d arrays are treated as a single
+task) and return one value per task, computed for all columns at once with NumPy instead of one scipy/sklearn call
+per task. Ties are ranked by their average rank, as in `scipy.stats.rankdata`, so `spearman` and `auc` agree with
+`scipy.stats.spearmanr` and `sklearn.metrics.roc_auc_score`.
+
+Run as a script to benchmark against the scipy path:
+    python -m model_creation.model_evaluation.metrics --samples 100000 --tasks 6
+"""
+
+import time
+import argparse
+import numpy as np
+
+
+def _as_columns(a):
+    a = np.asarray(a, dtype=np.float64)
+    return a.reshape(len(a), -1)
+
+
+def rankdata(a):
+    """Column-wise ranks starting at 1, with ties given their average rank"""
+    a = np.ascontiguousarray(_as_columns(a).T)  # sort along contiguous rows
+    k, n = a.shape
+    order = np.argsort(a, axis=1)
+    sorted_a = np.take_along_axis(a, order, axis=1)
+    # number runs of equal values, with ids unique across columns
+    new_run = np.ones((k, n), dtype=bool)
+    new_run[:, 1:] = sorted_a[:, 1:] != sorted_a[:, :-1]
+    run_id = np.cumsum(new_run.ravel()) - 1
+    run_start = np.flatnonzero(new_run.ravel()) % n
+    run_end = np.append(run_start[1:], 0)
+    run_end[run_end == 0] = n  # runs ending a column
+    run_rank = (run_start + run_end + 1) / 2.
+    ranks = np.empty((k, n))
+    ranks[np.arange(k)[:, None], order] = run_rank[run_id].reshape(k, n)
+    return ranks.T
+
+
+def n_unique(a):
+    """Column-wise number of distinct values"""
+    sorted_a = np.sort(_as_columns(a).T, axis=1)
+    return 1 + np.count_nonzero(sorted_a[:, 1:] != sorted_a[:, :-1], axis=1)
+
+
+def pearson(y_true, y_score):
+    """Column-wise Pearson correlation; nan for constant columns"""
+    y_true, y_score = _as_columns(y_true), _as_columns(y_score)
+    y_true = y_true - y_true.mean(axis=0)
+    y_score = y_score - y_score.mean(axis=0)
+    denom = np.sqrt((y_true ** 2).sum(axis=0) * (y_score ** 2).sum(axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (y_true * y_score).sum(axis=0) / denom
+    return np.clip(r, -1., 1.)
+
+
+def spearman(y_true, y_score):
+    """Column-wise Spearman correlation; nan for constant columns"""
+    return pearson(rankdata(y_true), rankdata(y_score))
+
+
+def auc(y_binary, y_score):
+    """Column-wise area under the ROC curve of scores for binary (0/1) labels, by the Mann-Whitney U statistic;
+    nan for columns with a single class
+    """
+    y_binary = _as_columns(y_binary) > 0
+    n_pos = y_binary.sum(axis=0)
+    n_neg = len(y_binary) - n_pos
+    rank_sum = np.where(y_binary, rankdata(y_score), 0.).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (rank_sum - n_pos * (n_pos + 1) / 2.) / (n_pos * n_neg)
+
+
+def multitask_reward(y_true, y_score, method='spearman', min_unique=10):
+    """Search reward: 1 + the mean per-task correlation of the predictions
+
+    Tasks with fewer than `min_unique` distinct predictions (e.g. collapsed to a constant) score a correlation of 0,
+    as in `amber_cnn_sumstats.robust_spearmanr`; the offset of 1 keeps rewards positive.
+
+    Parameters
+    ----------
+    y_true : np.array
+        observed values, (n_samples, n_tasks)
+    y_score : np.array
+        predicted values, (n_samples, n_tasks)
+    method : str
+        'spearman' or 'pearson'
+    min_unique : int
+        minimum number of distinct predictions per task
+
+    Returns
+    -------
+    float
+    """
+    corr = {'spearman': spearman, 'pearson': pearson}[method](y_true, y_score)
+    corr = np.where((n_unique(y_score) < min_unique) | np.isnan(corr), 0., corr)
+    return 1. + corr.mean()
+
+
+def use_multitask_reward(reward_fn, method='spearman', min_unique=10):
+    """Score all tasks of an AMBER `LossAucReward` in one `multitask_reward` call instead of one scorer call per
+    output column; the reward stays the mean per-task score
+    """
+    def call_scorer(pred, y):
+        return [[multitask_reward(y[i], pred[i], method=method, min_unique=min_unique)] for i in range(len(y))]
+
+    reward_fn.call_scorer = call_scorer
+    return reward_fn
+
+
+def benchmark(n_samples=100000, n_tasks=6, repeats=3, seed=0):
+    """Time the vectorized metrics against per-task scipy/sklearn calls on random data, and check they agree
+
+    Returns
+    -------
+    dict
+        metric -> (scipy seconds, vectorized seconds, max absolute difference)
+    """
+    import scipy.stats as ss
+    from sklearn.metrics import roc_auc_score
+    rng = np.random.RandomState(seed)
+    y_true = rng.rand(n_samples, n_tasks)
+    # rounded, so that predictions have ties like sigmoid outputs of a converged model
+    y_score = np.round(y_true + rng.normal(scale=0.3, size=y_true.shape), 3)
+    y_binary = (y_true >= np.median(y_true, axis=0)).astype(float)
+
+    def robust_spearmanr(t, s):
+        return (0 if len(set(s)) < 10 else ss.spearmanr(t.flatten(), s.flatten()).correlation) + 1
+
+    cases = {
+        'pearson': (lambda: [ss.pearsonr(y_true[:, j], y_score[:, j])[0] for j in range(n_tasks)],
+                    lambda: pearson(y_true, y_score)),
+        'spearman': (lambda: [ss.spearmanr(y_true[:, j], y_score[:, j]).correlation for j in range(n_tasks)],
+                     lambda: spearman(y_true, y_score)),
+        'auc': (lambda: [roc_auc_score(y_binary[:, j], y_score[:, j]) for j in range(n_tasks)],
+                lambda: auc(y_binary, y_score)),
+        'reward': (lambda: [np.mean([robust_spearmanr(y_true[:, j], y_score[:, j]) for j in range(n_tasks)])],
+                   lambda: [multitask_reward(y_true, y_score)]),
+    }
+    results = {}
+    for name, (reference, vectorized) in cases.items():
+        timings = []
+        for fn in (reference, vectorized):
+            start = time.time()
+            for _ in range(repeats):
+                value = np.asarray(fn())
+            timings.append((time.time() - start) / repeats)
+            if fn is reference:
+                expected = value
+        results[name] = (timings[0], timings[1], np.max(np.abs(expected - value)))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark vectorized metrics against scipy')
+    parser.add_argument("--samples", type=int, default=100000, help="number of samples")
+    parser.add_argument("--tasks", type=int, default=6, help="number of tasks")
+    parser.add_argument("--repeats", type=int, default=3, help="timing repeats")
+    args = parser.parse_args()
+
+    print("metric\tscipy_s\tvectorized_s\tspeedup\tmax_abs_diff")
+    for name, (t_ref, t_vec, diff) in benchmark(args.samples, args.tasks, args.repeats).items():
+        print("%s\t%.4f\t%.4f\t%.1fx\t%.2e" % (name, t_ref, t_vec, t_ref / t_vec, diff))
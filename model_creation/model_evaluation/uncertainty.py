@@ -0,0 +1,153 @@
+"""Monte-Carlo dropout uncertainty of CROTON predictions
+
+The model is cloned with its Dropout layers (dropout_rate=0.4 in the trained models) switched on at prediction time,
+while BatchNormalization and everything else stay in inference mode, so calling the model with `training=True` is
+not an option. Every sequence is repeated T times along the batch axis, so the T stochastic passes run as one batch
+in one `predict` call instead of T calls, and the predictions are summarized per output as mean, std and a
+percentile interval.
+
+Examples:
+    python -m model_creation.model_evaluation.uncertainty --model models/CROTON.h5 --seqs seqs.txt --samples 50 \\
+        --out predictions.tsv
+    python -m model_creation.model_evaluation.uncertainty --model models/CROTON.h5 --benchmark
+"""
+
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from tensorflow.keras.layers import Dropout
+from tensorflow.keras.models import load_model, clone_model
+from model_creation.data_compilation.encode import OneHotCodes, seqs_to_codes
+from model_creation.model_evaluation.evaluate import statlst
+
+
+def mc_dropout_model(model):
+    """Copy of `model` (with its weights) whose Dropout layers, and subclasses like SpatialDropout1D, also drop
+    units at prediction time
+    """
+    def clone_layer(layer):
+        if isinstance(layer, Dropout):
+            cls = layer.__class__
+            mc_cls = type('MC' + cls.__name__, (cls,),
+                          {'call': lambda self, inputs, training=None: cls.call(self, inputs, training=True)})
+            return mc_cls.from_config(layer.get_config())
+        return layer.__class__.from_config(layer.get_config())
+
+    mc_model = clone_model(model, clone_function=clone_layer)
+    mc_model.set_weights(model.get_weights())
+    return mc_model
+
+
+def predict_mc(mc_model, x, n_samples=50, batch_size=4096, interval=95.):
+    """Mean, std and percentile interval of `n_samples` stochastic predictions per sequence
+
+    Parameters
+    ----------
+    mc_model : keras model
+        see `mc_dropout_model`
+    x : np.array, or OneHotCodes
+        one-hot sequences, (n_seqs, 60, 4)
+    n_samples : int
+        number of dropout passes (T)
+    batch_size : int
+        rows per `predict` call, i.e. sequences x passes
+    interval : float
+        central percentile interval to report, e.g. 95 for the 2.5th and 97.5th percentiles
+
+    Returns
+    -------
+    dict
+        'mean', 'std', 'lower' and 'upper', each (n_seqs, n_outputs)
+    """
+    per_batch = max(1, batch_size // n_samples)
+    summary = {'mean': [], 'std': [], 'lower': [], 'upper': []}
+    for i in range(0, len(x), per_batch):
+        xb = np.asarray(x[i:i + per_batch])
+        # all passes of all sequences in the chunk in one call
+        pred = mc_model.predict(np.repeat(xb, n_samples, axis=0), batch_size=len(xb) * n_samples)
+        pred = pred.reshape(len(xb), n_samples, -1)
+        summary['mean'].append(pred.mean(axis=1))
+        summary['std'].append(pred.std(axis=1))
+        summary['lower'].append(np.percentile(pred, (100. - interval) / 2., axis=1))
+        summary['upper'].append(np.percentile(pred, 100. - (100. - interval) / 2., axis=1))
+    return {k: np.concatenate(v, axis=0) for k, v in summary.items()}
+
+
+def predict_uncertainty(model_fp, seqs, n_samples=50, batch_size=4096, interval=95.):
+    """Batch API: MC dropout predictions of the six statistics for a list of 60-bp sequences
+
+    Returns
+    -------
+    pandas.DataFrame
+        one row per sequence; '<stat>', '<stat>_std', '<stat>_lower' and '<stat>_upper' columns, see `predict_mc`
+    """
+    mc_model = mc_dropout_model(load_model(model_fp))
+    x = OneHotCodes(seqs_to_codes([s.upper() for s in seqs]))
+    summary = predict_mc(mc_model, x, n_samples=n_samples, batch_size=batch_size, interval=interval)
+    df = pd.DataFrame({'seq': list(seqs)})
+    for i, stat in enumerate(statlst):
+        df[stat] = summary['mean'][:, i]
+        for k in ('std', 'lower', 'upper'):
+            df['%s_%s' % (stat, k)] = summary[k][:, i]
+    return df
+
+
+def benchmark(model_fp, n_samples=(10, 50), n_seqs=1000, repeats=5, seed=0):
+    """Latency of point predictions vs. MC dropout as one replicated batch vs. T sequential passes, for one
+    sequence (as in the web app) and for `n_seqs` sequences, and of building the MC dropout model, which the web
+    app does once at startup
+
+    Returns
+    -------
+    pandas.DataFrame
+        median seconds per call of every method, T and number of sequences
+    """
+    model = load_model(model_fp)
+    mc_model = mc_dropout_model(model)
+    codes = np.random.RandomState(seed).randint(0, 4, size=(n_seqs, model.input_shape[1])).astype(np.uint8)
+    rows = []
+
+    def timeit(fn):
+        fn()  # warm-up
+        timings = []
+        for _ in range(repeats):
+            start = time.time()
+            fn()
+            timings.append(time.time() - start)
+        return float(np.median(timings))
+
+    rows.append({'method': 'mc_build', 'T': 0, 'n_seqs': 0, 'seconds': timeit(lambda: mc_dropout_model(model))})
+    for n in (1, n_seqs):
+        x = np.asarray(OneHotCodes(codes[:n]))
+        rows.append({'method': 'point', 'T': 1, 'n_seqs': n, 'seconds': timeit(lambda: model.predict(x))})
+        for t in n_samples:
+            rows.append({'method': 'mc_batched', 'T': t, 'n_seqs': n,
+                         'seconds': timeit(lambda: predict_mc(mc_model, x, n_samples=t))})
+            rows.append({'method': 'mc_sequential', 'T': t, 'n_seqs': n,
+                         'seconds': timeit(lambda: [mc_model.predict(x) for _ in range(t)])})
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Monte-Carlo dropout uncertainty of CROTON predictions')
+    parser.add_argument("--model", type=str, default='models/CROTON.h5', help="keras model")
+    parser.add_argument("--seqs", type=str, default=None, help="60-bp sequences, one per line")
+    parser.add_argument("--samples", type=int, default=50, help="number of dropout passes (T)")
+    parser.add_argument("--interval", type=float, default=95., help="central percentile interval")
+    parser.add_argument("--batch-size", type=int, default=4096, help="rows (sequences x passes) per predict call")
+    parser.add_argument("--out", type=str, default=None, help="output tsv; default stdout")
+    parser.add_argument("--benchmark", action='store_true', help="benchmark latency at T=10 and T=50 instead")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        print(benchmark(args.model).to_string(index=False))
+    else:
+        with open(args.seqs) as f:
+            seqs = [line.strip() for line in f if line.strip()]
+        df = predict_uncertainty(args.model, seqs, n_samples=args.samples, batch_size=args.batch_size,
+                                 interval=args.interval)
+        if args.out is not None:
+            df.to_csv(args.out, sep="\t", index=False)
+        else:
+            print(df.to_string(index=False))
@@ -19,10 +19,25 @@ import pickle
 import os
 import sys
 import scipy.stats as ss
+import time
+import shutil
 import argparse
-from tensorflow.keras.callbacks import EarlyStopping, ModelCheckpoint
+import tensorflow as tf
+from tensorflow.keras.callbacks import EarlyStopping
+from tensorflow.keras.models import load_model
 from tensorflow.keras.utils import plot_model
 from amber.plots import plot_training_history
+from model_creation.data_compilation.encode import OneHotCodes, is_codes, seqs_to_codes
+from model_creation.data_compilation.shards import open_shards, concat_sequences
+from model_creation.model_search.data_loader import OneHotSequence, predict_onehot
+from model_creation.model_search.arch_cache import ArchCache, fingerprint, restore_result, cache_manager_rewards
+from model_creation.model_evaluation.metrics import pearson, use_multitask_reward
+from model_creation.model_evaluation.bootstrap import confidence_intervals
+from model_creation.model_search.autotune import apply_profile
+from model_creation.model_search.profiler import TrainingProfiler, TimedModelCheckpoint, plot_time_breakdown
+from model_creation.model_search.search_artifacts import best_architecture
+from model_creation.model_search.search_checkpoint import prepare_resume, restore_checkpoint, enable_checkpoints
+from model_creation.model_search.results_store import record_result
 
 TASK_IDENTIFIER = {'del_freq': 0, '1ins_freq': 1, '1del_freq': 2, 'avgdel_len': 3, 'avgins_len': 4, 'entropy': 5,
                    'onemod3_freq': 6, 'twomod3_freq': 7, 'frameshift_freq': 8}
@@ -30,9 +45,14 @@ TASK_IDENTIFIER = {'del_freq': 0, '1ins_freq': 1, '1del_freq': 2, 'avgdel_len':
 
 def load_pickle_data(pickle_fp, tasks):
     """Refer to data_compilation for how sequences and labels are compiled
+
+    Sequences stored as uint8 base codes are wrapped in a lazy `OneHotCodes` view, so they are only
+    expanded to one-hot one batch at a time; older pickles with one-hot matrices are returned as-is.
     """
     data = pickle.load(open(pickle_fp, "rb"))
     x = data[0]
+    if is_codes(x):
+        x = OneHotCodes(x)
     ys = []
     for task in tasks:
         task_col = TASK_IDENTIFIER[task]
@@ -41,6 +61,14 @@ def load_pickle_data(pickle_fp, tasks):
     return x, y
 
 
+def load_shard_data(shard_dir, tasks):
+    """Memory-mapped counterpart of `load_pickle_data` for a shard directory written by
+    `model_creation.data_compilation.shards.write_shards`; sequences and the task columns of the labels
+    are only read from disk (and one-hot encoded) when a batch is gathered
+    """
+    return open_shards(shard_dir, cols=[TASK_IDENTIFIER[task] for task in tasks])
+
+
 def random_sample_controller(skip_target, model_space):
     """Random sample architectures from a model space, with sampling residual connection at a
     specified skip_target in [0,1]
@@ -80,9 +108,9 @@ def read_controller_train_history(fn, last_only=None):
     Parameters
     ----------
     fn : str
-        filepath to "train_hist.tsv" generated by amber controller
+        filepath to "train_history.csv" generated by amber controller
     last_only : int, or None
-        only read specified number of episodes from the last; if none,
+        only read specified number of trials from the last; if none,
         look for the best over controller train history
 
     Returns
@@ -92,18 +120,7 @@ def read_controller_train_history(fn, last_only=None):
     best_auc : float
         the reward (i.e. auc) for the best architecture
     """
-    d = pd.read_csv(fn, sep=",")
-    if last_only is not None:
-        d = d.loc[d.iloc[:, 0] >= (d.shape[0] - last_only)]
-    best_auc = - np.inf
-    best_arc = None
-    for i in range(d.shape[0]):
-        index, auc = d.iloc[i][0], d.iloc[i][2]
-        arc = d.iloc[i][3:].to_list()
-        if auc > best_auc:
-            best_arc = arc
-            best_auc = auc
-    return best_arc, best_auc
+    return best_architecture(fn, last_n=last_only)
 
 
 def robust_spearmanr(y_true, y_score):
@@ -164,13 +181,320 @@ def get_model_space(out_filters=64, num_layers=9, num_pool=4):
     return model_space
 
 
-def main(mode, wd, dataset, tasks, aux_reward_weight=1.0, enable_run=True):
+def load_data(dataset, tasks, data_dir=None):
+    """Load the train, validation and test data as (x, y) tuples
+
+    Parameters
+    ----------
+    dataset : str
+        dataset identifier. only funcional for 'forecast'
+    tasks : list of str
+        list of task identifiers
+    data_dir : str, or None
+        directory with 'train', 'val' and 'test' shard directories to stream data from; if None, load the
+        pickles in memory
+
+    Returns
+    -------
+    train_data, val_data, test_data : tuple
+    """
+    if dataset != 'forecast':
+        raise ValueError("Unknown dataset identifier: %s" % dataset)
+    if data_dir is not None:
+        train_data, val_data, test_data = [load_shard_data(os.path.join(data_dir, split), tasks)
+                                           for split in ('train', 'val', 'test')]
+        # validation/test labels are scored as plain arrays; labels are small next to the sequences
+        val_data = (val_data[0], np.asarray(val_data[1]))
+        test_data = (test_data[0], np.asarray(test_data[1]))
+    else:
+        train_data = load_pickle_data(tasks=tasks, pickle_fp='./data/data/Forecast/train_.pkl')
+        val_data = load_pickle_data(tasks=tasks, pickle_fp='./data/data/Forecast/val_.pkl')
+        test_data = load_pickle_data(tasks=tasks, pickle_fp='./data/data/Forecast/test_.pkl')
+    return train_data, val_data, test_data
+
+
+def get_final_model_builder(model_space, tasks, fc_units=32, flatten_op='GAP', wsf=6):
+    """Builder for the full-size (widened by `wsf`) residual CNNs trained in train/random mode
+
+    Parameters
+    ----------
+    model_space : amber.architect.ModelSpace
+        the model space architectures are sampled from
+    tasks : list of str
+        list of task identifiers; one sigmoid output unit each
+    fc_units : int
+        units of the fully-connected layer before widening
+    flatten_op : str
+        flatten operation before the fully-connected layer
+    wsf : int
+        width scale factor
+
+    Returns
+    -------
+    amber.modeler.KerasResidualCnnBuilder
+        call with `model_states=arc` to get a compiled keras model
+    """
+    input_node = Operation('input', shape=(60, 4), name="input")
+    output_node = Operation('dense', units=len(tasks), activation='sigmoid')
+    model_compile_dict = {
+        'loss': 'binary_crossentropy',
+        'optimizer': 'adam'
+    }
+    return KerasResidualCnnBuilder(
+        inputs_op=input_node,
+        output_op=output_node,
+        fc_units=fc_units * wsf,
+        flatten_mode=flatten_op,
+        model_compile_dict=model_compile_dict,
+        model_space=model_space,
+        dropout_rate=0.4,
+        wsf=wsf,
+        add_conv1_under_pool=True
+    )
+
+
+def get_train_config(dataset, data_dir=None, child_batchsize=512, epochs=500, patience=50, shuffle_buffer=None,
+                     fc_units=32, flatten_op='GAP', wsf=6):
+    """Everything besides the architecture and tasks that determines a trained model in train/random mode, used
+    as part of its `arch_cache.fingerprint`
+    """
+    return {
+        'data': os.path.abspath(data_dir) if data_dir is not None else dataset,
+        'child_batchsize': child_batchsize,
+        'epochs': epochs,
+        'patience': patience,
+        'shuffle_buffer': shuffle_buffer,
+        'builder': {'fc_units': fc_units, 'flatten_op': flatten_op, 'wsf': wsf, 'dropout_rate': 0.4},
+    }
+
+
+def train_and_evaluate(arc, kmb, wd_, train_data, val_data, test_data, tasks, child_batchsize=512, epochs=500,
+                       patience=50, verbose=2, workers=1, prefetch=10, shuffle_buffer=None, cache=None,
+                       cache_key=None, return_history=False, n_boot=1000):
+    """Train one architecture to convergence, then write its predictions ('val.tsv', 'test.tsv'), Pearson
+    correlations ('metrics.txt') with bootstrap confidence intervals ('metrics_ci.tsv'), training history and
+    per-epoch time breakdown ('profile.tsv', see `profiler`) to `wd_`
+
+    Parameters
+    ----------
+    arc : list of int
+        architecture tokens
+    kmb : amber.modeler.KerasResidualCnnBuilder
+        model builder, see `get_final_model_builder`
+    wd_ : str
+        output directory for this architecture
+    train_data, val_data, test_data : tuple
+        (x, y) data, see `load_data`
+    tasks : list of str
+        list of task identifiers
+    child_batchsize : int
+        training batch size
+    epochs : int
+        maximum number of epochs
+    patience : int
+        epochs without improvement of the validation loss before early stopping
+    verbose : int
+        keras verbosity
+    workers : int
+        number of threads assembling training batches
+    prefetch : int
+        maximum number of batches queued ahead of training
+    shuffle_buffer : int, or None
+        shuffle training samples within blocks of this size instead of globally, see `OneHotSequence`
+    cache : arch_cache.ArchCache, or None
+        if given, reuse the result stored under `cache_key` instead of training, and store it otherwise
+    cache_key : str, or None
+        `arch_cache.fingerprint` of (model space, arc, tasks, `get_train_config(...)`)
+    return_history : bool
+        also return the keras training history (None if the result came from the cache)
+    n_boot : int
+        bootstrap resamples for the 95% confidence intervals of the correlations, see `bootstrap`; 0 for none
+
+    Returns
+    -------
+    metrics : dict
+        '<VAL|TEST> <task>' -> pearson correlation
+    history : dict
+        only if `return_history`
+    """
+    if cache is not None:
+        record = cache.get(cache_key)
+        if record is not None:
+            print("architecture already trained in %s, reusing its results" % record['wd'])
+            restore_result(record, wd_)
+            return (record['metrics'], None) if return_history else record['metrics']
+    os.makedirs(wd_, exist_ok=True)
+    model = kmb(model_states=arc)
+    plot_model(model, to_file=os.path.join(wd_, "model.png"))
+    model_weight_fp = os.path.join(wd_, "bestmodel.h5")
+    profiler = TrainingProfiler(len(train_data[0]), out_fp=os.path.join(wd_, "profile.tsv"))
+    checkpointer = TimedModelCheckpoint(
+        model_weight_fp,
+        profiler,
+        monitor='val_loss',
+        save_best_only=True,
+        save_weights_only=False,
+        verbose=verbose
+    )
+    earlystopper = EarlyStopping(
+        monitor='val_loss',
+        patience=patience,
+        verbose=verbose
+    )
+
+    hist = model.fit(
+        OneHotSequence(train_data[0], train_data[1], batch_size=child_batchsize, shuffle=True,
+                       shuffle_buffer=shuffle_buffer),
+        epochs=epochs,
+        verbose=verbose,
+        validation_data=OneHotSequence(val_data[0], val_data[1], batch_size=child_batchsize),
+        callbacks=[checkpointer, earlystopper, profiler],
+        workers=workers,
+        max_queue_size=prefetch
+    )
+
+    model.load_weights(model_weight_fp)
+    metrics = {}
+    ci_rows = []
+    fo = open(os.path.join(wd_, "metrics.txt"), "w")
+    for split, (x, y) in (('VAL', val_data), ('TEST', test_data)):
+        pred = predict_onehot(model, x)
+        df = {'obs_%s' % k: y[:, i] for i, k in enumerate(tasks)}
+        df.update({
+            'pred_%s' % k: pred[:, i] for i, k in enumerate(tasks)})
+        df = pd.DataFrame(df)
+        df.to_csv(os.path.join(wd_, "%s.tsv" % split.lower()), sep="\t", index=False)
+        if split == 'TEST':
+            print('TEST')
+        corr = pearson(y, pred)
+        for i, task in enumerate(tasks):
+            metrics['%s %s' % (split, task)] = float(corr[i])
+            print("%s pearson=%.5f" % (task, metrics['%s %s' % (split, task)]))
+            fo.write("%s\t%s pearson\t%.5f\n" % (split, task, metrics['%s %s' % (split, task)]))
+        if n_boot:
+            lower, upper = confidence_intervals(y, pred, n_boot=n_boot)['pearson']
+            ci_rows += [{'split': split, 'task': task, 'pearson': corr[i], 'ci_low': lower[i], 'ci_high': upper[i]}
+                        for i, task in enumerate(tasks)]
+    if ci_rows:
+        pd.DataFrame(ci_rows).to_csv(os.path.join(wd_, "metrics_ci.tsv"), sep="\t", index=False)
+    plot_training_history(hist, wd_)
+    plot_time_breakdown(profiler, wd_)
+    print(profiler.summary())
+    fo.close()
+    if cache is not None:
+        cache.put(cache_key, {'metrics': metrics, 'wd': os.path.abspath(wd_),
+                              'weights_fp': os.path.abspath(model_weight_fp), 'arc': [int(a) for a in arc],
+                              'tasks': list(tasks)})
+    return (metrics, hist.history) if return_history else metrics
+
+
+def load_extra_sequences(seq_fp=None, n_synthetic=0, seq_len=60, seed=0):
+    """Unlabeled sequences for distillation, as uint8 base codes: one sequence per line in `seq_fp` (or a .npy
+    code matrix), plus `n_synthetic` uniformly random sequences
+    """
+    codes = [np.zeros((0, seq_len), dtype=np.uint8)]
+    if seq_fp is not None:
+        if seq_fp.endswith('.npy'):
+            codes.append(np.load(seq_fp).astype(np.uint8))
+        else:
+            with open(seq_fp) as f:
+                codes.append(seqs_to_codes([line.strip().upper() for line in f if line.strip()]))
+    if n_synthetic:
+        codes.append(np.random.RandomState(seed).randint(0, 4, size=(n_synthetic, seq_len)).astype(np.uint8))
+    return np.concatenate(codes, axis=0)
+
+
+def measure_latency(model, x, batch_size=1, repeats=50):
+    """Median seconds per `model.predict` call on a batch of `batch_size` sequences from `x`"""
+    batch = np.asarray(x[np.arange(batch_size) % len(x)])
+    model.predict(batch, batch_size=batch_size)  # warm-up
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        model.predict(batch, batch_size=batch_size)
+        timings.append(time.time() - start)
+    return float(np.median(timings))
+
+
+def distill_and_evaluate(teacher_fp, arc, student_kmb, wd_, train_data, val_data, test_data, tasks, extra_codes=None,
+                         child_batchsize=512, workers=1, prefetch=10, shuffle_buffer=None, export_fp=None):
+    """Train a compact student on the predictions of a trained teacher, and compare the two
+
+    The student is trained on the teacher's outputs for the training sequences (and `extra_codes`) with
+    `train_and_evaluate`, so early stopping and the reported metrics use the true validation/test labels. Writes
+    'distill_report.tsv' (per-task test Pearson of teacher and student) and 'distill_summary.tsv' (parameters,
+    file size and prediction latency) to `wd_`.
+
+    Parameters
+    ----------
+    teacher_fp : str
+        the teacher keras model, e.g. '<wd>/train/bestmodel.h5' or 'models/CROTON.h5'
+    arc : list of int
+        architecture tokens of the student
+    student_kmb : amber.modeler.KerasResidualCnnBuilder
+        builder of the student, see `get_final_model_builder` with a small `wsf`
+    wd_ : str
+        output directory
+    train_data, val_data, test_data : tuple
+        (x, y) data, see `load_data`; the training labels are replaced by the teacher's predictions
+    tasks : list of str
+        list of task identifiers, in the teacher's output order
+    extra_codes : np.array, or None
+        unlabeled uint8-coded sequences to add to the training sequences, see `load_extra_sequences`
+    child_batchsize, workers, prefetch, shuffle_buffer :
+        see `train_and_evaluate`
+    export_fp : str, or None
+        copy the student to this model path, e.g. 'models/CROTON.h5' to serve it in the web app
+
+    Returns
+    -------
+    report : pandas.DataFrame
+        per task, teacher and student test Pearson correlations
+    """
+    teacher = load_model(teacher_fp, compile=False)
+    if teacher.output_shape[-1] != len(tasks):
+        raise ValueError("Teacher %s has %i outputs, but %i tasks were given" % (
+            teacher_fp, teacher.output_shape[-1], len(tasks)))
+    x_train = train_data[0]
+    if extra_codes is not None and len(extra_codes):
+        x_train = concat_sequences(x_train, extra_codes)
+    print("labeling %i training sequences with the teacher" % len(x_train))
+    y_soft = predict_onehot(teacher, x_train)
+    student_metrics = train_and_evaluate(arc, student_kmb, wd_, (x_train, y_soft), val_data, test_data, tasks,
+                                         child_batchsize=child_batchsize, workers=workers, prefetch=prefetch,
+                                         shuffle_buffer=shuffle_buffer)
+    student_fp = os.path.join(wd_, "bestmodel.h5")
+    student = load_model(student_fp, compile=False)
+
+    teacher_corr = pearson(test_data[1], predict_onehot(teacher, test_data[0]))
+    report = pd.DataFrame({'task': tasks, 'teacher_pearson': teacher_corr,
+                           'student_pearson': [student_metrics['TEST %s' % task] for task in tasks]})
+    report.to_csv(os.path.join(wd_, "distill_report.tsv"), sep="\t", index=False)
+    summary = pd.DataFrame([
+        {'model': name, 'params': model.count_params(), 'file_mb': os.path.getsize(fp) / 2. ** 20,
+         'latency_1_ms': 1000. * measure_latency(model, test_data[0], batch_size=1),
+         'latency_%i_ms' % child_batchsize: 1000. * measure_latency(model, test_data[0], batch_size=child_batchsize,
+                                                                    repeats=10)}
+        for name, model, fp in (('teacher', teacher, teacher_fp), ('student', student, student_fp))])
+    summary.to_csv(os.path.join(wd_, "distill_summary.tsv"), sep="\t", index=False)
+    print(report.to_string(index=False))
+    print(summary.to_string(index=False))
+    if export_fp is not None:
+        shutil.copyfile(student_fp, export_fp)
+        print("student exported to %s" % export_fp)
+    return report
+
+
+def main(mode, wd, dataset, tasks, aux_reward_weight=1.0, enable_run=True, data_dir=None, workers=1, prefetch=10,
+         shuffle_buffer=None, use_cache=True, cache_dir=None, checkpoint_every=1, resume=False, reward='spearman',
+         teacher_fp=None, student_wsf=1, distill_seqs=None, n_synthetic=0, export_fp=None, seed=None,
+         results_db=None):
     """Main wrapper for amber-croton creation
 
     Parameters
     ----------
     mode : str
-        must be in ['search', 'train', 'random'].
+        must be in ['search', 'train', 'random', 'distill'].
     wd : str
         working directory
     dataset : str
@@ -182,17 +506,55 @@ def main(mode, wd, dataset, tasks, aux_reward_weight=1.0, enable_run=True):
     enable_run : bool
         Only used in search mode. If true, will run amber search upon called; otherwise, return the contructed
         `amber.Amber` instance
+    data_dir : str, or None
+        directory with 'train', 'val' and 'test' shard directories to stream data from; if None, load the
+        pickles in memory
+    workers : int
+        Only used in train/random mode. Number of threads assembling training batches
+    prefetch : int
+        Only used in train/random mode. Maximum number of batches queued ahead of training
+    shuffle_buffer : int, or None
+        Only used in train/random mode. Shuffle training samples within blocks of this size instead of
+        globally, see `OneHotSequence`
+    use_cache : bool
+        skip training architectures that were trained before with the same model space, tasks and training
+        configuration (train/random mode), or evaluated before with the same shared weights (search mode)
+    cache_dir : str, or None
+        Only used in train/random mode. Persistent cache directory; defaults to '<wd>/arch_cache'
+    checkpoint_every : int, or None
+        Only used in search mode. Checkpoint the search to '<wd>/checkpoint' every this many controller episodes;
+        None to disable, see `search_checkpoint`
+    resume : bool
+        Only used in search mode. Continue from the latest checkpoint in `wd` instead of starting over
+    reward : str
+        Only used in search mode. Reward of a child model: 1 + its mean per-task 'spearman' or 'pearson'
+        correlation on the validation data, see `metrics.multitask_reward`
+    teacher_fp : str, or None
+        Only used in distill mode. Teacher model; defaults to the model trained in train mode, '<wd>/train/bestmodel.h5'
+    student_wsf : int
+        Only used in distill mode. Width scale factor of the student, which has the architecture of the searched
+        best model (trained with wsf=6)
+    distill_seqs : str, or None
+        Only used in distill mode. Unlabeled sequences to distill on besides the training data, see
+        `load_extra_sequences`
+    n_synthetic : int
+        Only used in distill mode. Number of random sequences to distill on besides the training data
+    export_fp : str, or None
+        Only used in distill mode. Copy the student to this model path, e.g. 'models/CROTON.h5'
+    seed : int, or None
+        seed numpy and TensorFlow, e.g. for replicate searches in separate working dirs
+    results_db : str, or None
+        Only used in train and random mode. Results store to record the run in; defaults to '<wd>/results.sqlite',
+        see `results_store`
 
     Returns
     -------
     None
     """
-    if dataset == 'forecast':
-        train_data = load_pickle_data(tasks=tasks, pickle_fp='./data/data/Forecast/train_.pkl')
-    else:
-        raise ValueError("Unknown dataset identifier: %s" % dataset)
-    val_data = load_pickle_data(tasks=tasks, pickle_fp='./data/data/Forecast/val_.pkl')
-    test_data = load_pickle_data(tasks=tasks, pickle_fp='./data/data/Forecast/test_.pkl')
+    if seed is not None:
+        np.random.seed(seed)
+        tf.compat.v1.set_random_seed(seed)
+    train_data, val_data, test_data = load_data(dataset, tasks, data_dir=data_dir)
 
     # First, define the components we need to use
     type_dict = {
@@ -294,24 +656,42 @@ def main(mode, wd, dataset, tasks, aux_reward_weight=1.0, enable_run=True):
 
     # finally, run program
     if mode == 'search':
+        state = None
+        if resume:
+            state = prepare_resume(wd, specs['train_env'])
+            if state is None:
+                print("no checkpoint in %s, starting a new search" % wd)
+            elif state['episode'] + 1 >= specs['train_env']['max_episode']:
+                print("search in %s already finished all %i episodes" % (wd, specs['train_env']['max_episode']))
+                return None
+            else:
+                print("resuming search after episode %i" % state['episode'])
         amb = Amber(types=type_dict, specs=specs)
+        use_multitask_reward(amb.reward_fn, method=reward)
+        if state is not None:
+            restore_checkpoint(amb, wd, state)
+        if checkpoint_every:
+            enable_checkpoints(amb, wd, every=checkpoint_every, state=state)
+        if use_cache:
+            amb.arch_cache = ArchCache()
+            cache_manager_rewards(amb.manager, model_space, tasks, amb.arch_cache)
         if enable_run is True:
             amb.run()
+            if use_cache:
+                print(amb.arch_cache.report())
         return amb
+    elif mode == 'distill':
+        best_arc, best_auc = read_controller_train_history(fn=os.path.join(wd, 'train_history.csv'),
+                                                           last_only=samps_per_controller_step)
+        print("best_arc=%s" % best_arc)
+        kmb = get_final_model_builder(model_space, tasks, fc_units=fc_units, flatten_op=flatten_op, wsf=student_wsf)
+        extra_codes = load_extra_sequences(distill_seqs, n_synthetic=n_synthetic)
+        return distill_and_evaluate(teacher_fp or os.path.join(wd, 'train', 'bestmodel.h5'), best_arc, kmb,
+                                    os.path.join(wd, 'distill'), train_data, val_data, test_data, tasks,
+                                    extra_codes=extra_codes, child_batchsize=child_batchsize, workers=workers,
+                                    prefetch=prefetch, shuffle_buffer=shuffle_buffer, export_fp=export_fp)
     else:
-        wsf = 6
-        model_compile_dict['optimizer'] = 'adam'
-        kmb = KerasResidualCnnBuilder(
-            inputs_op=input_node,
-            output_op=output_node,
-            fc_units=fc_units * wsf,
-            flatten_mode=flatten_op,
-            model_compile_dict=model_compile_dict,
-            model_space=model_space,
-            dropout_rate=0.4,
-            wsf=wsf,
-            add_conv1_under_pool=True
-        )
+        kmb = get_final_model_builder(model_space, tasks, fc_units=fc_units, flatten_op=flatten_op)
         if mode == 'train':
             best_arc, best_auc = read_controller_train_history(fn=os.path.join(wd, 'train_history.csv'),
                                                                last_only=samps_per_controller_step)
@@ -322,65 +702,32 @@ def main(mode, wd, dataset, tasks, aux_reward_weight=1.0, enable_run=True):
             # 25/28 is learned from amber
             best_arc = random_sample_controller(skip_target=25 / 28, model_space=model_space)
             wd_ = os.path.join(wd, 'random')
-        verbose = 2
-        os.makedirs(wd_, exist_ok=True)
-        model = kmb(model_states=best_arc)
-        plot_model(model, to_file=os.path.join(wd_, "model.png"))
-        model_weight_fp = os.path.join(wd_, "bestmodel.h5")
-        checkpointer = ModelCheckpoint(
-            model_weight_fp,
-            monitor='val_loss',
-            save_best_only=True,
-            save_weights_only=False,
-            verbose=verbose
-        )
-        earlystopper = EarlyStopping(
-            monitor='val_loss',
-            patience=50,
-            verbose=verbose
-        )
-
-        hist = model.fit(
-            train_data[0], train_data[1],
-            epochs=500,
-            batch_size=child_batchsize,
-            verbose=verbose,
-            validation_data=val_data,
-            callbacks=[checkpointer, earlystopper]
-        )
-
-        model.load_weights(model_weight_fp)
-        val_pred = model.predict(val_data[0])
-        val_df = {'obs_%s' % k: val_data[1][:, i] for i, k in enumerate(tasks)}
-        val_df.update({
-            'pred_%s' % k: val_pred[:, i] for i, k in enumerate(tasks)})
-        val_df = pd.DataFrame(val_df)
-        val_df.to_csv(os.path.join(wd_, "val.tsv"), sep="\t", index=False)
-        fo = open(os.path.join(wd_, "metrics.txt"), "w")
-        for task in tasks:
-            print("%s pearson=%.5f" % (task, ss.pearsonr(val_df['obs_%s' % task], val_df['pred_%s' % task])[0]))
-            fo.write(
-                "VAL\t%s pearson\t%.5f\n" % (task, ss.pearsonr(val_df['obs_%s' % task], val_df['pred_%s' % task])[0]))
-        test_pred = model.predict(test_data[0])
-        test_df = {'obs_%s' % k: test_data[1][:, i] for i, k in enumerate(tasks)}
-        test_df.update({
-            'pred_%s' % k: test_pred[:, i] for i, k in enumerate(tasks)})
-        test_df = pd.DataFrame(test_df)
-        test_df.to_csv(os.path.join(wd_, "test.tsv"), sep="\t", index=False)
-        print('TEST')
-        for task in tasks:
-            print("%s pearson=%.5f" % (task, ss.pearsonr(test_df['obs_%s' % task], test_df['pred_%s' % task])[0]))
-            fo.write("TEST\t%s pearson\t%.5f\n" % (
-                task, ss.pearsonr(test_df['obs_%s' % task], test_df['pred_%s' % task])[0]))
-        plot_training_history(hist, wd_)
-        fo.close()
+        cache, cache_key = None, None
+        if use_cache:
+            cache = ArchCache(cache_dir or os.path.join(wd, 'arch_cache'))
+            cache_key = fingerprint(model_space, best_arc, tasks,
+                                    get_train_config(dataset, data_dir=data_dir, child_batchsize=child_batchsize,
+                                                     shuffle_buffer=shuffle_buffer, fc_units=fc_units,
+                                                     flatten_op=flatten_op))
+        start = time.time()
+        metrics, history = train_and_evaluate(best_arc, kmb, wd_, train_data, val_data, test_data, tasks,
+                                              child_batchsize=child_batchsize, workers=workers, prefetch=prefetch,
+                                              shuffle_buffer=shuffle_buffer, cache=cache, cache_key=cache_key,
+                                              return_history=True)
+        record_result(wd, wd_, mode, metrics, db_fp=results_db, dataset=dataset, arc=best_arc,
+                      args={'data_dir': data_dir, 'child_batchsize': child_batchsize, 'shuffle_buffer': shuffle_buffer,
+                            'fc_units': fc_units, 'flatten_op': flatten_op, 'tasks': tasks},
+                      wall_time=time.time() - start, epochs=len(history['loss']) if history is not None else 0)
+        if use_cache:
+            print(cache.report())
 
 
 if __name__ == "__main__":
     if not run_from_ipython():
         parser = argparse.ArgumentParser(description='AMBER search for CROTON')
         parser.add_argument("--wd", type=str, help="working dir")
-        parser.add_argument("--mode", type=str, choices=['search', 'train', 'random'], required=True, help="run mode")
+        parser.add_argument("--mode", type=str, choices=['search', 'train', 'random', 'distill'],
+                            required=True, help="run mode")
         parser.add_argument("--dataset", type=str, choices=['all', 'forecast', 'sprout'], help="training dataset")
         parser.add_argument("--tasks", type=str, nargs='+',
                             choices=['del_freq', '1ins_freq', '1del_freq', 'frameshift_freq',
@@ -389,10 +736,43 @@ if __name__ == "__main__":
                             help="tasks of interest")
         parser.add_argument("--aux-weight", type=float, default=1.0,
                             help="weight for auxilary reward; must be in [0, 10]")
+        parser.add_argument("--data-dir", type=str, default=None,
+                            help="stream train/val/test shards from this directory instead of loading the pickles")
+        parser.add_argument("--workers", type=int, default=1, help="threads assembling training batches")
+        parser.add_argument("--prefetch", type=int, default=10, help="training batches queued ahead")
+        parser.add_argument("--shuffle-buffer", type=int, default=None,
+                            help="shuffle within blocks of this many samples instead of globally")
+        parser.add_argument("--cache-dir", type=str, default=None,
+                            help="architecture cache dir for train/random mode; default <wd>/arch_cache")
+        parser.add_argument("--no-cache", action='store_true', help="retrain architectures even if cached")
+        parser.add_argument("--checkpoint-every", type=int, default=1,
+                            help="checkpoint the search every this many episodes; 0 to disable")
+        parser.add_argument("--resume", action='store_true', help="resume the search from the latest checkpoint")
+        parser.add_argument("--thread-profile", type=str, default=None,
+                            help="tuned thread profile; default $CROTON_THREAD_PROFILE or ./thread_profile.json")
+        parser.add_argument("--teacher", type=str, default=None,
+                            help="distill mode: teacher model; default <wd>/train/bestmodel.h5")
+        parser.add_argument("--student-wsf", type=int, default=1, help="distill mode: student width scale factor")
+        parser.add_argument("--distill-seqs", type=str, default=None,
+                            help="distill mode: extra unlabeled sequences, one per line or a .npy code matrix")
+        parser.add_argument("--n-synthetic", type=int, default=0, help="distill mode: extra random sequences")
+        parser.add_argument("--export", type=str, default=None,
+                            help="distill mode: copy the student here, e.g. models/CROTON.h5")
+        parser.add_argument("--seed", type=int, default=None, help="numpy/TensorFlow seed")
+        parser.add_argument("--results-db", type=str, default=None,
+                            help="train/random mode: results store; default <wd>/results.sqlite")
+        parser.add_argument("--reward", type=str, choices=['spearman', 'pearson'], default='spearman',
+                            help="search reward: mean per-task correlation on the validation data")
 
         args = parser.parse_args()
         os.makedirs(args.wd, exist_ok=True)
         with open(os.path.join(args.wd, "args.txt"), "w") as f:
             f.write("\n".join(sys.argv))
+        if apply_profile('train', fp=args.thread_profile) is not None:
+            print("applied the training thread profile")
         main(mode=args.mode, wd=args.wd, dataset=args.dataset, tasks=args.tasks, aux_reward_weight=args.aux_weight,
-             enable_run=True)
+             enable_run=True, data_dir=args.data_dir, workers=args.workers, prefetch=args.prefetch,
+             shuffle_buffer=args.shuffle_buffer, use_cache=not args.no_cache, cache_dir=args.cache_dir,
+             checkpoint_every=args.checkpoint_every or None, resume=args.resume, reward=args.reward,
+             teacher_fp=args.teacher, student_wsf=args.student_wsf, distill_seqs=args.distill_seqs,
+             n_synthetic=args.n_synthetic, export_fp=args.export, seed=args.seed, results_db=args.results_db)
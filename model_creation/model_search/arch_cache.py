@@ -0,0 +1,146 @@
+"""Persistent cache of trained architectures, so duplicate architecture token sequences are not retrained
+
+An entry is keyed on a canonical hash of the model space, the architecture tokens, the tasks and the training
+configuration, and stores the trained metrics and where the weights were saved. Entries are one small json file
+each, written atomically, so concurrent workers can share a cache directory.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+
+
+def _canonical_model_space(model_space):
+    # layer -> list of (operation type, attributes), independent of object identity and dict ordering
+    return [[[op.Layer_type, {k: repr(v) for k, v in sorted(op.Layer_attributes.items())}]
+             for op in model_space[i]] for i in range(len(model_space))]
+
+
+def fingerprint(model_space, arc, tasks, config=None):
+    """sha256 hex digest identifying a training run
+
+    Parameters
+    ----------
+    model_space : amber.architect.ModelSpace
+        the model space the architecture tokens index into
+    arc : list of int
+        architecture tokens
+    tasks : list of str
+        task identifiers, in output order
+    config : dict, or None
+        anything else that changes the trained model (epochs, batch size, builder arguments, ...)
+
+    Returns
+    -------
+    str
+    """
+    payload = {
+        'model_space': _canonical_model_space(model_space),
+        'arc': [int(a) for a in arc],
+        'tasks': list(tasks),
+        'config': config or {},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+class ArchCache:
+    """Fingerprint -> result records, with hit/miss counts
+
+    Parameters
+    ----------
+    cache_dir : str, or None
+        directory holding one '<fingerprint>.json' per entry; if None, entries only live in memory
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.memory = {}
+        self.hits = 0
+        self.misses = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _fp(self, key):
+        return os.path.join(self.cache_dir, '%s.json' % key)
+
+    def get(self, key):
+        """The stored record, or None; counts a hit or a miss"""
+        record = self.memory.get(key)
+        if record is None and self.cache_dir is not None and os.path.isfile(self._fp(key)):
+            with open(self._fp(key)) as f:
+                record = json.load(f)
+            self.memory[key] = record
+        if record is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return record
+
+    def put(self, key, record):
+        self.memory[key] = record
+        if self.cache_dir is not None:
+            tmp_fp = '%s.tmp%i' % (self._fp(key), os.getpid())
+            with open(tmp_fp, 'w') as f:
+                json.dump(record, f, indent=1)
+            os.replace(tmp_fp, self._fp(key))
+
+    def report(self):
+        total = self.hits + self.misses
+        return "architecture cache: %i hits, %i misses (%.1f%% hit rate)" % (
+            self.hits, self.misses, 100. * self.hits / total if total else 0.)
+
+
+def restore_result(record, wd_):
+    """Recreate the outputs of a cached train/random run in `wd_`: metrics.txt in the layout written by
+    `amber_cnn_sumstats.train_and_evaluate` (and read by `get_randomized_distr.read_bg`), predictions copied
+    from the original run if still there, and 'cached_from.txt' pointing at the original weights
+    """
+    os.makedirs(wd_, exist_ok=True)
+    with open(os.path.join(wd_, "metrics.txt"), "w") as fo:
+        for key, value in record['metrics'].items():
+            split, task = key.split(' ', 1)
+            fo.write("%s\t%s pearson\t%.5f\n" % (split, task, value))
+    src_dir = record.get('wd')
+    for fn in ('val.tsv', 'test.tsv', 'metrics_ci.tsv', 'arc.txt'):
+        if src_dir and os.path.isfile(os.path.join(src_dir, fn)) and os.path.abspath(src_dir) != os.path.abspath(wd_):
+            shutil.copyfile(os.path.join(src_dir, fn), os.path.join(wd_, fn))
+    with open(os.path.join(wd_, "cached_from.txt"), "w") as f:
+        f.write("%s\n%s\n" % (src_dir, record.get('weights_fp')))
+
+
+def cache_manager_rewards(manager, model_space, tasks, cache):
+    """Make an AMBER EnasManager reuse the reward of an architecture sampled again before its shared weights
+    change
+
+    In ENAS search, architectures are scored with the current shared weights, which are only updated by
+    `get_rewards(trial, None, ...)` between controller episodes. A reward is therefore reusable for repeats of an
+    architecture until the next shared-weights update, and the cache key includes a counter of those updates.
+
+    Parameters
+    ----------
+    manager : amber.architect.EnasManager
+        the manager of an `amber.Amber` instance, i.e. `amb.manager`
+    model_space : amber.architect.ModelSpace
+        the searched model space
+    tasks : list of str
+        task identifiers
+    cache : ArchCache
+        records rewards; an in-memory cache is enough, since keys do not carry over between searches
+    """
+    get_rewards = manager.get_rewards
+    shared_weights = {'version': 0}
+
+    def cached_get_rewards(trial, model_arc=None, nsteps=None):
+        if model_arc is None:  # trains the shared weights
+            shared_weights['version'] += 1
+            return get_rewards(trial, model_arc, nsteps=nsteps)
+        key = fingerprint(model_space, model_arc, tasks, {'shared_weights_version': shared_weights['version']})
+        record = cache.get(key)
+        if record is None:
+            reward, loss_and_metrics = get_rewards(trial, model_arc, nsteps=nsteps)
+            record = {'reward': reward, 'loss_and_metrics': loss_and_metrics}
+            cache.put(key, record)
+        return record['reward'], dict(record['loss_and_metrics'])
+
+    manager.get_rewards = cached_get_rewards
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Autotune the CPU thread configuration of TensorFlow for training and inference
+
+Benchmarks a model (CROTON.h5, or any `bestmodel.h5`) on random sequences over a grid of intra-/inter-op thread
+counts and batch sizes, for training steps and for prediction, each grid point in a fresh process. The fastest
+configurations are saved to a thread profile (default './thread_profile.json', or $CROTON_THREAD_PROFILE), which
+`amber_cnn_sumstats.py`, the web app and the evaluation scripts apply at startup with `apply_profile`.
+
+With `--processes N`, the grid is limited to 1/N of the cores, for nodes shared by N training processes.
+
+Example:
+    python -m model_creation.model_search.autotune --model models/CROTON.h5 --processes 1
+"""
+
+import os
+import json
+import time
+import socket
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+
+DEFAULT_PROFILE = 'thread_profile.json'
+
+
+def profile_path(fp=None):
+    return fp or os.environ.get('CROTON_THREAD_PROFILE', DEFAULT_PROFILE)
+
+
+def load_profile(fp=None):
+    """The saved thread profile, or None if there is none"""
+    fp = profile_path(fp)
+    if not os.path.isfile(fp):
+        return None
+    with open(fp) as f:
+        return json.load(f)
+
+
+def set_tf_threads(intra_threads, inter_threads):
+    """Limit the TensorFlow thread pools of this process; call before building models (and again after
+    `clear_session` on TF 1.x, where the limits live in the keras session)
+    """
+    import tensorflow as tf
+    if tf.__version__.startswith('1.'):
+        from tensorflow.keras import backend as K
+        config = tf.ConfigProto(intra_op_parallelism_threads=intra_threads,
+                                inter_op_parallelism_threads=inter_threads)
+        K.set_session(tf.Session(config=config))
+    elif tf.config.threading.get_intra_op_parallelism_threads() != intra_threads:
+        # TF 2.x: process-wide, and only settable before the runtime is initialized
+        tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+
+
+def apply_profile(kind, fp=None):
+    """Set this process's TensorFlow thread pools to the tuned configuration, before any model is built
+
+    Parameters
+    ----------
+    kind : str
+        'train' or 'inference'
+    fp : str, or None
+        thread profile; defaults to $CROTON_THREAD_PROFILE, or './thread_profile.json'
+
+    Returns
+    -------
+    dict, or None
+        the applied configuration ('intra', 'inter', 'batch_size', 'samples_per_sec'); None if there is no profile,
+        in which case TensorFlow's defaults are left alone
+    """
+    profile = load_profile(fp)
+    if profile is None:
+        return None
+    config = profile[kind]
+    if profile['host']['cpu_count'] != os.cpu_count():
+        print("thread profile %s was tuned on a %i-core host, this one has %i cores" % (
+            profile_path(fp), profile['host']['cpu_count'], os.cpu_count()))
+    os.environ['OMP_NUM_THREADS'] = str(config['intra'])
+    set_tf_threads(config['intra'], config['inter'])
+    return config
+
+
+def _benchmark_point(model_fp, kind, intra, inter, batch_size, steps, warmup):
+    # runs in a fresh process, so the thread pools are configured before TensorFlow starts
+    os.environ['OMP_NUM_THREADS'] = str(intra)
+    os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    set_tf_threads(intra, inter)
+    from tensorflow.keras.models import load_model
+    model = load_model(model_fp, compile=kind == 'train')
+    if kind == 'train' and model.optimizer is None:
+        model.compile(loss='binary_crossentropy', optimizer='adam')
+    rng = np.random.RandomState(0)
+    x = np.eye(4, dtype=np.float32)[rng.randint(0, 4, size=(batch_size,) + model.input_shape[1:2])]
+    y = rng.rand(batch_size, model.output_shape[-1]).astype(np.float32)
+    step = (lambda: model.train_on_batch(x, y)) if kind == 'train' else (lambda: model.predict_on_batch(x))
+    for _ in range(warmup):
+        step()
+    start = time.time()
+    for _ in range(steps):
+        step()
+    return batch_size * steps / (time.time() - start)
+
+
+def thread_grid(processes=1):
+    """Intra-op thread counts (powers of 2, and all cores) and inter-op thread counts to try"""
+    cores = max(1, os.cpu_count() // processes)
+    intra = sorted(set([2 ** i for i in range(int(np.log2(cores)) + 1)] + [cores]))
+    inter = [1, 2] if cores > 1 else [1]
+    return intra, inter
+
+
+def autotune(model_fp, out_fp=None, processes=1, train_batch_sizes=(512,), inference_batch_sizes=(512, 2048, 8192),
+             steps=20, warmup=3):
+    """Benchmark the thread/batch size grid and save the fastest configurations
+
+    Parameters
+    ----------
+    model_fp : str
+        keras model to benchmark
+    out_fp : str, or None
+        thread profile to write; see `apply_profile`
+    processes : int
+        number of processes that will share the node; the grid is limited to their share of the cores
+    train_batch_sizes : tuple of int
+        training batch sizes; only the threads of the training profile are applied, since the batch size also
+        changes what is learned
+    inference_batch_sizes : tuple of int
+        prediction batch sizes
+    steps : int
+        timed batches per grid point
+    warmup : int
+        untimed batches per grid point
+
+    Returns
+    -------
+    dict
+        the saved profile
+    """
+    intra_grid, inter_grid = thread_grid(processes)
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for kind, batch_sizes in (('train', train_batch_sizes), ('inference', inference_batch_sizes)):
+        for intra, inter, batch_size in itertools.product(intra_grid, inter_grid, batch_sizes):
+            with ctx.Pool(1) as pool:
+                samples_per_sec = pool.apply(_benchmark_point, (model_fp, kind, intra, inter, batch_size, steps,
+                                                                warmup))
+            results.append({'kind': kind, 'intra': intra, 'inter': inter, 'batch_size': batch_size,
+                            'samples_per_sec': samples_per_sec})
+            print("%s\tintra=%i\tinter=%i\tbatch_size=%i\t%.0f samples/sec" % (
+                kind, intra, inter, batch_size, samples_per_sec), flush=True)
+
+    profile = {
+        'host': {'hostname': socket.gethostname(), 'cpu_count': os.cpu_count(), 'processes': processes},
+        'model': os.path.abspath(model_fp),
+        'results': results,
+    }
+    for kind in ('train', 'inference'):
+        best = max([r for r in results if r['kind'] == kind], key=lambda r: r['samples_per_sec'])
+        profile[kind] = {k: best[k] for k in ('intra', 'inter', 'batch_size', 'samples_per_sec')}
+        print("best %s: intra=%i inter=%i batch_size=%i (%.0f samples/sec)" % (
+            kind, best['intra'], best['inter'], best['batch_size'], best['samples_per_sec']))
+    out_fp = profile_path(out_fp)
+    with open(out_fp + '.tmp', 'w') as f:
+        json.dump(profile, f, indent=1)
+    os.replace(out_fp + '.tmp', out_fp)
+    print("thread profile written to %s" % out_fp)
+    return profile
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Autotune TensorFlow CPU threads for CROTON')
+    parser.add_argument("--model", type=str, default='models/CROTON.h5', help="keras model to benchmark")
+    parser.add_argument("--out", type=str, default=None,
+                        help="thread profile; default $CROTON_THREAD_PROFILE or ./thread_profile.json")
+    parser.add_argument("--processes", type=int, default=1, help="processes sharing the node")
+    parser.add_argument("--train-batch-sizes", type=int, nargs='+', default=[512], help="training batch sizes")
+    parser.add_argument("--inference-batch-sizes", type=int, nargs='+', default=[512, 2048, 8192],
+                        help="prediction batch sizes")
+    parser.add_argument("--steps", type=int, default=20, help="timed batches per configuration")
+    args = parser.parse_args()
+
+    autotune(args.model, out_fp=args.out, processes=args.processes, train_batch_sizes=args.train_batch_sizes,
+             inference_batch_sizes=args.inference_batch_sizes, steps=args.steps)
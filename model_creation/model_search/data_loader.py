@@ -0,0 +1,74 @@
+"""Batch loaders that expand uint8-coded sequences to one-hot only at batch time
+
+Inputs can be in memory (`OneHotCodes`) or streamed from disk (`shards.ShardedArray` over
+memory-mapped shards); `model.fit(..., workers=n, max_queue_size=k)` assembles batches of a
+`OneHotSequence` in n background threads, keeping up to k batches prefetched.
+"""
+
+import numpy as np
+from tensorflow.keras.utils import Sequence
+
+
+class OneHotSequence(Sequence):
+    """Keras Sequence over in-memory sequences, one-hot encoded per batch
+
+    Parameters
+    ----------
+    x : OneHotCodes or np.array
+        anything indexable by an array of sample indices that returns a one-hot batch
+    y : np.array, or None
+        labels; if None, batches only contain inputs (e.g. for prediction)
+    batch_size : int
+        number of samples per batch
+    shuffle : bool
+        reshuffle sample order at the end of every epoch
+    seed : int, or None
+        seed for the shuffling RNG
+    shuffle_buffer : int, or None
+        if given, shuffle within consecutive blocks of this many samples and shuffle the order of the
+        blocks, instead of shuffling globally; every batch then reads from one (or two adjacent)
+        blocks, which keeps reads from on-disk shards local
+    """
+
+    def __init__(self, x, y=None, batch_size=512, shuffle=False, seed=None, shuffle_buffer=None):
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.rng = np.random.RandomState(seed)
+        self.index = np.arange(len(x))
+        if self.shuffle:
+            self._shuffle_index()
+
+    def _shuffle_index(self):
+        if self.shuffle_buffer is None:
+            self.rng.shuffle(self.index)
+            return
+        n = len(self.index)
+        blocks = [np.arange(start, min(start + self.shuffle_buffer, n)) for start in range(0, n, self.shuffle_buffer)]
+        for block in blocks:
+            self.rng.shuffle(block)
+        order = self.rng.permutation(len(blocks))
+        self.index = np.concatenate([blocks[i] for i in order]) if blocks else self.index
+
+    def __len__(self):
+        return int(np.ceil(len(self.index) / self.batch_size))
+
+    def __getitem__(self, i):
+        # sorted indices keep the gather contiguous-ish; order within a batch does not matter
+        idx = np.sort(self.index[i * self.batch_size:(i + 1) * self.batch_size])
+        if self.y is None:
+            return self.x[idx]
+        return self.x[idx], self.y[idx]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._shuffle_index()
+
+
+def predict_onehot(model, x, batch_size=4096):
+    """Predict on one-hot batches expanded chunk by chunk, so the full one-hot matrix is never built
+    """
+    preds = [model.predict(x[i:i + batch_size], batch_size=batch_size) for i in range(0, len(x), batch_size)]
+    return np.concatenate(preds, axis=0)
@@ -3,11 +3,11 @@ plot the distribution agains amber-design
 """
 
 # zzjfrank, jan 25 2021
-import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+from model_creation.model_search.results_store import ResultsStore, db_path
 
 target_dir = './outputs/forecast_freqs/'
 tasks = ['1ins', '1del', 'del', 'onemod3', 'twomod3', 'frameshift']
@@ -26,32 +26,42 @@ def read_bg():
     distribution in a model space
 
     The random-sampled architectures are created by setting `mode=random`. See the `main()` function
-     in amber_cnn_sumstats.py for more information.
+     in amber_cnn_sumstats.py for more information. Only the runs in 'random_collections.denseResConn' are read,
+     from the results store of `target_dir` (see `results_store`), into which runs only found as `metrics.txt` are
+     imported first.
 
     Returns
     -------
     df : pandas.DataFrame
-        a dataframe of testing performances
+        a dataframe of testing performances, tasks x runs
     """
-    sub_dir = 'random_collections.denseResConn'
-    cl = [os.path.join(target_dir, sub_dir, x, 'metrics.txt') for x in os.listdir(os.path.join(target_dir, sub_dir))]
-    dfs = [pd.read_table(x, header=None, index_col=(0, 1), sep="\t") for x in cl if os.path.isfile(x)]
-    df = pd.concat(dfs, axis=1)
+    with ResultsStore(db_path(target_dir)) as store:
+        store.import_runs(target_dir)
+        df = store.table('random', split='TEST', parent=target_dir + 'random_collections.denseResConn')
+    df.index = [x.rstrip('_freq') for x in df.index]
     return df
 
 
-df = read_bg()
-df = df.iloc[6:]  # only testing
-df.index = [x[1].split()[0].rstrip('_freq') for x in df.index]
+def read_amb():
+    """Testing performances of the AMBER-designed model (`mode=train`, in '<target_dir>/train'), with their
+    confidence intervals
+    """
+    with ResultsStore(db_path(target_dir)) as store:
+        store.import_runs(target_dir)
+        amb = store.query(mode='train', split='TEST', wd_=target_dir + 'train')
+    if amb['run_id'].nunique() != 1:
+        raise ValueError("expected exactly one train run in %strain, found %i" % (target_dir, amb['run_id'].nunique()))
+    amb.index = [x.rstrip('_freq') for x in amb['task']]
+    return amb
 
-amb = pd.read_table(os.path.join(target_dir, 'train', 'metrics.txt'), header=None, index_col=(0, 1), sep="\t")
-amb = amb.iloc[6:]
-amb.index = [x[1].split()[0].rstrip('_freq') for x in amb.index]
+
+df = read_bg()
+amb = read_amb()
 
 # performance over random
 outperform_pct = {}
 for idx in df.index:
-    outperform_pct[idx] = np.mean(df.loc[idx] <= amb.loc[idx][2])
+    outperform_pct[idx] = np.mean(df.loc[idx] <= amb['value'].loc[idx])
 print(outperform_pct)
 
 # plot
@@ -63,7 +73,13 @@ sns.boxplot(y='variable', x='value', order=tasks, data=plot_df,
 for patch in ax.artists:
     r, g, b, a = patch.get_facecolor()
     patch.set_facecolor((r, g, b, .7))
-ax.scatter(amb[2].loc[tasks], np.arange(0, amb.shape[0]), color='red', s=16, label='CROTON', zorder=10)  # *
+ax.scatter(amb['value'].loc[tasks], np.arange(0, amb.shape[0]), color='red', s=16, label='CROTON', zorder=10)  # *
+# 95% bootstrap confidence intervals of CROTON, if written by train mode
+if amb['ci_low'].notna().all():
+    ax.errorbar(amb['value'].loc[tasks].values, np.arange(0, amb.shape[0]),
+                xerr=[amb['value'].loc[tasks].values - amb['ci_low'].loc[tasks].values,
+                      amb['ci_high'].loc[tasks].values - amb['value'].loc[tasks].values],
+                fmt='none', ecolor='red', capsize=3, zorder=10)
 sns.stripplot(x="value", y="variable", order=tasks, data=plot_df, color=".25",  # color=".3", marker='o',
               size=4, linewidth=0, label='Sampled CNNs')
 handles, labels = ax.get_legend_handles_labels()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Live progress monitor for an AMBER architecture search (`amber_cnn_sumstats.py --mode search`)
+
+Tails `<wd>/train_history.csv`, reading only the bytes appended since the last refresh, and keeps rolling
+statistics: best reward so far, moving average of the reward, episodes/hour, and the entropy of the operations
+sampled at every layer over the last `window` trials. Every refresh costs the same however long the search has run.
+AMBER only writes `weight_data.json` when the search ends, so the live entropy is that of the sampled architectures
+rather than of the controller probabilities; run `search_artifacts` on the finished search for the latter.
+
+Example:
+    python -m model_creation.model_search.monitor --wd ./outputs/forecast_freqs --html progress.html
+"""
+
+import os
+import io
+import csv
+import sys
+import time
+import argparse
+from collections import deque
+import numpy as np
+
+TAIL_BYTES = 256  # bytes before the read offset compared at every update, to notice a file rewritten in place
+
+
+def layer_token_positions(n_tokens):
+    """Positions of the operation tokens in an architecture sequence of `n_tokens` tokens, where layer i has one
+    operation token followed by i skip-connection tokens
+    """
+    positions, pos, layer = [], 0, 0
+    while pos < n_tokens:
+        positions.append(pos)
+        pos += 1 + layer
+        layer += 1
+    return positions
+
+
+def entropy(counts):
+    """Shannon entropy in bits of a vector of counts"""
+    p = np.asarray(counts, dtype=np.float64)
+    p = p[p > 0] / p.sum()
+    return float(-(p * np.log2(p)).sum())
+
+
+class SearchMonitor:
+    """Rolling statistics over a growing `train_history.csv`
+
+    Parameters
+    ----------
+    wd : str
+        working directory of the search
+    window : int
+        number of most recent trials for the reward moving average and the operation entropy
+    steps_per_episode : int
+        trials per controller episode, see `max_step_per_ep` in `amber_cnn_sumstats.main`
+    """
+
+    def __init__(self, wd, window=100, steps_per_episode=100):
+        self.fp = os.path.join(wd, 'train_history.csv')
+        self.window = window
+        self.steps_per_episode = steps_per_episode
+        self.reset()
+
+    def reset(self):
+        self.inode = None
+        self.offset = 0
+        self.tail = b''  # last bytes read, up to TAIL_BYTES
+        self.partial = ''
+        self.n_trials = 0
+        self.last_trial = -1
+        self.best_reward = -np.inf
+        self.best_arc = None
+        self.rewards = deque()
+        self.reward_sum = 0.
+        self.ops = deque()  # operation tokens of the trials in the window
+        self.op_counts = None  # layer x operation counts over the window
+        self.rate_samples = deque(maxlen=10)  # (time, trials) at refreshes, for episodes/hour
+
+    @staticmethod
+    def _parse(row):
+        trial, reward, arc = int(row[0]), float(row[2]), [int(a) for a in row[3:]]
+        if not arc:
+            raise ValueError("no architecture tokens in row %s" % row)
+        return trial, reward, arc
+
+    def _add(self, trial, reward, arc):
+        self.n_trials += 1
+        self.last_trial = trial
+        if reward > self.best_reward:
+            self.best_reward, self.best_arc = reward, arc
+        self.rewards.append(reward)
+        self.reward_sum += reward
+        ops = [arc[i] for i in layer_token_positions(len(arc))]
+        if self.op_counts is None:
+            self.op_counts = np.zeros((len(ops), 1), dtype=int)
+        if max(ops) >= self.op_counts.shape[1]:
+            self.op_counts = np.pad(self.op_counts, ((0, 0), (0, max(ops) + 1 - self.op_counts.shape[1])))
+        self.op_counts[np.arange(len(ops)), ops] += 1
+        self.ops.append(ops)
+        if len(self.rewards) > self.window:
+            self.reward_sum -= self.rewards.popleft()
+            old = self.ops.popleft()
+            self.op_counts[np.arange(len(old)), old] -= 1
+
+    def _read(self):
+        # parse the rows appended since the last read; False if the file was rewritten since, e.g. by a new or
+        # resumed search: replaced, truncated, changed before the read offset, or no longer parseable there
+        stat = os.stat(self.fp)
+        if self.inode is not None and (stat.st_ino != self.inode or stat.st_size < self.offset):
+            return False
+        resumed = self.offset > 0
+        with open(self.fp, 'rb') as f:
+            f.seek(self.offset - len(self.tail))
+            chunk = f.read()
+        if not chunk.startswith(self.tail):
+            return False
+        chunk = chunk[len(self.tail):]
+        self.inode = stat.st_ino
+        self.offset += len(chunk)
+        self.tail = (self.tail + chunk)[-TAIL_BYTES:]
+        text = self.partial + chunk.decode()
+        lines_end = text.rfind('\n') + 1
+        self.partial = text[lines_end:]  # keep an incompletely written row for the next update
+        for row in csv.reader(io.StringIO(text[:lines_end])):
+            if not row:
+                continue
+            try:
+                trial, reward, arc = self._parse(row)
+            except (ValueError, IndexError):
+                if resumed:
+                    return False
+                continue  # e.g. a header, in a file read from its start
+            self._add(trial, reward, arc)
+        return True
+
+    def update(self):
+        """Read the rows appended since the last update; returns the number of new trials, or of all trials if the
+        file was rewritten and read again from its start"""
+        if not os.path.isfile(self.fp):
+            return 0
+        n_before = self.n_trials
+        if not self._read():
+            self.reset()
+            n_before = 0
+            self._read()
+        self.rate_samples.append((time.time(), self.n_trials))
+        return self.n_trials - n_before
+
+    def stats(self):
+        """Current statistics as a dict"""
+        (t0, n0), (t1, n1) = self.rate_samples[0], self.rate_samples[-1]
+        episodes_per_hour = (n1 - n0) / self.steps_per_episode / (t1 - t0) * 3600. if t1 > t0 else float('nan')
+        layer_entropy = [entropy(c) for c in self.op_counts] if self.op_counts is not None else []
+        return {
+            'trials': self.n_trials,
+            'episode': (self.last_trial + 1) // self.steps_per_episode,
+            'best_reward': self.best_reward,
+            'best_arc': self.best_arc,
+            'reward_moving_avg': self.reward_sum / len(self.rewards) if self.rewards else float('nan'),
+            'episodes_per_hour': episodes_per_hour,
+            'layer_entropy': layer_entropy,
+        }
+
+    def render_text(self):
+        s = self.stats()
+        lines = [
+            "search: %s" % self.fp,
+            "episode %i (%i trials), %.2f episodes/hour" % (s['episode'], s['trials'], s['episodes_per_hour']),
+            "best reward %.5f, moving average (last %i) %.5f" % (
+                s['best_reward'], self.window, s['reward_moving_avg']),
+            "best arc: %s" % (",".join(map(str, s['best_arc'])) if s['best_arc'] else None),
+            "operation entropy (bits) by layer: %s" % " ".join("L%i=%.2f" % (i, e)
+                                                               for i, e in enumerate(s['layer_entropy'])),
+        ]
+        return "\n".join(lines)
+
+    def render_html(self, refresh=60):
+        s = self.stats()
+        rows = [("episode", s['episode']), ("trials", s['trials']),
+                ("episodes/hour", "%.2f" % s['episodes_per_hour']),
+                ("best reward", "%.5f" % s['best_reward']),
+                ("reward moving average (last %i)" % self.window, "%.5f" % s['reward_moving_avg']),
+                ("best arc", ",".join(map(str, s['best_arc'])) if s['best_arc'] else None)]
+        rows += [("L%i operation entropy (bits)" % i, "%.3f" % e) for i, e in enumerate(s['layer_entropy'])]
+        return ("<html><head><meta http-equiv=\"refresh\" content=\"%i\"><title>AMBER search</title></head><body>\n"
+                "<h3>%s</h3><p>updated %s</p>\n<table>\n%s\n</table></body></html>\n" % (
+                    refresh, self.fp, time.strftime("%Y-%m-%d %H:%M:%S"),
+                    "\n".join("<tr><td>%s</td><td>%s</td></tr>" % row for row in rows)))
+
+
+def main(wd, interval=60, window=100, steps_per_episode=100, html=None, once=False):
+    """Refresh a terminal (or static html) report of the search in `wd` every `interval` seconds"""
+    monitor = SearchMonitor(wd, window=window, steps_per_episode=steps_per_episode)
+    while True:
+        monitor.update()
+        if monitor.n_trials:
+            if html is not None:
+                with open(html + '.tmp', 'w') as f:
+                    f.write(monitor.render_html(refresh=interval))
+                os.replace(html + '.tmp', html)
+            else:
+                if sys.stdout.isatty():
+                    sys.stdout.write("\033[2J\033[H")  # clear the screen
+                print(monitor.render_text(), flush=True)
+        if once:
+            return monitor
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Monitor an AMBER search for CROTON')
+    parser.add_argument("--wd", type=str, required=True, help="working dir of the search")
+    parser.add_argument("--interval", type=int, default=60, help="seconds between refreshes")
+    parser.add_argument("--window", type=int, default=100, help="trials for moving averages")
+    parser.add_argument("--steps-per-episode", type=int, default=100, help="trials per controller episode")
+    parser.add_argument("--html", type=str, default=None, help="write a static html report here instead")
+    parser.add_argument("--once", action='store_true', help="refresh once and exit")
+    args = parser.parse_args()
+
+    main(args.wd, interval=args.interval, window=args.window, steps_per_episode=args.steps_per_episode,
+         html=args.html, once=args.once)
@@ -0,0 +1,137 @@
+"""Keras callback recording where training time goes
+
+Per epoch, `TrainingProfiler` records wall time split into training (batch compute), data-loading stalls (time the
+training loop waited between batches, i.e. for the next batch from the `OneHotSequence` queue), validation and
+checkpoint saving, along with training samples/sec and the peak RSS of the process. Checkpoint time is measured by
+`TimedModelCheckpoint`, a `ModelCheckpoint` that reports to the profiler; list the profiler after the other
+callbacks, so that their epoch-end work is included in the epoch.
+"""
+
+import os
+import time
+import resource
+import pandas as pd
+from tensorflow.keras.callbacks import Callback, ModelCheckpoint
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class TrainingProfiler(Callback):
+    """Per-epoch time breakdown and throughput, written as a TSV
+
+    Parameters
+    ----------
+    n_samples : int
+        number of training samples per epoch, for samples/sec
+    out_fp : str, or None
+        TSV to (re)write at the end of every epoch
+    """
+
+    def __init__(self, n_samples, out_fp=None):
+        super().__init__()
+        self.n_samples = n_samples
+        self.out_fp = out_fp
+        self.rows = []
+        self.checkpoint_time = 0.
+
+    def on_epoch_begin(self, epoch, logs=None):
+        now = time.time()
+        self.epoch_start = now
+        self.last_batch_end = now
+        self.train_time = 0.
+        self.stall_time = 0.
+        self.val_time = 0.
+        self.checkpoint_time = 0.
+        self.val_start = None
+
+    def on_train_batch_begin(self, batch, logs=None):
+        now = time.time()
+        self.stall_time += now - self.last_batch_end
+        self.batch_start = now
+
+    def on_train_batch_end(self, batch, logs=None):
+        now = time.time()
+        self.train_time += now - self.batch_start
+        self.last_batch_end = now
+
+    # older keras versions only call the mode-less batch hooks
+    on_batch_begin = on_train_batch_begin
+    on_batch_end = on_train_batch_end
+
+    def on_test_begin(self, logs=None):
+        self.val_start = time.time()
+
+    def on_test_end(self, logs=None):
+        self.val_time += time.time() - self.val_start
+
+    def on_epoch_end(self, epoch, logs=None):
+        wall = time.time() - self.epoch_start
+        if self.val_start is None:  # validation hooks not called; attribute what is left of the epoch
+            self.val_time = max(0., wall - self.train_time - self.stall_time - self.checkpoint_time)
+        self.rows.append({
+            'epoch': epoch,
+            'wall_time': wall,
+            'train_time': self.train_time,
+            'stall_time': self.stall_time,
+            'val_time': self.val_time,
+            'checkpoint_time': self.checkpoint_time,
+            'samples_per_sec': self.n_samples / self.train_time if self.train_time > 0 else float('nan'),
+            'peak_rss_mb': _peak_rss_mb(),
+        })
+        if self.out_fp is not None:
+            self.to_frame().to_csv(self.out_fp, sep="\t", index=False)
+
+    def to_frame(self):
+        return pd.DataFrame(self.rows)
+
+    def summary(self):
+        """One-line summary over all epochs"""
+        df = self.to_frame()
+        if not len(df):
+            return "no epochs profiled"
+        total = df['wall_time'].sum()
+        return ("%i epochs in %.1f min, %.0f samples/sec; train %.1f%%, data stall %.1f%%, validation %.1f%%, "
+                "checkpoint %.1f%%; peak RSS %.0f MB" % (
+                    len(df), total / 60., df['samples_per_sec'].median(), 100. * df['train_time'].sum() / total,
+                    100. * df['stall_time'].sum() / total, 100. * df['val_time'].sum() / total,
+                    100. * df['checkpoint_time'].sum() / total, df['peak_rss_mb'].max()))
+
+
+class TimedModelCheckpoint(ModelCheckpoint):
+    """`ModelCheckpoint` reporting the time spent saving to a `TrainingProfiler`"""
+
+    def __init__(self, filepath, profiler, **kwargs):
+        super().__init__(filepath, **kwargs)
+        self.profiler = profiler
+
+    def on_epoch_end(self, epoch, logs=None):
+        start = time.time()
+        super().on_epoch_end(epoch, logs)
+        self.profiler.checkpoint_time += time.time() - start
+
+
+def plot_time_breakdown(profiler, par_dir):
+    """Stacked per-epoch time breakdown, next to the 'loss.png' of `amber.plots.plot_training_history`, with the
+    profiler summary as its title
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    df = profiler.to_frame()
+    if not len(df):
+        return
+    fig, ax = plt.subplots(figsize=(8, 4))
+    bottom = 0
+    for col, label in (('train_time', 'train'), ('stall_time', 'data stall'), ('val_time', 'validation'),
+                       ('checkpoint_time', 'checkpoint')):
+        ax.bar(df['epoch'], df[col], bottom=bottom, label=label, width=0.9)
+        bottom = bottom + df[col]
+    ax.set_xlabel('epoch')
+    ax.set_ylabel('seconds')
+    ax.legend(loc='upper right')
+    ax.set_title(profiler.summary(), fontsize=7)
+    fig.tight_layout()
+    fig.savefig(os.path.join(par_dir, 'time_breakdown.png'))
+    plt.close(fig)
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Train a collection of randomly sampled architectures in parallel, as the background performance distribution
+read by `get_randomized_distr.read_bg`
+
+Equivalent to many `amber_cnn_sumstats.py --mode random` runs: K architectures are sampled up front from a
+seeded RNG, then trained concurrently on a pool of CPU processes. Each process gets an equal share of the cores
+for TensorFlow's intra-/inter-op thread pools, so workers do not oversubscribe the machine. Every architecture
+writes its `metrics.txt` (and predictions) to `<out_dir>/arc_<k>/`; with `--data-dir` the workers share the
+memory-mapped data shards instead of each holding a copy of the pickles.
+
+With `--scheduler halving`, the architectures are screened by successive halving instead: all of them train for
+a few epochs, the best 1/eta by validation loss (or mean Spearman correlation) continue from their weights for eta
+times as many epochs, and so on until only the finalists are left, which are trained to convergence. The
+finalists are the best of the sample rather than a random sample, so they are written to '<wd>/random_halving'
+by default.
+
+To spread a collection over several nodes, queue its architectures on a shared filesystem with `work_queue.py`.
+
+Example:
+    python -m model_creation.model_search.random_collection --wd ./outputs/forecast_freqs --dataset forecast \\
+        --tasks del_freq 1ins_freq 1del_freq onemod3_freq twomod3_freq frameshift_freq --num-arcs 50 --workers 8
+"""
+
+import os
+import math
+import time
+import pickle
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from model_creation.model_search.arch_cache import ArchCache, fingerprint, restore_result
+from model_creation.model_search.autotune import set_tf_threads
+from model_creation.model_search.results_store import ResultsStore, db_path
+
+_worker = {}
+
+
+def _init_worker(wd, dataset, tasks, data_dir, intra_threads, inter_threads, hide_gpus):
+    os.environ['OMP_NUM_THREADS'] = str(intra_threads)
+    if hide_gpus:
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    set_tf_threads(intra_threads, inter_threads)
+    from model_creation.model_search.amber_cnn_sumstats import load_data, get_final_model_builder
+    model_space = pickle.load(open(os.path.join(wd, "model_space.pkl"), "rb"))
+    _worker.update({
+        'data': load_data(dataset, tasks, data_dir=data_dir),
+        'model_space': model_space,
+        'tasks': tasks,
+        'threads': (intra_threads, inter_threads),
+        'get_builder': get_final_model_builder,
+    })
+
+
+def _new_builder():
+    from tensorflow.keras import backend as K
+    K.clear_session()  # drop the previous architecture's graph
+    set_tf_threads(*_worker['threads'])
+    return _worker['get_builder'](_worker['model_space'], _worker['tasks'])
+
+
+def _train_one(k, arc, wd_, epochs, patience, verbose, cache_dir, cache_key):
+    from model_creation.model_search.amber_cnn_sumstats import train_and_evaluate
+    kmb = _new_builder()
+    start = time.time()
+    os.makedirs(wd_, exist_ok=True)
+    with open(os.path.join(wd_, "arc.txt"), "w") as f:
+        f.write(",".join(map(str, arc)))
+    train_data, val_data, test_data = _worker['data']
+    metrics, history = train_and_evaluate(arc, kmb, wd_, train_data, val_data, test_data, _worker['tasks'],
+                                          epochs=epochs, patience=patience, verbose=verbose,
+                                          cache=ArchCache(cache_dir) if cache_dir else None, cache_key=cache_key,
+                                          return_history=True)
+    n_epochs = len(history['loss']) if history is not None else 0
+    return k, time.time() - start, metrics, n_epochs
+
+
+def _train_rung(k, arc, weights_fp, initial_epoch, epochs, child_batchsize, verbose):
+    # continue training from the previous rung's weights up to `epochs`, then score on the validation data
+    from model_creation.model_search.data_loader import OneHotSequence, predict_onehot
+    from model_creation.model_evaluation.metrics import spearman
+    kmb = _new_builder()
+    start = time.time()
+    model = kmb(model_states=arc)
+    if initial_epoch > 0:
+        model.load_weights(weights_fp)
+    train_data, val_data, _ = _worker['data']
+    model.fit(OneHotSequence(train_data[0], train_data[1], batch_size=child_batchsize, shuffle=True),
+              epochs=epochs, initial_epoch=initial_epoch, verbose=verbose)
+    model.save_weights(weights_fp)
+    val_loss = np.atleast_1d(model.evaluate(OneHotSequence(val_data[0], val_data[1], batch_size=child_batchsize),
+                                            verbose=0))[0]
+    pred = predict_onehot(model, val_data[0])
+    return k, float(val_loss), float(np.nanmean(spearman(val_data[1], pred))), time.time() - start
+
+
+def sample_arcs(model_space, num_arcs, seed=None):
+    """Sample all architectures up front, so a collection only depends on the seed and not on scheduling"""
+    from model_creation.model_search.amber_cnn_sumstats import random_sample_controller
+    np.random.seed(seed)
+    return [random_sample_controller(skip_target=25 / 28, model_space=model_space) for _ in range(num_arcs)]
+
+
+def make_pool(wd, dataset, tasks, n_workers=1, data_dir=None, threads=None, hide_gpus=True):
+    """Spawn `n_workers` training processes that each load the data once and get an equal share of `threads`"""
+    threads = threads or os.cpu_count()
+    intra_threads = max(1, threads // n_workers)
+    inter_threads = 2 if intra_threads >= 4 else 1
+    print("[random] %i workers x %i intra-op / %i inter-op threads" % (n_workers, intra_threads, inter_threads))
+    return ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_worker,
+                               initargs=(wd, dataset, tasks, data_dir, intra_threads, inter_threads, hide_gpus))
+
+
+def train_full(pool, arcs, out_dir, model_space, tasks, config, epochs=500, patience=50, verbose=0, cache=None,
+               store=None, mode='random'):
+    """Train architectures to convergence on a worker pool, each distinct architecture only once
+
+    Parameters
+    ----------
+    pool : concurrent.futures.ProcessPoolExecutor
+        training processes, see `make_pool`
+    arcs : dict
+        architecture id -> tokens; outputs go to '<out_dir>/arc_<id>/'
+    out_dir : str
+        output directory
+    model_space : amber.architect.ModelSpace
+        the model space the tokens index into
+    tasks : list of str
+        list of task identifiers
+    config : dict
+        training configuration, see `amber_cnn_sumstats.get_train_config`
+    epochs, patience, verbose :
+        see `amber_cnn_sumstats.train_and_evaluate`
+    cache : arch_cache.ArchCache, or None
+        results already in the cache are restored instead of trained; repeats within `arcs` wait for the first
+        one to finish
+    store : results_store.ResultsStore, or None
+        record every architecture in this store as they finish
+    mode : str
+        mode the architectures are recorded under; 'random' for a random sample, 'halving' for finalists
+
+    Returns
+    -------
+    rows : list of dict
+        per architecture: id, tokens, wall time (s), epochs trained and validation/test Pearson correlations
+    """
+    keys = {k: fingerprint(model_space, arc, tasks, config) for k, arc in arcs.items()} if cache is not None else {}
+    rows, scheduled, repeats, cached = [], {}, [], {}
+    for k in arcs:
+        if cache is None:
+            scheduled[k] = k
+        elif keys[k] in scheduled:
+            repeats.append(k)
+        else:
+            record = cache.get(keys[k])
+            if record is not None:
+                cached[k] = record
+            else:
+                scheduled[keys[k]] = k
+
+    def add_row(k, wall, metrics, n_epochs):
+        row = {'arc_id': k, 'arc': ','.join(map(str, arcs[k])), 'wall_time': wall, 'epochs': n_epochs}
+        row.update(metrics)
+        rows.append(row)
+        if store is not None:
+            store.record_run(os.path.join(out_dir, 'arc_%04i' % k), mode, metrics, dataset=config['data'],
+                             arc=arcs[k], args=config, wall_time=wall, epochs=n_epochs)
+
+    def restore(k, record):
+        restore_result(record, os.path.join(out_dir, 'arc_%04i' % k))
+        add_row(k, 0., record['metrics'], 0)
+
+    for k, record in cached.items():
+        restore(k, record)
+    start = time.time()
+    n_trained = 0
+    futures = [pool.submit(_train_one, k, arcs[k], os.path.join(out_dir, 'arc_%04i' % k), epochs, patience,
+                           verbose, cache.cache_dir if cache is not None else None, keys.get(k))
+               for k in scheduled.values()]
+    for future in as_completed(futures):
+        k, wall, metrics, n_epochs = future.result()
+        add_row(k, wall, metrics, n_epochs)
+        n_trained += 1
+        elapsed = time.time() - start
+        print("[random] arc_%04i done in %.1f min; %i/%i trained, %.2f architectures/hour" % (
+            k, wall / 60., n_trained, len(scheduled), n_trained / elapsed * 3600.), flush=True)
+    for k in repeats:
+        restore(k, cache.get(keys[k]))
+    if n_trained:
+        print("[random] %i architectures trained in %.2f hours: %.2f architectures/hour" % (
+            n_trained, (time.time() - start) / 3600., n_trained / (time.time() - start) * 3600.))
+    return rows
+
+
+def main(wd, dataset, tasks, num_arcs, n_workers=1, seed=None, out_dir=None, data_dir=None, threads=None,
+         epochs=500, patience=50, verbose=0, hide_gpus=True, use_cache=True, cache_dir=None, results_db=None):
+    """Sample and train `num_arcs` random architectures on `n_workers` processes
+
+    Parameters
+    ----------
+    wd : str
+        working directory of the search, holding "model_space.pkl"
+    dataset : str
+        dataset identifier, see `amber_cnn_sumstats.load_data`
+    tasks : list of str
+        list of task identifiers
+    num_arcs : int
+        number of architectures to sample and train
+    n_workers : int
+        number of training processes
+    seed : int, or None
+        seed for sampling the architectures; the same seed gives the same collection
+    out_dir : str, or None
+        output directory; defaults to '<wd>/random_collections.denseResConn', the layout `read_bg` reads
+    data_dir : str, or None
+        shard directory to stream data from, see `amber_cnn_sumstats.load_data`
+    threads : int, or None
+        total number of CPU threads to split among workers; defaults to all cores
+    epochs : int
+        maximum number of epochs per architecture
+    patience : int
+        early stopping patience
+    verbose : int
+        keras verbosity within workers
+    hide_gpus : bool
+        train on CPU only, so that concurrent workers do not contend for one GPU
+    use_cache : bool
+        train each distinct architecture (under the same training configuration) only once, reusing earlier
+        results from the architecture cache, see `arch_cache`
+    cache_dir : str, or None
+        architecture cache directory; defaults to '<wd>/arch_cache', shared with `amber_cnn_sumstats.main`
+    results_db : str, or None
+        results store the architectures are recorded in; defaults to '<wd>/results.sqlite', see `results_store`
+
+    Returns
+    -------
+    summary : pandas.DataFrame
+        per architecture: id, tokens, wall time (s), epochs and validation/test Pearson correlations; also
+        written to '<out_dir>/summary.tsv', merged with the rows an earlier run wrote there
+    """
+    from model_creation.model_search.amber_cnn_sumstats import get_train_config
+    out_dir = out_dir or os.path.join(wd, 'random_collections.denseResConn')
+    os.makedirs(out_dir, exist_ok=True)
+    model_space = pickle.load(open(os.path.join(wd, "model_space.pkl"), "rb"))
+    arcs = sample_arcs(model_space, num_arcs, seed=seed)
+    todo = {k: arcs[k] for k in range(num_arcs)
+            if not os.path.isfile(os.path.join(out_dir, 'arc_%04i' % k, 'metrics.txt'))}
+    if len(todo) < num_arcs:
+        print("[random] %i of %i architectures already trained, skipping them" % (num_arcs - len(todo), num_arcs))
+
+    cache = ArchCache(cache_dir or os.path.join(wd, 'arch_cache')) if use_cache else None
+    config = get_train_config(dataset, data_dir=data_dir, epochs=epochs, patience=patience)
+    with make_pool(wd, dataset, tasks, n_workers=n_workers, data_dir=data_dir, threads=threads,
+                   hide_gpus=hide_gpus) as pool, ResultsStore(db_path(wd, results_db)) as store:
+        rows = train_full(pool, todo, out_dir, model_space, tasks, config, epochs=epochs, patience=patience,
+                          verbose=verbose, cache=cache, store=store)
+
+    summary_fp = os.path.join(out_dir, "summary.tsv")
+    summary = pd.DataFrame(rows)
+    if len(todo) < num_arcs and os.path.isfile(summary_fp):  # keep the rows of the architectures skipped above
+        try:
+            previous = pd.read_csv(summary_fp, sep="\t", dtype={'arc': str})
+            summary = pd.concat([previous[~previous['arc_id'].isin(list(todo))], summary], ignore_index=True)
+        except pd.errors.EmptyDataError:
+            pass
+    if len(summary):
+        summary = summary.sort_values('arc_id').reset_index(drop=True)
+    summary.to_csv(summary_fp, sep="\t", index=False)
+    if cache is not None:
+        print("[random] %s" % cache.report())
+    return summary
+
+
+def successive_halving(wd, dataset, tasks, num_arcs, n_workers=1, seed=None, out_dir=None, data_dir=None,
+                       threads=None, min_epochs=5, eta=3, num_finalists=None, score='val_loss', epochs=500,
+                       patience=50, child_batchsize=512, verbose=0, hide_gpus=True, use_cache=True, cache_dir=None,
+                       results_db=None):
+    """Screen `num_arcs` random architectures by successive halving, and only train the finalists to convergence
+
+    Rung r trains the surviving architectures up to min_epochs * eta**r epochs, resuming from their weights of the
+    previous rung (the optimizer state is not kept), and keeps the best 1/eta of them.
+
+    Parameters
+    ----------
+    wd, dataset, tasks, num_arcs, n_workers, seed, data_dir, threads, verbose, hide_gpus, use_cache, cache_dir,
+    results_db :
+        see `main`; only the finalists are recorded in the results store, as 'halving' runs
+    out_dir : str, or None
+        output directory; defaults to '<wd>/random_halving'
+    min_epochs : int
+        epoch budget of the first rung
+    eta : int
+        reduction factor between rungs
+    num_finalists : int, or None
+        number of architectures to train to convergence; defaults to num_arcs // eta**3, and at least 1
+    score : str
+        ranking within rungs: 'val_loss' (lower is better) or 'spearman', the mean Spearman correlation over tasks
+        on the validation data (higher is better)
+    epochs, patience : int
+        maximum number of epochs and early stopping patience of the finalists; rungs never exceed `epochs`
+    child_batchsize : int
+        training batch size within rungs
+
+    Returns
+    -------
+    summary : pandas.DataFrame
+        the finalists, as in `main`; also written to '<out_dir>/summary.tsv', and the rung scores of all
+        architectures to '<out_dir>/rungs.tsv'
+    """
+    from model_creation.model_search.amber_cnn_sumstats import get_train_config
+    if score not in ('val_loss', 'spearman'):
+        raise ValueError("Unknown score: %s" % score)
+    out_dir = out_dir or os.path.join(wd, 'random_halving')
+    rung_dir = os.path.join(out_dir, 'rungs')
+    os.makedirs(rung_dir, exist_ok=True)
+    model_space = pickle.load(open(os.path.join(wd, "model_space.pkl"), "rb"))
+    arcs = sample_arcs(model_space, num_arcs, seed=seed)
+    num_finalists = num_finalists or max(1, num_arcs // eta ** 3)
+
+    cache = ArchCache(cache_dir or os.path.join(wd, 'arch_cache')) if use_cache else None
+    config = get_train_config(dataset, data_dir=data_dir, epochs=epochs, patience=patience)
+    survivors = list(range(num_arcs))
+    rung_rows, rung_epochs, rung_wall = [], 0, 0.
+    start = time.time()
+    with make_pool(wd, dataset, tasks, n_workers=n_workers, data_dir=data_dir, threads=threads,
+                   hide_gpus=hide_gpus) as pool:
+        rung, prev_budget, budget = 0, 0, min(min_epochs, epochs)
+        while len(survivors) > num_finalists and prev_budget < epochs:
+            futures = [pool.submit(_train_rung, k, arcs[k], os.path.join(rung_dir, 'arc_%04i.h5' % k), prev_budget,
+                                   budget, child_batchsize, verbose) for k in survivors]
+            scores = {}
+            for future in as_completed(futures):
+                k, val_loss, spearman, wall = future.result()
+                # a collapsed model (constant predictions, diverged loss) gets NaN, ranked as the worst score
+                scores[k] = np.nan_to_num(val_loss if score == 'val_loss' else -spearman, nan=np.inf)
+                rung_wall += wall
+                rung_rows.append({'rung': rung, 'arc_id': k, 'epochs': budget, 'val_loss': val_loss,
+                                  'spearman': spearman, 'wall_time': wall})
+            rung_epochs += (budget - prev_budget) * len(survivors)
+            n_keep = max(num_finalists, int(math.ceil(len(survivors) / float(eta))))
+            print("[halving] rung %i: %i architectures trained to %i epochs, keeping %i" % (
+                rung, len(survivors), budget, n_keep), flush=True)
+            survivors = sorted(survivors, key=lambda k: scores[k])[:n_keep]
+            rung, prev_budget, budget = rung + 1, budget, min(budget * eta, epochs)
+        pd.DataFrame(rung_rows).to_csv(os.path.join(out_dir, "rungs.tsv"), sep="\t", index=False)
+
+        with ResultsStore(db_path(wd, results_db)) as store:
+            rows = train_full(pool, {k: arcs[k] for k in survivors}, out_dir, model_space, tasks, config,
+                              epochs=epochs, patience=patience, verbose=verbose, cache=cache, store=store,
+                              mode='halving')
+
+    summary = pd.DataFrame(rows).sort_values('arc_id')
+    summary.to_csv(os.path.join(out_dir, "summary.tsv"), sep="\t", index=False)
+    print("[halving] %i architectures screened, %i finalists, %.2f hours" % (
+        num_arcs, len(survivors), (time.time() - start) / 3600.))
+
+    # compute saved, estimated against training all sampled architectures like the (non-cached) finalists
+    trained = summary[summary['epochs'] > 0]
+    if len(trained):
+        used_epochs = rung_epochs + trained['epochs'].sum()
+        used_wall = rung_wall + trained['wall_time'].sum()
+        full_epochs = trained['epochs'].mean() * num_arcs
+        full_wall = trained['wall_time'].mean() * num_arcs
+        print("[halving] %i epochs trained vs. ~%i to train all architectures (%.1f%% saved)" % (
+            used_epochs, full_epochs, 100. * (1 - used_epochs / full_epochs)))
+        print("[halving] %.2f worker hours vs. ~%.2f to train all architectures (%.1f%% saved)" % (
+            used_wall / 3600., full_wall / 3600., 100. * (1 - used_wall / full_wall)))
+    if cache is not None:
+        print("[halving] %s" % cache.report())
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Train random architectures in parallel for CROTON')
+    parser.add_argument("--wd", type=str, required=True, help="working dir with model_space.pkl")
+    parser.add_argument("--dataset", type=str, choices=['all', 'forecast', 'sprout'], help="training dataset")
+    parser.add_argument("--tasks", type=str, nargs='+',
+                        choices=['del_freq', '1ins_freq', '1del_freq', 'frameshift_freq',
+                                 'onemod3_freq', 'twomod3_freq',
+                                 'avgdel_len', 'avgins_len', 'entropy'],
+                        help="tasks of interest")
+    parser.add_argument("--num-arcs", type=int, required=True, help="number of architectures to sample")
+    parser.add_argument("--workers", type=int, default=1, help="number of training processes")
+    parser.add_argument("--threads", type=int, default=None, help="total CPU threads to split among workers")
+    parser.add_argument("--seed", type=int, default=None, help="seed for sampling architectures")
+    parser.add_argument("--out-dir", type=str, default=None,
+                        help="output dir; default <wd>/random_collections.denseResConn, or <wd>/random_halving")
+    parser.add_argument("--data-dir", type=str, default=None, help="stream train/val/test shards from this directory")
+    parser.add_argument("--epochs", type=int, default=500, help="maximum epochs per architecture")
+    parser.add_argument("--patience", type=int, default=50, help="early stopping patience")
+    parser.add_argument("--cache-dir", type=str, default=None, help="architecture cache dir; default <wd>/arch_cache")
+    parser.add_argument("--no-cache", action='store_true', help="retrain architectures even if cached")
+    parser.add_argument("--results-db", type=str, default=None, help="results store; default <wd>/results.sqlite")
+    parser.add_argument("--scheduler", type=str, choices=['full', 'halving'], default='full',
+                        help="train all architectures to convergence, or screen them by successive halving")
+    parser.add_argument("--min-epochs", type=int, default=5, help="halving: epochs of the first rung")
+    parser.add_argument("--eta", type=int, default=3, help="halving: keep the best 1/eta per rung")
+    parser.add_argument("--num-finalists", type=int, default=None, help="halving: architectures to fully train")
+    parser.add_argument("--score", type=str, choices=['val_loss', 'spearman'], default='val_loss',
+                        help="halving: validation score to rank architectures by")
+    args = parser.parse_args()
+
+    kwargs = dict(wd=args.wd, dataset=args.dataset, tasks=args.tasks, num_arcs=args.num_arcs,
+                  n_workers=args.workers, seed=args.seed, out_dir=args.out_dir, data_dir=args.data_dir,
+                  threads=args.threads, epochs=args.epochs, patience=args.patience, use_cache=not args.no_cache,
+                  cache_dir=args.cache_dir, results_db=args.results_db)
+    if args.scheduler == 'halving':
+        successive_halving(min_epochs=args.min_epochs, eta=args.eta, num_finalists=args.num_finalists,
+                           score=args.score, **kwargs)
+    else:
+        main(**kwargs)
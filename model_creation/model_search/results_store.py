@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+SQLite store of the results of all train/random runs, so collections are queried instead of re-parsed
+
+Every run finished by `amber_cnn_sumstats.main` (train and random mode) and `random_collection.py` is recorded in
+'<wd>/results.sqlite' with its working dir, mode, dataset, architecture tokens, arguments and timings, and one row
+per (split, task, metric) with the value and bootstrap confidence interval, if any. Metrics are indexed by task, mode
+and split. Runs that only have a 'metrics.txt' (e.g. from before the store existed, or trained by `work_queue.py`
+workers) are imported with `import_runs`.
+
+SQLite locks the database file for writers; on a shared filesystem without reliable locking, give every node its
+own database, or record runs from one process only (as `random_collection.py` does, and why `work_queue.py` workers
+leave recording to `import_runs`).
+
+Example:
+    python -m model_creation.model_search.results_store --wd ./outputs/forecast_freqs --import-runs \\
+        --mode random --split TEST
+"""
+
+import os
+import json
+import time
+import sqlite3
+import argparse
+import pandas as pd
+
+DEFAULT_DB = 'results.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    wd TEXT UNIQUE NOT NULL,
+    mode TEXT,
+    dataset TEXT,
+    arc TEXT,
+    args TEXT,
+    wall_time REAL,
+    epochs INTEGER,
+    recorded_at REAL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    run_id INTEGER NOT NULL REFERENCES runs(run_id) ON DELETE CASCADE,
+    split TEXT NOT NULL,
+    task TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    ci_low REAL,
+    ci_high REAL,
+    PRIMARY KEY (run_id, split, task, metric)
+);
+CREATE INDEX IF NOT EXISTS runs_mode ON runs (mode);
+CREATE INDEX IF NOT EXISTS metrics_task_split ON metrics (task, split, metric);
+"""
+
+# directory name of a run's parent -> mode, for runs imported from their metrics.txt
+# (successive-halving finalists are the best of their sample, so they are kept apart from the random background)
+MODE_DIRS = {'random_collections.denseResConn': 'random', 'random_halving': 'halving', 'random': 'random',
+             'train': 'train', 'distill': 'distill'}
+
+
+def db_path(wd, db_fp=None):
+    return db_fp or os.path.join(wd, DEFAULT_DB)
+
+
+def read_metrics_txt(fp):
+    """'metrics.txt' of `amber_cnn_sumstats.train_and_evaluate` as {'<split> <task>': value}"""
+    metrics = {}
+    with open(fp) as f:
+        for line in f:
+            split, name, value = line.rstrip('\n').split('\t')
+            metrics['%s %s' % (split, name.split()[0])] = float(value)
+    return metrics
+
+
+class ResultsStore:
+    """Runs and their metrics in one SQLite database
+
+    Parameters
+    ----------
+    db_fp : str
+        database file; created if it does not exist
+    timeout : float
+        seconds to wait for another writer's lock
+    """
+
+    def __init__(self, db_fp, timeout=60.):
+        self.db_fp = db_fp
+        self.conn = sqlite3.connect(db_fp, timeout=timeout)
+        self.conn.execute("PRAGMA foreign_keys = ON")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record_run(self, wd_, mode, metrics, dataset=None, arc=None, args=None, wall_time=None, epochs=None,
+                   ci=None):
+        """Add or replace the run in `wd_`
+
+        Parameters
+        ----------
+        wd_ : str
+            output directory of the run, which identifies it
+        mode : str
+            'train', 'random', 'halving', ...
+        metrics : dict
+            '<VAL|TEST> <task>' -> Pearson correlation, as returned by `train_and_evaluate`
+        dataset : str, or None
+        arc : list of int, or None
+            architecture tokens
+        args : dict, or None
+            anything else worth keeping about the run, stored as json
+        wall_time : float, or None
+            seconds
+        epochs : int, or None
+            epochs trained
+        ci : pandas.DataFrame, or None
+            confidence intervals, columns "split", "task", "ci_low" and "ci_high"; defaults to the run's
+            'metrics_ci.tsv', if any
+
+        Returns
+        -------
+        int
+            the run id
+        """
+        bounds = {}
+        ci_fp = os.path.join(wd_, 'metrics_ci.tsv')
+        if ci is None and os.path.isfile(ci_fp):
+            ci = pd.read_table(ci_fp)
+        if ci is not None:
+            bounds = {(r.split, r.task): (float(r.ci_low), float(r.ci_high)) for r in ci.itertuples()}
+        with self.conn:
+            self.conn.execute("DELETE FROM runs WHERE wd = ?", (os.path.abspath(wd_),))
+            run_id = self.conn.execute(
+                "INSERT INTO runs (wd, mode, dataset, arc, args, wall_time, epochs, recorded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(wd_), mode, dataset, ','.join(map(str, arc)) if arc is not None else None,
+                 json.dumps(args, default=repr) if args is not None else None, wall_time, epochs,
+                 time.time())).lastrowid
+            rows = []
+            for key, value in metrics.items():
+                split, task = key.split(' ', 1)
+                rows.append((run_id, split, task, 'pearson', float(value)) + bounds.get((split, task), (None, None)))
+            self.conn.executemany("INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return run_id
+
+    def run_dirs(self):
+        return set(r[0] for r in self.conn.execute("SELECT wd FROM runs"))
+
+    def import_runs(self, root, dataset=None):
+        """Record the runs below `root` that have a 'metrics.txt' but are not in the store; returns how many"""
+        known = self.run_dirs()
+        n = 0
+        for dirpath, _, filenames in os.walk(root):
+            if 'metrics.txt' not in filenames or os.path.abspath(dirpath) in known:
+                continue
+            parent = os.path.basename(os.path.dirname(os.path.abspath(dirpath)))
+            mode = MODE_DIRS.get(parent, MODE_DIRS.get(os.path.basename(dirpath)))
+            arc = None
+            if os.path.isfile(os.path.join(dirpath, 'arc.txt')):
+                with open(os.path.join(dirpath, 'arc.txt')) as f:
+                    arc = [int(a) for a in f.read().strip().split(',') if a]
+            self.record_run(dirpath, mode, read_metrics_txt(os.path.join(dirpath, 'metrics.txt')), dataset=dataset,
+                            arc=arc)
+            n += 1
+        return n
+
+    def query(self, task=None, mode=None, split=None, metric='pearson', wd_=None, parent=None):
+        """Metrics of all matching runs, in long format
+
+        Parameters
+        ----------
+        task, mode, split, metric : str, or None
+            only rows with these values
+        wd_ : str, or None
+            only the run in this directory
+        parent : str, or None
+            only runs directly below this directory, e.g. one collection
+
+        Returns
+        -------
+        pandas.DataFrame
+            columns "run_id", "wd", "mode", "dataset", "arc", "split", "task", "metric", "value", "ci_low",
+            "ci_high", "wall_time" and "epochs"
+        """
+        where, params = ["m.metric = ?"], [metric]
+        if wd_ is not None:
+            wd_ = os.path.abspath(wd_)
+        for column, value in (('m.task', task), ('r.mode', mode), ('m.split', split), ('r.wd', wd_)):
+            if value is not None:
+                where.append("%s = ?" % column)
+                params.append(value)
+        df = pd.read_sql_query(
+            "SELECT r.run_id, r.wd, r.mode, r.dataset, r.arc, m.split, m.task, m.metric, m.value, m.ci_low, "
+            "m.ci_high, r.wall_time, r.epochs FROM metrics m JOIN runs r ON m.run_id = r.run_id WHERE %s "
+            "ORDER BY r.run_id, m.split, m.task" % " AND ".join(where), self.conn, params=params)
+        if parent is not None:
+            df = df[df['wd'].map(os.path.dirname) == os.path.abspath(parent)].reset_index(drop=True)
+        return df
+
+    def table(self, mode, split='TEST', metric='pearson', parent=None):
+        """task x run matrix of a metric, e.g. the random background distribution for `get_randomized_distr`"""
+        df = self.query(mode=mode, split=split, metric=metric, parent=parent)
+        return df.pivot(index='task', columns='run_id', values='value')
+
+
+def record_result(wd, wd_, mode, metrics, db_fp=None, **kwargs):
+    """Record one run in the store of the search in `wd`, see `ResultsStore.record_run`"""
+    with ResultsStore(db_path(wd, db_fp)) as store:
+        return store.record_run(wd_, mode, metrics, **kwargs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query the results store of a CROTON search')
+    parser.add_argument("--wd", type=str, required=True, help="working dir of the search")
+    parser.add_argument("--db", type=str, default=None, help="database; default <wd>/results.sqlite")
+    parser.add_argument("--import-runs", action='store_true', help="first import runs only found as metrics.txt")
+    parser.add_argument("--task", type=str, default=None, help="only this task")
+    parser.add_argument("--mode", type=str, default=None, help="only this mode, e.g. train or random")
+    parser.add_argument("--split", type=str, choices=['VAL', 'TEST'], default=None, help="only this split")
+    parser.add_argument("--out", type=str, default=None, help="write the results to this tsv instead")
+    args = parser.parse_args()
+
+    with ResultsStore(db_path(args.wd, args.db)) as store:
+        if args.import_runs:
+            print("imported %i runs" % store.import_runs(args.wd))
+        results = store.query(task=args.task, mode=args.mode, split=args.split)
+    if args.out is not None:
+        results.to_csv(args.out, sep="\t", index=False)
+    else:
+        print(results.to_string(index=False))
@@ -0,0 +1,183 @@
+"""
+Fast summaries of AMBER search artifacts: operation selection probabilities from `weight_data.json`, and the
+best architecture in `train_history.csv`
+
+`weight_data.json` is parsed one layer at a time with `ijson` if it is installed (falling back to `json`), and
+summaries are cached in '<search dir>/summary_cache/', so they are only recomputed when the artifacts change.
+
+Example:
+    python -m model_creation.model_search.search_artifacts --sd ./outputs/forecast_freqs --od ./outputs/forecast_freqs
+"""
+
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+CACHE_DIR = 'summary_cache'
+
+
+def _cached(sd, name, sources, compute, use_cache=True):
+    # recompute unless the cached result was made from sources of the same size and modification time
+    stamp = [(os.path.basename(fp), os.path.getsize(fp), os.path.getmtime(fp)) for fp in sources]
+    cache_fp = os.path.join(sd, CACHE_DIR, '%s.pkl' % name)
+    if use_cache and os.path.isfile(cache_fp):
+        with open(cache_fp, 'rb') as f:
+            cached_stamp, result = pickle.load(f)
+        if cached_stamp == stamp:
+            return result
+    result = compute()
+    if use_cache:
+        os.makedirs(os.path.dirname(cache_fp), exist_ok=True)
+        with open(cache_fp + '.tmp', 'wb') as f:
+            pickle.dump((stamp, result), f)
+        os.replace(cache_fp + '.tmp', cache_fp)
+    return result
+
+
+def iter_weight_data(fp):
+    """Yield (layer key, layer dict) from AMBER's `weight_data.json`, holding only one layer in memory with ijson"""
+    with open(fp, 'rb') as f:
+        if ijson is not None:
+            for key, layer in ijson.kvitems(f, '', use_float=True):
+                yield key, layer
+        else:
+            for key, layer in json.load(f).items():
+                yield key, layer
+
+
+def _operation_name(k):
+    # 'conv1d_<filters>_...' -> 'conv1d_...', so the names do not depend on the number of filters
+    if k.startswith("conv"):
+        k = k.split("_")
+        k.pop(1)
+        k = "_".join(k)
+    return k
+
+
+def _action_probs(fp, last_n):
+    layers = {}
+    for key, layer in iter_weight_data(fp):
+        names = [_operation_name(k) for k in layer['operation']]
+        # time x operation, for the first run of each operation
+        probs = np.array([v[0] for v in layer['operation'].values()], dtype=np.float64).T
+        layers[int(key[1:])] = (names, probs)
+    n_ops = sum(len(names) for names, _ in layers.values())
+    layer_id = np.empty(n_ops, dtype=int)
+    layer_type = np.empty(n_ops, dtype=object)
+    prob = np.empty(n_ops)
+    prob_over_time = {}
+    i = 0
+    for lid in sorted(layers):
+        names, probs = layers[lid]
+        layer_id[i:i + len(names)] = lid
+        layer_type[i:i + len(names)] = names
+        prob[i:i + len(names)] = probs[-last_n:].mean(axis=0)
+        prob_over_time[lid] = pd.DataFrame(probs, columns=names)
+        i += len(names)
+    sum_df = pd.DataFrame({"layer_id": layer_id, "layer_type": layer_type, "prob": prob})
+    return sum_df, prob_over_time
+
+
+def action_probs(sd, last_n=50, use_cache=True):
+    """Selection probability of every operation, averaged over the last `last_n` controller steps
+
+    Parameters
+    ----------
+    sd : str
+        search directory, with `weight_data.json`
+    last_n : int
+        number of steps to average over; larger number will stabilize the probability but also might over-smooth
+    use_cache : bool
+        reuse the summary cached in '<sd>/summary_cache' if `weight_data.json` did not change
+
+    Returns
+    -------
+    sum_df : pandas.DataFrame
+        columns "layer_id", "layer_type" and "prob"
+    prob_over_time : dict
+        layer id -> DataFrame of operation probabilities (columns) over time (rows)
+    """
+    fp = os.path.join(sd, "weight_data.json")
+    return _cached(sd, 'action_probs.last%i' % last_n, [fp], lambda: _action_probs(fp, last_n), use_cache=use_cache)
+
+
+def read_train_history(fn):
+    """Read AMBER's `train_history.csv` (no header; trial, [loss and metrics], reward, architecture tokens...)
+
+    Returns
+    -------
+    trial : np.array
+    reward : np.array
+    arcs : np.array
+        trials x architecture tokens
+    """
+    d = pd.read_csv(fn, sep=",", header=None)
+    return d.iloc[:, 0].values, d.iloc[:, 2].values.astype(np.float64), d.iloc[:, 3:].values
+
+
+def best_architecture(fn, last_n=None, use_cache=True):
+    """Architecture with the best reward in a controller train history
+
+    Parameters
+    ----------
+    fn : str
+        filepath to "train_history.csv" generated by the amber controller
+    last_n : int, or None
+        only consider this many trials from the last (e.g. the number of steps per controller episode for the last
+        episode); if None, look for the best over the whole history
+    use_cache : bool
+        reuse the result cached next to `fn` if the history did not change
+
+    Returns
+    -------
+    best_arc : list of int
+        architecture tokens with the best reward; the first one if tied
+    best_reward : float
+        its reward
+    """
+    def compute():
+        trial, reward, arcs = read_train_history(fn)
+        if last_n is not None:
+            keep = trial >= trial.max() + 1 - last_n
+            reward, arcs = reward[keep], arcs[keep]
+        best = int(np.argmax(reward))
+        return [int(a) for a in arcs[best]], float(reward[best])
+    return _cached(os.path.dirname(os.path.abspath(fn)), 'best_arc.%s.last%s' % (os.path.basename(fn), last_n),
+                   [fn], compute, use_cache=use_cache)
+
+
+def dump_action_probs(sd, od, last_n=50, use_cache=True):
+    """Write 'L<i>.prob_over_time.tsv' per layer and 'selection_prob_at_convergence.tsv' to `od`; see
+    `action_probs`
+    """
+    sum_df, prob_over_time = action_probs(sd, last_n=last_n, use_cache=use_cache)
+    os.makedirs(od, exist_ok=True)
+    for lid, df in prob_over_time.items():
+        df.to_csv(os.path.join(od, "L%i.prob_over_time.tsv" % lid), sep="\t", index=False)
+    sum_df.to_csv(os.path.join(od, "selection_prob_at_convergence.tsv"), sep="\t", index=False)
+    return sum_df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize AMBER search artifacts')
+    parser.add_argument("--sd", type=str, required=True, help="search dir")
+    parser.add_argument("--od", type=str, default=None, help="output dir; default the search dir")
+    parser.add_argument("--last-n", type=int, default=50, help="controller steps to average probabilities over")
+    parser.add_argument("--last-trials", type=int, default=None, help="trials to look for the best architecture in")
+    parser.add_argument("--no-cache", action='store_true', help="recompute summaries even if cached")
+    args = parser.parse_args()
+
+    print(dump_action_probs(args.sd, args.od or args.sd, last_n=args.last_n, use_cache=not args.no_cache))
+    history_fp = os.path.join(args.sd, 'train_history.csv')
+    if os.path.isfile(history_fp):
+        best_arc, best_reward = best_architecture(history_fp, last_n=args.last_trials, use_cache=not args.no_cache)
+        print("best_arc=%s" % best_arc)
+        print("best reward=%s" % best_reward)
@@ -0,0 +1,157 @@
+"""Checkpoint and resume AMBER architecture searches
+
+A search (`amber_cnn_sumstats.py --mode search`) runs for up to 120 controller episodes in a 24h budget; without
+checkpoints, an interrupted job loses all controller progress. After every `every` episodes, `enable_checkpoints`
+saves into '<wd>/checkpoint/':
+
+- 'controller_weights.h5': controller weights, in AMBER's format
+- 'variables.*': all variables of the search session, i.e. the controller and the shared (ENAS) child weights,
+  together with their optimizer states
+- 'state.pkl': the last completed episode, the numpy/python RNG states, the controller's reward buffer, the entropy
+  record, the wall time used so far and the number of rows in 'train_history.csv'
+
+Resuming (`--resume`) cuts 'train_history.csv' back to the rows of the completed episodes, so that no trial is
+recorded twice, and continues with the next episode and the remaining time budget. TensorFlow's op-level random
+state cannot be saved, so a resumed search is a statistically, not bitwise, identical continuation.
+"""
+
+import os
+import time
+import random
+import shutil
+import pickle
+import numpy as np
+import tensorflow as tf
+
+CHECKPOINT_DIR = 'checkpoint'
+
+
+def _parse_budget(time_budget):
+    return sum(x * int(t) for x, t in zip([3600, 60, 1], time_budget.split(":")))
+
+
+def _format_budget(seconds):
+    seconds = max(1, int(seconds))  # AMBER reports the fraction of the budget used
+    return "%i:%02i:%02i" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def _count_rows(fp):
+    if not os.path.isfile(fp):
+        return 0
+    with open(fp) as f:
+        return sum(1 for _ in f)
+
+
+def load_checkpoint(wd):
+    """The state of the latest checkpoint in `wd`, or None"""
+    fp = os.path.join(wd, CHECKPOINT_DIR, 'state.pkl')
+    if not os.path.isfile(fp):
+        return None
+    with open(fp, 'rb') as f:
+        return pickle.load(f)
+
+
+def prepare_resume(wd, train_env_specs):
+    """Set up `wd` and the 'train_env' specs to resume from the latest checkpoint, before building `amber.Amber`
+
+    Parameters
+    ----------
+    wd : str
+        working directory of the search
+    train_env_specs : dict
+        the 'train_env' specs of the search; 'resume_prev_run' and 'time_budget' are updated in place
+
+    Returns
+    -------
+    state : dict, or None
+        checkpoint state to pass on to `restore_checkpoint`; None if there is no checkpoint
+    """
+    state = load_checkpoint(wd)
+    if state is None:
+        return None
+    # drop the trials of the interrupted episode; AMBER appends to the history when resuming
+    history_fp = os.path.join(wd, 'train_history.csv')
+    with open(history_fp) as f:
+        rows = f.readlines()[:state['history_rows']]
+    with open(history_fp + '.tmp', 'w') as f:
+        f.writelines(rows)
+    os.replace(history_fp + '.tmp', history_fp)
+    # AMBER loads the controller weights from the working directory when resuming
+    shutil.copyfile(os.path.join(wd, CHECKPOINT_DIR, 'controller_weights.h5'),
+                    os.path.join(wd, 'controller_weights.h5'))
+    train_env_specs['resume_prev_run'] = True
+    if 'time_budget' in train_env_specs:
+        train_env_specs['time_budget'] = _format_budget(
+            _parse_budget(train_env_specs['time_budget']) - state['elapsed'])
+    return state
+
+
+def restore_checkpoint(amb, wd, state):
+    """Restore an `amber.Amber` instance built after `prepare_resume` to the checkpointed state"""
+    with amb.session.graph.as_default():
+        tf.compat.v1.train.Saver().restore(amb.session, os.path.join(wd, CHECKPOINT_DIR, 'variables'))
+    np.random.set_state(state['numpy_rng'])
+    random.setstate(state['python_rng'])
+    amb.controller.buffer = state['buffer']
+    amb.env.entropy_record = state['entropy_record']
+    amb.env.start_ep = state['episode'] + 1
+
+
+def save_checkpoint(amb, wd, episode, elapsed, saver):
+    """Write a checkpoint after `episode` (0-based) to '<wd>/checkpoint', replacing the previous one"""
+    ckpt_dir = os.path.join(wd, CHECKPOINT_DIR)
+    tmp_dir = ckpt_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    amb.controller.save_weights(os.path.join(tmp_dir, 'controller_weights.h5'))
+    saver.save(amb.session, os.path.join(tmp_dir, 'variables'), write_meta_graph=False)
+    state = {
+        'episode': episode,
+        'numpy_rng': np.random.get_state(),
+        'python_rng': random.getstate(),
+        'buffer': amb.controller.buffer,
+        'entropy_record': amb.env.entropy_record,
+        'elapsed': elapsed,
+        'history_rows': _count_rows(os.path.join(wd, 'train_history.csv')),
+    }
+    with open(os.path.join(tmp_dir, 'state.pkl'), 'wb') as f:
+        pickle.dump(state, f)
+    # swap in the new checkpoint; the old one is only removed once the new one is complete
+    if os.path.isdir(ckpt_dir):
+        os.rename(ckpt_dir, ckpt_dir + '.old')
+    os.rename(tmp_dir, ckpt_dir)
+    shutil.rmtree(ckpt_dir + '.old', ignore_errors=True)
+
+
+def enable_checkpoints(amb, wd, every=1, state=None):
+    """Checkpoint an `amber.Amber` search every `every` episodes
+
+    The controller is trained once at the end of every episode, after all of its trials are written to
+    'train_history.csv', so checkpoints are taken right after that.
+
+    Parameters
+    ----------
+    amb : amber.Amber
+        the search, built (and restored, when resuming) but not yet run
+    wd : str
+        working directory of the search
+    every : int
+        number of episodes between checkpoints
+    state : dict, or None
+        checkpoint state the search resumed from, see `prepare_resume`
+    """
+    with amb.session.graph.as_default():
+        saver = tf.compat.v1.train.Saver()
+    train = amb.controller.train
+    progress = {'episode': amb.env.start_ep, 'start': time.time(),
+                'elapsed': state['elapsed'] if state is not None else 0.}
+
+    def checkpointed_train(*args, **kwargs):
+        loss = train(*args, **kwargs)
+        episode = progress['episode']
+        if (episode + 1) % every == 0:
+            save_checkpoint(amb, wd, episode, progress['elapsed'] + time.time() - progress['start'], saver)
+        progress['episode'] += 1
+        return loss
+
+    amb.controller.train = checkpointed_train
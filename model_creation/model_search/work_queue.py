@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Service-free work queue on a shared filesystem, for random architecture collections and replicate searches
+spread over any number of nodes
+
+A queue is a directory ('<wd>/queue' by default) with one json file per task in 'pending/', 'claimed/', 'done/'
+or 'failed/'. Workers claim a task by renaming it from 'pending/' to 'claimed/', which is atomic on POSIX (and
+NFS) filesystems, so exactly one worker wins it. While a task runs, its worker touches the claimed file every
+`heartbeat` seconds; a claimed file not touched for `lease` seconds belongs to a dead worker, and any worker puts it
+back in 'pending/' (or in 'failed/' after `max_attempts` claims). Lease ages are measured against the modification
+time of a file the reaper touches itself, so clocks of different nodes do not need to agree.
+
+Tasks are random architectures ('arc'), trained in the worker process as in `random_collection.py`, with their
+outputs in '<wd>/random_collections.denseResConn/arc_<k>/', the layout `get_randomized_distr.read_bg` reads; and
+search seeds ('seed'), run as `amber_cnn_sumstats.py --mode search --resume` in '<wd>/search_seed_<s>/', so a
+re-queued search continues from its last checkpoint. Workers do not write to the results store, which may not lock
+reliably on the shared filesystem; the finished runs are imported from their 'metrics.txt' by the one process reading
+them (`results_store --import-runs`, or `get_randomized_distr`).
+
+Example:
+    python -m model_creation.model_search.work_queue submit --wd ./outputs/forecast_freqs --num-arcs 500 --seed 0
+    # on every node:
+    python -m model_creation.model_search.work_queue work --wd ./outputs/forecast_freqs --dataset forecast \\
+        --tasks del_freq 1ins_freq 1del_freq onemod3_freq twomod3_freq frameshift_freq
+    python -m model_creation.model_search.work_queue status --wd ./outputs/forecast_freqs
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import socket
+import argparse
+import threading
+import subprocess
+import pandas as pd
+
+STATES = ('pending', 'claimed', 'done', 'failed')
+
+
+def _write_json(fp, obj):
+    # write next to the target, then rename, so readers never see a partial file
+    tmp_fp = '%s.%s.%i.tmp' % (fp, socket.gethostname(), os.getpid())
+    with open(tmp_fp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_fp, fp)
+
+
+def _read_json(fp):
+    with open(fp) as f:
+        return json.load(f)
+
+
+class WorkQueue:
+    """Task files in a shared directory, see the module docstring
+
+    Parameters
+    ----------
+    queue_dir : str
+        queue directory, shared by all workers
+    lease : float
+        seconds without a heartbeat after which a claimed task is re-queued
+    max_attempts : int
+        number of claims after which a task that keeps failing (or killing its worker) goes to 'failed/'
+    """
+
+    def __init__(self, queue_dir, lease=900., max_attempts=3):
+        self.queue_dir = queue_dir
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.worker_id = '%s.%i' % (socket.gethostname(), os.getpid())
+        for state in STATES:
+            os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+    def _fp(self, state, task_id):
+        return os.path.join(self.queue_dir, state, '%s.json' % task_id)
+
+    def task_ids(self, state):
+        return sorted(fn[:-len('.json')] for fn in os.listdir(os.path.join(self.queue_dir, state))
+                      if fn.endswith('.json'))
+
+    def submit(self, tasks):
+        """Add tasks (dicts with a unique 'id') that are not in the queue yet; returns the number added"""
+        known = set()
+        for state in STATES:
+            known.update(self.task_ids(state))
+        n_added = 0
+        for task in tasks:
+            if task['id'] in known:
+                continue
+            task = dict(task, attempts=0)
+            _write_json(self._fp('pending', task['id']), task)
+            n_added += 1
+        return n_added
+
+    def _now(self):
+        # the filesystem's clock, as seen by the file server
+        clock_fp = os.path.join(self.queue_dir, '.clock.%s' % self.worker_id)
+        with open(clock_fp, 'w'):
+            pass
+        now = os.path.getmtime(clock_fp)
+        os.remove(clock_fp)
+        return now
+
+    def reap(self):
+        """Re-queue claimed tasks whose lease expired; returns their ids"""
+        now = self._now()
+        reaped = []
+        for task_id in self.task_ids('claimed'):
+            fp = self._fp('claimed', task_id)
+            try:
+                # also covers a claim renamed but not written yet: `claim` touches the file before renaming it
+                if now - os.path.getmtime(fp) < self.lease:
+                    continue
+                task = _read_json(fp)
+            except (OSError, ValueError):  # completed, re-queued or rewritten by another worker meanwhile
+                continue
+            state = 'failed' if task['attempts'] >= self.max_attempts else 'pending'
+            try:
+                os.rename(fp, self._fp(state, task_id))
+            except OSError:
+                continue
+            print("[queue] lease of %s (worker %s) expired, moved to %s" % (task_id, task.get('worker'), state),
+                  flush=True)
+            reaped.append(task_id)
+        return reaped
+
+    def claim(self):
+        """Claim the next pending task; returns it, or None if there are none"""
+        for task_id in self.task_ids('pending'):
+            pending_fp, fp = self._fp('pending', task_id), self._fp('claimed', task_id)
+            try:
+                # the rename keeps the mtime, which would make a task pending for longer than the lease look expired
+                os.utime(pending_fp)
+                os.rename(pending_fp, fp)
+            except OSError:  # claimed by another worker first
+                continue
+            try:
+                task = _read_json(fp)
+                task.update(attempts=task['attempts'] + 1, worker=self.worker_id, claimed_at=time.time())
+                _write_json(fp, task)
+            except (OSError, ValueError):  # re-queued or completed by another worker meanwhile
+                continue
+            return task
+        return None
+
+    def heartbeat(self, task):
+        """Renew the lease on a claimed task; False if it is no longer claimed by this worker"""
+        fp = self._fp('claimed', task['id'])
+        try:
+            os.utime(fp)
+            return _read_json(fp).get('worker') == self.worker_id
+        except (OSError, ValueError):
+            return False
+
+    def complete(self, task, result):
+        """Record a finished task, with its `result` dict"""
+        _write_json(self._fp('done', task['id']), dict(task, result=result, finished_at=time.time()))
+        for state in ('claimed', 'pending'):  # also drop a copy re-queued while the lease had lapsed
+            try:
+                os.remove(self._fp(state, task['id']))
+            except OSError:
+                pass
+
+    def fail(self, task, error):
+        """Give a task that raised back to the queue, or to 'failed/' after `max_attempts`"""
+        state = 'failed' if task['attempts'] >= self.max_attempts else 'pending'
+        if not self.heartbeat(task):  # the lease had lapsed and the task was re-queued already
+            return 'pending'
+        fp = self._fp('claimed', task['id'])
+        _write_json(fp, dict(task, error=error))
+        os.rename(fp, self._fp(state, task['id']))
+        return state
+
+    def counts(self):
+        return {state: len(self.task_ids(state)) for state in STATES}
+
+
+class Heartbeat(threading.Thread):
+    """Renew the lease of `task` every `interval` seconds until stopped"""
+
+    def __init__(self, queue, task, interval=60.):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.task = task
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if not self.queue.heartbeat(self.task) and not self.lost:
+                self.lost = True
+                print("[queue] lost the claim on %s; it may be run again elsewhere" % self.task['id'], flush=True)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def arc_tasks(wd, num_arcs, seed=None):
+    """'arc' tasks for `num_arcs` architectures sampled as in `random_collection.main` with the same seed"""
+    from model_creation.model_search.random_collection import sample_arcs
+    model_space = pickle.load(open(os.path.join(wd, "model_space.pkl"), "rb"))
+    arcs = sample_arcs(model_space, num_arcs, seed=seed)
+    return [{'id': 'arc_%04i' % k, 'kind': 'arc', 'k': k, 'arc': [int(a) for a in arc]} for k, arc in enumerate(arcs)]
+
+
+def seed_tasks(seeds):
+    """'seed' tasks, one replicate search per seed"""
+    return [{'id': 'seed_%i' % s, 'kind': 'seed', 'seed': int(s)} for s in seeds]
+
+
+class Worker:
+    """Runs queued tasks until the queue is drained
+
+    Parameters
+    ----------
+    wd : str
+        working directory of the search, holding "model_space.pkl" (for 'arc' tasks); outputs go under it
+    dataset, tasks, data_dir, threads, epochs, patience, verbose, hide_gpus, use_cache, cache_dir :
+        see `random_collection.main`
+    queue_dir : str, or None
+        defaults to '<wd>/queue'
+    lease, max_attempts :
+        see `WorkQueue`
+    heartbeat : float
+        seconds between lease renewals; should be well below `lease`
+    poll : float
+        seconds to wait for tasks of other workers to finish or be re-queued when nothing is pending
+    """
+
+    def __init__(self, wd, dataset, tasks, queue_dir=None, data_dir=None, threads=None, epochs=500, patience=50,
+                 verbose=0, hide_gpus=True, use_cache=True, cache_dir=None, lease=900., max_attempts=3,
+                 heartbeat=60., poll=60.):
+        self.wd = wd
+        self.dataset = dataset
+        self.tasks = tasks
+        self.queue = WorkQueue(queue_dir or os.path.join(wd, 'queue'), lease=lease, max_attempts=max_attempts)
+        self.data_dir = data_dir
+        self.threads = threads or os.cpu_count()
+        self.epochs = epochs
+        self.patience = patience
+        self.verbose = verbose
+        self.hide_gpus = hide_gpus
+        self.cache_dir = (cache_dir or os.path.join(wd, 'arch_cache')) if use_cache else None
+        self.heartbeat = heartbeat
+        self.poll = poll
+        self.train_config = None
+
+    def _run_arc(self, task):
+        from model_creation.model_search import random_collection
+        from model_creation.model_search.arch_cache import fingerprint
+        if self.train_config is None:  # load the data once per worker process
+            from model_creation.model_search.amber_cnn_sumstats import get_train_config
+            random_collection._init_worker(self.wd, self.dataset, self.tasks, self.data_dir, self.threads,
+                                           2 if self.threads >= 4 else 1, self.hide_gpus)
+            self.train_config = get_train_config(self.dataset, data_dir=self.data_dir, epochs=self.epochs,
+                                               patience=self.patience)
+        cache_key = fingerprint(random_collection._worker['model_space'], task['arc'], self.tasks,
+                                self.train_config) if self.cache_dir else None
+        wd_ = os.path.join(self.wd, 'random_collections.denseResConn', 'arc_%04i' % task['k'])
+        _, wall, metrics, n_epochs = random_collection._train_one(task['k'], task['arc'], wd_, self.epochs,
+                                                                  self.patience, self.verbose, self.cache_dir,
+                                                                  cache_key)
+        return {'wd': wd_, 'wall_time': wall, 'epochs': n_epochs, 'metrics': metrics}
+
+    def _run_seed(self, task):
+        # a fresh process per search: the AMBER session and graph are process-wide
+        wd_ = os.path.join(self.wd, 'search_seed_%i' % task['seed'])
+        cmd = [sys.executable, '-m', 'model_creation.model_search.amber_cnn_sumstats', '--mode', 'search',
+               '--wd', wd_, '--dataset', self.dataset, '--tasks'] + list(self.tasks) + [
+               '--seed', str(task['seed']), '--resume']
+        if self.data_dir is not None:
+            cmd += ['--data-dir', self.data_dir]
+        if self.cache_dir is None:
+            cmd += ['--no-cache']
+        start = time.time()
+        with open(os.path.join(self.queue.queue_dir, 'logs', '%s.log' % task['id']), 'a') as log:
+            subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, check=True)
+        return {'wd': wd_, 'wall_time': time.time() - start}
+
+    def run(self, wait=True):
+        """Claim and run tasks until none are pending (and, if `wait`, none are claimed by live workers);
+        returns the number of tasks this worker completed
+        """
+        os.makedirs(os.path.join(self.queue.queue_dir, 'logs'), exist_ok=True)
+        n_done = 0
+        while True:
+            self.queue.reap()
+            task = self.queue.claim()
+            if task is None:
+                if wait and self.queue.task_ids('claimed'):
+                    time.sleep(self.poll)
+                    continue
+                break
+            print("[queue] %s: running %s (attempt %i)" % (self.queue.worker_id, task['id'], task['attempts']),
+                  flush=True)
+            heartbeat = Heartbeat(self.queue, task, interval=self.heartbeat)
+            heartbeat.start()
+            try:
+                result = self._run_arc(task) if task['kind'] == 'arc' else self._run_seed(task)
+            except Exception as e:
+                heartbeat.stop()
+                state = self.queue.fail(task, '%s: %s' % (type(e).__name__, e))
+                print("[queue] %s failed (%s: %s), moved to %s" % (task['id'], type(e).__name__, e, state),
+                      flush=True)
+                continue
+            heartbeat.stop()
+            self.queue.complete(task, result)
+            n_done += 1
+            print("[queue] %s done in %.1f min; %s" % (
+                task['id'], result['wall_time'] / 60., self.queue.counts()), flush=True)
+        print("[queue] %s: no tasks left, %i completed by this worker" % (self.queue.worker_id, n_done))
+        return n_done
+
+
+def status(queue_dir):
+    """Task counts by state, and the claimed tasks with their workers and heartbeat ages
+
+    Returns
+    -------
+    counts : dict
+        state -> number of tasks
+    claimed : pandas.DataFrame
+        columns "id", "worker", "attempts" and "heartbeat_age" (seconds)
+    """
+    queue = WorkQueue(queue_dir)
+    now = queue._now()
+    rows = []
+    for task_id in queue.task_ids('claimed'):
+        fp = queue._fp('claimed', task_id)
+        try:
+            task = _read_json(fp)
+            rows.append({'id': task_id, 'worker': task.get('worker'), 'attempts': task['attempts'],
+                         'heartbeat_age': now - os.path.getmtime(fp)})
+        except (OSError, ValueError):
+            continue
+    return queue.counts(), pd.DataFrame(rows, columns=['id', 'worker', 'attempts', 'heartbeat_age'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Shared-filesystem work queue for CROTON collections and searches')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    submit_parser = subparsers.add_parser('submit', help="add architecture and/or search seed tasks")
+    submit_parser.add_argument("--num-arcs", type=int, default=0, help="random architectures to sample")
+    submit_parser.add_argument("--seed", type=int, default=None, help="seed for sampling architectures")
+    submit_parser.add_argument("--search-seeds", type=int, nargs='+', default=[], help="replicate search seeds")
+
+    work_parser = subparsers.add_parser('work', help="run tasks until the queue is drained")
+    work_parser.add_argument("--dataset", type=str, choices=['all', 'forecast', 'sprout'], required=True,
+                             help="training dataset")
+    work_parser.add_argument("--tasks", type=str, nargs='+', required=True,
+                             choices=['del_freq', '1ins_freq', '1del_freq', 'frameshift_freq',
+                                      'onemod3_freq', 'twomod3_freq',
+                                      'avgdel_len', 'avgins_len', 'entropy'],
+                             help="tasks of interest")
+    work_parser.add_argument("--data-dir", type=str, default=None, help="stream train/val/test shards from here")
+    work_parser.add_argument("--threads", type=int, default=None, help="CPU threads; default all cores")
+    work_parser.add_argument("--epochs", type=int, default=500, help="maximum epochs per architecture")
+    work_parser.add_argument("--patience", type=int, default=50, help="early stopping patience")
+    work_parser.add_argument("--cache-dir", type=str, default=None, help="architecture cache dir")
+    work_parser.add_argument("--no-cache", action='store_true', help="retrain architectures even if cached")
+    work_parser.add_argument("--lease", type=float, default=900., help="seconds before a silent task is re-queued")
+    work_parser.add_argument("--heartbeat", type=float, default=60., help="seconds between lease renewals")
+    work_parser.add_argument("--max-attempts", type=int, default=3, help="claims before a task is failed")
+    work_parser.add_argument("--no-wait", action='store_true',
+                             help="exit when nothing is pending, instead of waiting for tasks of other workers")
+
+    subparsers.add_parser('status', help="print task counts and claimed tasks")
+
+    for p in (submit_parser, work_parser, subparsers.choices['status']):
+        p.add_argument("--wd", type=str, required=True, help="working dir with model_space.pkl")
+        p.add_argument("--queue-dir", type=str, default=None, help="queue dir; default <wd>/queue")
+    args = parser.parse_args()
+    queue_dir = args.queue_dir or os.path.join(args.wd, 'queue')
+
+    if args.command == 'submit':
+        new_tasks = seed_tasks(args.search_seeds)
+        if args.num_arcs:
+            new_tasks += arc_tasks(args.wd, args.num_arcs, seed=args.seed)
+        print("[queue] %i of %i tasks added to %s" % (WorkQueue(queue_dir).submit(new_tasks), len(new_tasks),
+                                                       queue_dir))
+    elif args.command == 'work':
+        Worker(args.wd, args.dataset, args.tasks, queue_dir=queue_dir, data_dir=args.data_dir, threads=args.threads,
+               epochs=args.epochs, patience=args.patience, use_cache=not args.no_cache, cache_dir=args.cache_dir,
+               lease=args.lease, max_attempts=args.max_attempts, heartbeat=args.heartbeat).run(wait=not args.no_wait)
+    else:
+        counts, claimed = status(queue_dir)
+        print(" ".join("%s=%i" % (state, counts[state]) for state in STATES))
+        if len(claimed):
+            print(claimed.to_string(index=False))
@@ -0,0 +1,141 @@
+import os
+import pandas as pd
+import pytest
+from model_creation.data_compilation.compile_sprout import (get_master_df, compile_sprout_stats, read_master,
+    iter_master_tables)
+from model_creation.data_compilation.synthetic import write_sprout
+
+
+def baseline_get_master_df(cts_path, ins_path, maxlen=80):
+    # get_master_df before it was vectorized, with DataFrame.append (removed in pandas 2) as pd.concat
+    counts = pd.read_csv(cts_path)
+    counts = counts.rename(columns={ counts.columns[0]: 'cigar' })
+
+    counts = counts.dropna()
+    no_include_inds = []
+    for ind in range(len(counts)):
+        if (counts.cigar.iloc[ind].count('SNV') == 1): no_include_inds.append(ind)
+        elif (counts.cigar.iloc[ind] == 'no variant'): no_include_inds.append(ind)
+
+        if (counts.cigar.iloc[ind].count('I') > 0) and (counts.cigar.iloc[ind].count('D') > 0): no_include_inds.append(ind)
+        elif (counts.cigar.iloc[ind].count('I') > 1) or (counts.cigar.iloc[ind].count('D') > 1): no_include_inds.append(ind)
+        elif(counts.cigar.iloc[ind] == 'Other'): no_include_inds.append(ind)
+
+    master_df = counts[~counts.index.isin(no_include_inds)]
+    master_df = master_df[['cigar', 'total', 'seq', 'seqlen']]
+
+    if os.path.exists(ins_path):
+        ins = pd.read_csv(ins_path)
+        ins = ins.dropna()
+        if len(ins) != 0:
+            grouped = ins.groupby(ins.Sample)
+            groups = list(set(ins.Sample.tolist()))
+            ins_df = grouped.get_group(groups[0])
+            ins_df = ins_df[['Allele', 'Count', 'insseq', 'seqlen']]
+            for i in range(len(groups) - 1):
+                sample = grouped.get_group(groups[i+1])
+                sample = sample[['Allele', 'Count', 'insseq', 'seqlen']]
+                ins_df = pd.merge(ins_df, sample, on=['Allele', 'insseq', 'seqlen'], how='outer').fillna(0)
+                ins_df['Count'] = ins_df['Count_x'] + ins_df['Count_y']
+                ins_df = ins_df[['Allele', 'Count', 'insseq', 'seqlen']]
+            ins_df = ins_df[ins_df['seqlen'] <= maxlen]
+            ins_df = ins_df.rename(columns={'Allele': 'cigar', 'Count':'total', 'insseq':'seq'})
+            master_df = pd.concat([master_df, ins_df])
+    master_df['seq'] = master_df['seq'].str.upper()
+
+    return master_df
+
+
+def sorted_master(df):
+    return df.sort_values(['cigar', 'seq', 'seqlen', 'total']).reset_index(drop=True)
+
+
+COUNTS_HEADER = ',D1_A-1.bam,D2_A-1.bam,seq,seqlen,proba,total'
+COUNTS_ROWS = [
+    '-3:2D,30,25,ACGTacgtACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTAC,58,0.2,55',
+    '1:1I,40,38,ACGTACGTACGTACGTACGTACGTACGTTACGTACGTACGTACGTACGTACGTACGTAC,61,0.2,78',
+    '-1:1D,22,27,ACGTACGTACGTACGTACGTACGTACGTCGTACGTACGTACGTACGTACGTACGTAC,59,0.1,49',
+    'no variant,200,180,ACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGT,60,0.3,380',
+    'SNV:2A,21,30,ACGTACGTACGTACGTACGTACGTACGTACGTAAGTACGTACGTACGTACGTACGTACGT,60,0.05,51',
+    'Other,25,25,ACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGTACGT,60,0.05,50',
+    '"-2:1D,3:1I",23,24,ACGTACGTACGTACGTACGTACGTACGTCGTAACGTACGTACGTACGTACGTACGTACGT,60,0.05,47',
+    '2:2I,30,31,ACGTACGTACGTACGTACGTACGTACGTAAACGTACGTACGTACGTACGTACGTACGTACGT,62,0.05,61',
+]
+INSERTIONS = [
+    'Sample,Allele,Count,insseq,seqlen',
+    'D1_A-1.bam,1:5I,12,ACGTA,65', 'D2_A-1.bam,1:5I,7,ACGTA,65', 'D2_A-1.bam,1:5I,3,TTTTT,65',
+    'D1_A-1.bam,1:25I,4,ACGTACGTACGTACGTACGTACGTA,85', 'D1_A-1.bam,1:12I,9,acgtacgtacgt,72',
+]
+
+
+def write_inputs(tmp_path, counts_rows=COUNTS_ROWS, insertions=INSERTIONS):
+    cts_path, ins_path = str(tmp_path / 'counts-A-1.txt'), str(tmp_path / 'insertions-A-1.txt')
+    with open(cts_path, 'w') as f:
+        f.write('\n'.join([COUNTS_HEADER] + counts_rows) + '\n')
+    if insertions is not None:
+        with open(ins_path, 'w') as f:
+            f.write('\n'.join(insertions) + '\n')
+    return cts_path, ins_path
+
+
+def test_master_df_matches_baseline(tmp_path):
+    for insertions in (INSERTIONS, [INSERTIONS[0], INSERTIONS[1], INSERTIONS[5]], None): # several samples, one, none
+        cts_path, ins_path = write_inputs(tmp_path, insertions=insertions)
+        if insertions is None and os.path.exists(ins_path): os.remove(ins_path)
+        new, old = get_master_df(cts_path, ins_path), baseline_get_master_df(cts_path, ins_path)
+        # same rows and totals; insertion totals only differ in dtype, integers instead of floats from the
+        # outer merges
+        pd.testing.assert_frame_equal(sorted_master(new), sorted_master(old), check_dtype=False)
+        assert pd.api.types.is_integer_dtype(new['total'])
+    assert set(new['cigar']) == {'-3:2D', '1:1I', '-1:1D', '2:2I'}
+
+
+def test_master_df_classifies_rows_after_dropna_by_position(tmp_path):
+    # the baseline collected positions but tested them against index labels, which no longer line up
+    # once dropna removed a row: a row with missing counts shifted which rows were excluded
+    expected = baseline_get_master_df(*write_inputs(tmp_path))
+    nan_paths = write_inputs(tmp_path, counts_rows=['1:3I,,,ACGT,63,,'] + COUNTS_ROWS)
+    new = get_master_df(*nan_paths)
+    pd.testing.assert_frame_equal(sorted_master(new), sorted_master(expected), check_dtype=False)
+    assert not sorted_master(baseline_get_master_df(*nan_paths)).equals(sorted_master(expected))
+
+
+@pytest.fixture(scope='module')
+def sprout_dir(tmp_path_factory):
+    out_dir = tmp_path_factory.mktemp('sprout')
+    write_sprout(str(out_dir), scale=0.01, seed=0)
+    return out_dir
+
+
+def test_master_df_matches_baseline_on_synthetic_inputs(sprout_dir):
+    counts_dir = sprout_dir / 'data' / 'Sprout' / 'counts'
+    insertions_dir = sprout_dir / 'data' / 'Sprout' / '30insertions'
+    keys = sorted(fn[len('counts-'):-len('.txt')] for fn in os.listdir(counts_dir))
+    n_with_insertions = 0
+    for key in keys:
+        cts_path = str(counts_dir / ('counts-%s.txt' % key))
+        ins_path = str(insertions_dir / ('insertions-%s.txt' % key))
+        new, old = get_master_df(cts_path, ins_path), baseline_get_master_df(cts_path, ins_path)
+        pd.testing.assert_frame_equal(sorted_master(new), sorted_master(old), check_dtype=False)
+        n_with_insertions += os.path.exists(ins_path)
+    assert n_with_insertions > 0
+
+
+def test_master_store_reads_back_as_master_files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for directory in ('counts', '30insertions'):
+        os.makedirs(tmp_path / 'data' / 'Sprout' / directory)
+    cts_path, ins_path = write_inputs(tmp_path)
+    os.replace(cts_path, tmp_path / 'data' / 'Sprout' / 'counts' / 'counts-A-1.txt')
+    os.replace(ins_path, tmp_path / 'data' / 'Sprout' / '30insertions' / 'insertions-A-1.txt')
+    pd.DataFrame({'genename': ['A'], 'id_ending': ["['-1']"], 'insertions': [150],
+                  'deletions': [100]}).to_csv('key_df.csv', index=False)
+
+    compile_sprout_stats(out_fp='key_df.dir.csv', master_dir='master', n_jobs=1)
+    compile_sprout_stats(out_fp='key_df.store.csv', master_store_fp='master.h5', n_jobs=1)
+    pd.testing.assert_frame_equal(pd.read_csv('key_df.store.csv'), pd.read_csv('key_df.dir.csv'))
+    from_dir = read_master('A', master_store_fp=None, master_dir='master')
+    from_store = read_master('A', master_store_fp='master.h5', master_dir=None)
+    pd.testing.assert_frame_equal(from_store, from_dir, check_dtype=False) # object vs. str columns
+    assert [genename for genename, _ in iter_master_tables('master.h5', None)] == ['A']
+    assert [genename for genename, _ in iter_master_tables(None, 'master')] == ['A']
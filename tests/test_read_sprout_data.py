@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+from model_creation.data_compilation.read_sprout_data import add_num_indels
+
+
+def write_counts(fp, bams, rows):
+    # rows: cigar -> reads per BAM file
+    with open(fp, 'w') as f:
+        f.write(',' + ','.join(bams) + ',seq,seqlen,proba,total\n')
+        for cigar, reads in rows.items():
+            cigar = '"%s"' % cigar if ',' in cigar else cigar
+            f.write('%s,%s,ACGT,60,0.1,%i\n' % (cigar, ','.join(map(str, reads)), sum(reads)))
+
+
+def test_add_num_indels_matches_bam_files_exactly(tmp_path):
+    counts_dir = tmp_path / 'counts'
+    counts_dir.mkdir()
+    final_fp, out_fp = str(tmp_path / 'final_df.csv'), str(tmp_path / 'final_df.out.csv')
+    # 'D1_A-1.bam' is a substring of 'XD1_A-1.bam', which the old substring lookup also matched
+    pd.DataFrame({'genename': ['A', 'XA', 'B', 'C'],
+                  'bams': ['D1_A-1.bam,D2_A-1.bam', 'XD1_A-1.bam', 'D1_B-3.bam', 'D1_C-4.bam']}).to_csv(final_fp,
+                                                                                                   index=False)
+    write_counts(counts_dir / 'counts-A-1.txt', ['D1_A-1.bam', 'D2_A-1.bam'],
+                 {'1:1I': [10, 20], '-2:2D': [5, 5], 'no variant': [100, 100], '-2:1D,3:1I': [7, 7]})
+    write_counts(counts_dir / 'counts-B-3.txt', ['D1_B-3.bam'], {'-1:1D': [30], 'SNV:3A': [4]})
+    write_counts(counts_dir / 'counts-Z-9.txt', ['D1_Z-9.bam'], {'1:1I': [50]}) # not in final_df
+
+    add_num_indels(in_fp=final_fp, out_fp=out_fp, counts_dir=str(counts_dir), counts_store_fp=None)
+    df = pd.read_csv(out_fp).set_index('genename')
+
+    assert df.loc['A', ['insertions', 'deletions', 'total_out']].tolist() == [30., 10., 240.]
+    assert df.loc['B', ['insertions', 'deletions', 'total_out']].tolist() == [0., 30., 34.]
+    assert np.isnan(df.loc['XA', ['insertions', 'deletions', 'total_out']].astype(float)).all()
+    assert np.isnan(df.loc['C', ['insertions', 'deletions', 'total_out']].astype(float)).all()